@@ -36,6 +36,7 @@ from sklearn.metrics import make_scorer, mean_squared_error
 
 sys.path.append('/Users/lindenmp/Google-Drive-Penn/work/research_projects/neurodev_cs_predictive/1_code/')
 from func import set_proj_env, my_get_cmap, root_mean_squared_error, get_reg, get_stratified_cv, cross_val_score_nuis, get_fdr_p
+from prediction_func import load_fold_artifacts, get_fold_artifact_file, check_fold_artifacts
 
 
 # In[4]:
@@ -449,8 +450,15 @@ for m, metric in enumerate(metrics):
         # sort and get cross-val
         X_sort, y_sort, my_cv, c_sort = get_stratified_cv(X = X, y = y, c = c, n_splits = n_splits)
 
-        # get full model score
-        nuis_model, _ = cross_val_score_nuis(X = X_sort, y = y_sort, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = my_scorer)
+        # get full model score. fold scores saved by the cluster jobs (see load_fold_artifacts) are used where those
+        # jobs were run on these rows, folds, features and nuisance model (see check_fold_artifacts); otherwise (e.g.,
+        # for control_c, which only the rcv jobs cover, or a lausanne parcel subset) the model is fit here
+        order = y.index.get_indexer(y_sort.index)
+        artifacts = None
+        if control_c == None:
+            artifacts = load_fold_artifacts(get_fold_artifact_file(predictiondir + 'predict_symptoms_scv_nuis', alg, metric, pheno))
+        if check_fold_artifacts(artifacts, order, n_features = X.shape[1]): nuis_model = artifacts['accuracy'][score]
+        else: nuis_model, _ = cross_val_score_nuis(X = X_sort, y = y_sort, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = my_scorer)
         if score == 'rmse': nuis_model = np.abs(nuis_model)
         main_score_nuis = nuis_model.mean()
         main_sterr_nuis = nuis_model.std() / np.sqrt(n_splits)
@@ -466,7 +474,13 @@ for m, metric in enumerate(metrics):
 
         for i, w in enumerate(window_start):
             Xl = X_sort_grad.iloc[:,w:w+bin_size]
-            cv_results, _ = cross_val_score_nuis(X = Xl, y = y_sort, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = my_scorer)
+            artifacts = None
+            if control_c == None:
+                artifacts = load_fold_artifacts(get_fold_artifact_file(os.path.join(indir, 'bin_'+str(i)), alg, metric, pheno))
+            if check_fold_artifacts(artifacts, order, n_features = Xl.shape[1]):
+                cv_results = artifacts['accuracy'][score]
+            else:
+                cv_results, _ = cross_val_score_nuis(X = Xl, y = y_sort, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = my_scorer)
             if score == 'rmse': cv_results = np.abs(cv_results)
             window_score[i] = cv_results.mean()
             window_sterr[i] = cv_results.std() / np.sqrt(n_splits)
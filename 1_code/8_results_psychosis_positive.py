@@ -38,6 +38,8 @@ from sklearn.utils import resample
 sys.path.append('/Users/lindenmp/Google-Drive-Penn/work/research_projects/neurodev_cs_predictive/1_code/')
 from func import set_proj_env, my_get_cmap, get_fdr_p, assemble_df, get_exact_p, get_fdr_p_df
 from func import get_stratified_cv, cross_val_score_nuis, get_reg, corr_true_pred, root_mean_squared_error
+from split_func import get_split_plan
+from prediction_func import load_fold_artifacts, get_fold_artifact_file, check_fold_artifacts
 
 
 # In[4]:
@@ -171,6 +173,8 @@ num_subjects = df.shape[0]; print(num_subjects)
 
 
 predictiondir = os.path.join(os.environ['PIPELINEDIR'], '3_prediction_rnr', 'out', outfile_prefix)
+# split plans written by the cluster jobs (see split_func.py)
+split_dir = predictiondir + 'splits'
 predictiondir
 
 
@@ -238,8 +242,17 @@ sp.stats.ttest_ind(y[clinical_idx],y[~clinical_idx])
 # In[21]:
 
 
-X_sort, y_sort, my_cv, c_sort = get_stratified_cv(X = X, y = y, c = c, n_splits = n_splits)
-accuracy_nuis, y_pred = cross_val_score_nuis(X = X_sort, y = y_sort, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = my_scorer)
+# the same stratified folds predict_symptoms_scv_nuis.py used for this pheno
+plan = get_split_plan(split_dir, y.index, 'stratified', n_splits = n_splits, y = y)
+X_sort, y_sort, my_cv, c_sort = get_stratified_cv(X = X, y = y, c = c, n_splits = n_splits, plan = plan)
+
+# out-of-fold predictions and fold scores saved by the cluster job (see load_fold_artifacts); the model is only refit
+# here if the job predates saved artifacts or was run on other folds, features or nuisance model (see check_fold_artifacts)
+artifacts = load_fold_artifacts(get_fold_artifact_file(predictiondir + 'predict_symptoms_scv_nuis', alg, metric, pheno))
+if check_fold_artifacts(artifacts, plan[0,0], n_features = X.shape[1]):
+    accuracy_nuis = artifacts['accuracy'][score]; y_pred = artifacts['y_pred']
+else:
+    accuracy_nuis, y_pred = cross_val_score_nuis(X = X_sort, y = y_sort, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = my_scorer)
 print(np.mean(accuracy_nuis))
 
 clinical_idx_sort = clinical_idx[y_sort.index]
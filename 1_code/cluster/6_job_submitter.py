@@ -6,18 +6,35 @@
 # In[ ]:
 
 
-import os
+import os, sys
 import numpy as np
 import subprocess
 import json
 
-py_exec = '/cbica/home/parkesl/miniconda3/envs/neurodev_cs_predictive/bin/python'
+# where the jobs run (see job_func.py): 'sge' submits with qsub on cubic, 'local' runs them on this machine in a
+# process pool using at most max_cpus cores, and 'shell' writes one job array script per section for other schedulers.
+# the paths can be pointed elsewhere through the environment for the local and shell backends
+backend = os.environ.get('JOB_BACKEND', 'sge')
+max_cpus = None
+projdir = os.environ.get('PROJDIR', '/cbica/home/parkesl/research_projects/neurodev_cs_predictive')
+py_exec = os.environ.get('PY_EXEC', '/cbica/home/parkesl/miniconda3/envs/neurodev_cs_predictive/bin/python')
+log_dir = os.environ.get('JOB_LOG_DIR', '/cbica/home/parkesl/sge/')
+
+# job packing (see pack_func.py): with pack_size > 0 each section's jobs are run pack_size at a time by one
+# interpreter that imports the libraries and parses each csv once (cluster/run_packed.py), instead of one per job
+pack_size = int(os.environ.get('JOB_PACK_SIZE', 0))
+pack = {'py_exec': py_exec, 'worker': projdir+'/1_code/cluster/run_packed.py', 'batch_size': pack_size} if pack_size > 0 else None
+
+sys.path.append(os.path.join(projdir, '1_code'))
+from job_func import make_job, submit_jobs
 
 my_str = 'schaefer_200_streamlineCount'
 # my_str = 'schaefer_400_streamlineCount'
 
-indir = '/cbica/home/parkesl/research_projects/neurodev_cs_predictive/2_pipeline/1_compute_node_features/out/'+my_str+'_'
-outdir = '/cbica/home/parkesl/research_projects/neurodev_cs_predictive/2_pipeline/3_prediction/out/'+my_str+'_'
+indir = projdir+'/2_pipeline/1_compute_node_features/out/'+my_str+'_'
+outdir = projdir+'/2_pipeline/3_prediction/out/'+my_str+'_'
+# split plans (see split_func.py) shared by every job below and by the results notebooks
+split_dir = outdir+'splits'
 phenos = ['Overall_Psychopathology','Psychosis_Positive','Psychosis_NegativeDisorg']
 
 print(indir)
@@ -26,6 +43,8 @@ print(phenos)
 metrics = ['str', 'ac']
 algs = ['rr', 'krr_rbf']
 scores = ['corr', 'rmse']
+# the rcv/scv scripts compute every score from the same fits, so they take all scores in one job
+score_str = ','.join(scores)
 
 num_algs = len(algs)
 num_metrics = len(metrics)
@@ -40,19 +59,21 @@ print(num_algs * num_metrics * num_phenos * num_scores)
 # In[ ]:
 
 
-py_script = '/cbica/home/parkesl/research_projects/neurodev_cs_predictive/1_code/cluster/predict_symptoms_rcv_nuis.py'
+py_script = projdir+'/1_code/cluster/predict_symptoms_rcv_nuis.py'
 modeldir = outdir+'predict_symptoms_rcv_nuis'
 
+# the random splits don't depend on y, so one job fits every pheno on the same folds (see predict_symptoms_rcv_nuis.py)
+pheno_str = ','.join(phenos)
+
+jobs = []
 for alg in algs:
     for metric in metrics:
-        for pheno in phenos:
-            for score in scores:
-                subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -c {2}c.csv -alg {3} -metric {4} -pheno {5} -score {6} -o {7}'.format(py_exec, py_script, indir, alg, metric, pheno, score, modeldir)
+        subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -c {2}c.csv -alg {3} -metric {4} -pheno {5} -score {6} -split_dir {7} -o {8}'.format(py_exec, py_script, indir, alg, metric, pheno_str, score_str, split_dir, modeldir)
 
-                name = 'prim' + '_' + alg + '_' + metric[0] + '_' + pheno[0] + '_' + score[0]
-                qsub_call = 'qsub -N {0} -l h_vmem=1G,s_vmem=1G -pe threaded 4 -j y -b y -o /cbica/home/parkesl/sge/ -e /cbica/home/parkesl/sge/ '.format(name)
+        name = 'prim' + '_' + alg + '_' + metric[0]
+        jobs.append(make_job(name, subprocess_str, n_cpus = 4, mem = '1G'))
 
-                os.system(qsub_call + subprocess_str)
+submit_jobs(jobs, backend = backend, log_dir = log_dir, max_cpus = max_cpus, script_file = modeldir+'_jobs.sh', pack = pack)
 
 
 # ### Over c
@@ -61,19 +82,20 @@ for alg in algs:
 
 
 metrics = ['ac_c10', 'ac_c100', 'ac_c1000', 'ac_c10000']
-py_script = '/cbica/home/parkesl/research_projects/neurodev_cs_predictive/1_code/cluster/predict_symptoms_rcv_nuis.py'
+py_script = projdir+'/1_code/cluster/predict_symptoms_rcv_nuis.py'
 modeldir = outdir+'predict_symptoms_rcv_nuis'
 
+pheno_str = ','.join(phenos)
+
+jobs = []
 for alg in algs:
     for metric in metrics:
-        for pheno in phenos:
-            for score in scores:
-                subprocess_str = '{0} {1} -x {2}X_ac_c.csv -y {2}y.csv -c {2}c.csv -alg {3} -metric {4} -pheno {5} -score {6} -o {7}'.format(py_exec, py_script, indir, alg, metric, pheno, score, modeldir)
+        subprocess_str = '{0} {1} -x {2}X_ac_c.csv -y {2}y.csv -c {2}c.csv -alg {3} -metric {4} -pheno {5} -score {6} -n_jobs 2 -split_dir {7} -o {8}'.format(py_exec, py_script, indir, alg, metric, pheno_str, score_str, split_dir, modeldir)
 
-                name = 'prim' + '_' + alg + '_' + metric[0] + '_' + pheno[0] + '_' + score[0]
-                qsub_call = 'qsub -N {0} -l h_vmem=1G,s_vmem=1G -pe threaded 2 -j y -b y -o /cbica/home/parkesl/sge/ -e /cbica/home/parkesl/sge/ '.format(name)
+        name = 'prim' + '_' + alg + '_' + metric[0]
+        jobs.append(make_job(name, subprocess_str, n_cpus = 2, mem = '1G'))
 
-                os.system(qsub_call + subprocess_str)
+submit_jobs(jobs, backend = backend, log_dir = log_dir, max_cpus = max_cpus, script_file = modeldir+'_jobs.sh', pack = pack)
 
 metrics = ['str', 'ac']
 
@@ -83,19 +105,65 @@ metrics = ['str', 'ac']
 # In[ ]:
 
 
-py_script = '/cbica/home/parkesl/research_projects/neurodev_cs_predictive/1_code/cluster/predict_symptoms_scv_nuis.py'
+py_script = projdir+'/1_code/cluster/predict_symptoms_scv_nuis.py'
 modeldir = outdir+'predict_symptoms_scv_nuis'
 
+jobs = []
 for alg in algs:
     for metric in metrics:
         for pheno in phenos:
-            for score in scores:
-                subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -c {2}c.csv -alg {3} -metric {4} -pheno {5} -score {6} -o {7}'.format(py_exec, py_script, indir, alg, metric, pheno, score, modeldir)
+            subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -c {2}c.csv -alg {3} -metric {4} -pheno {5} -score {6} -split_dir {7} -o {8}'.format(py_exec, py_script, indir, alg, metric, pheno, score_str, split_dir, modeldir)
+
+            name = 'null' + '_' + alg + '_' + metric[0] + '_' + pheno[0]
+            jobs.append(make_job(name, subprocess_str, n_cpus = 4, mem = '1G'))
+
+submit_jobs(jobs, backend = backend, log_dir = log_dir, max_cpus = max_cpus, script_file = modeldir+'_jobs.sh', pack = pack)
+
+
+# ### Nuisance regressed out of y
+
+# In[ ]:
+
+
+py_script = projdir+'/1_code/cluster/predict_symptoms_scv_nuis.py'
+modeldir = outdir+'predict_symptoms_scv_nuis_y'
+
+# nuisance regressed out of y as well as X; the fold-wise residual-forming matrices are computed once and reused by
+# every permutation (see prediction_func.get_nuis_fold). -nuis_mode ols or ridge swaps the rbf kernel ridge nuisance model
+jobs = []
+for alg in algs:
+    for metric in metrics:
+        for pheno in phenos:
+            subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -c {2}c.csv -alg {3} -metric {4} -pheno {5} -score {6} -nuis_y 1 -split_dir {7} -o {8}'.format(py_exec, py_script, indir, alg, metric, pheno, score_str, split_dir, modeldir)
 
-                name = 'null' + '_' + alg + '_' + metric[0] + '_' + pheno[0] + '_' + score[0]
-                qsub_call = 'qsub -N {0} -l h_vmem=1G,s_vmem=1G -pe threaded 4 -j y -b y -o /cbica/home/parkesl/sge/ -e /cbica/home/parkesl/sge/ '.format(name)
+            name = 'nully' + '_' + alg + '_' + metric[0] + '_' + pheno[0]
+            jobs.append(make_job(name, subprocess_str, n_cpus = 4, mem = '1G'))
 
-                os.system(qsub_call + subprocess_str)
+submit_jobs(jobs, backend = backend, log_dir = log_dir, max_cpus = max_cpus, script_file = modeldir+'_jobs.sh', pack = pack)
+
+
+# ### Shared permutations (all models per phenotype)
+
+# In[ ]:
+
+
+py_script = projdir+'/1_code/cluster/predict_symptoms_scv_nuis_table.py'
+modeldir = outdir+'predict_symptoms_scv_nuis_table'
+
+# one job per pheno evaluates every alg and metric against the same 5000 permutations and writes one null table
+# (permuted_acc_nuis_<pheno>.csv) plus the observed accuracies and p-values (accuracy_nuis_<pheno>.csv)
+n_jobs = 4
+metric_str = ','.join(metrics)
+alg_str = ','.join(algs)
+
+jobs = []
+for pheno in phenos:
+    subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -c {2}c.csv -alg {3} -metric {4} -pheno {5} -score {6} -n_jobs {7} -split_dir {8} -o {9}'.format(py_exec, py_script, indir, alg_str, metric_str, pheno, score_str, n_jobs, split_dir, modeldir)
+
+    name = 'nullt' + '_' + pheno[0]
+    jobs.append(make_job(name, subprocess_str, n_cpus = n_jobs, mem = '2G'))
+
+submit_jobs(jobs, backend = backend, log_dir = log_dir, max_cpus = max_cpus, script_file = modeldir+'_jobs.sh', pack = pack)
 
 
 # ## Random splits cross-val (no nuis, param optimization)
@@ -103,19 +171,44 @@ for alg in algs:
 # In[ ]:
 
 
-py_script = '/cbica/home/parkesl/research_projects/neurodev_cs_predictive/1_code/cluster/predict_symptoms_ncv.py'
+py_script = projdir+'/1_code/cluster/predict_symptoms_ncv.py'
 modeldir = outdir+'predict_symptoms_ncv'
 
+jobs = []
 for alg in algs:
     for metric in metrics:
         for pheno in phenos:
             for score in scores:
-                subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -alg {3} -metric {4} -pheno {5} -score {6} -o {7}'.format(py_exec, py_script, indir, alg, metric, pheno, score, modeldir)
+                subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -alg {3} -metric {4} -pheno {5} -score {6} -split_dir {7} -o {8}'.format(py_exec, py_script, indir, alg, metric, pheno, score, split_dir, modeldir)
 
                 name = 'ncv' + '_' + alg + '_' + metric[0] + '_' + pheno[0] + '_' + score[0]
-                qsub_call = 'qsub -N {0} -l h_vmem=1G,s_vmem=1G -t 1-100 -pe threaded 1 -j y -b y -o /cbica/home/parkesl/sge/ -e /cbica/home/parkesl/sge/ '.format(name)
+                jobs.append(make_job(name, subprocess_str, n_cpus = 1, mem = '1G', n_tasks = 100))
+
+submit_jobs(jobs, backend = backend, log_dir = log_dir, max_cpus = max_cpus, script_file = modeldir+'_jobs.sh', pack = pack)
+
+
+# ### In-process (all seeds per job)
+
+# In[ ]:
+
+
+py_script = projdir+'/1_code/cluster/predict_symptoms_ncv_pool.py'
+modeldir = outdir+'predict_symptoms_ncv_pool'
+
+# one job per alg runs every seed, metric, pheno and score in a process pool (see ncv_func.py) and writes a single
+# ncv_results.npz holding the arrays the assembly step below builds (nested_score_mean, best_alpha, run_time_seconds)
+n_jobs = 8
+metric_str = ','.join(metrics)
+pheno_str = ','.join(phenos)
+
+jobs = []
+for alg in algs:
+    subprocess_str = '{0} {1} -x {2}X.csv -y {2}y.csv -alg {3} -metric {4} -pheno {5} -score {6} -seeds 100 -n_jobs {7} -split_dir {8} -o {9}'.format(py_exec, py_script, indir, alg, metric_str, pheno_str, score_str, n_jobs, split_dir, modeldir)
+
+    name = 'ncvp' + '_' + alg
+    jobs.append(make_job(name, subprocess_str, n_cpus = n_jobs, mem = '2G'))
 
-                os.system(qsub_call + subprocess_str)
+submit_jobs(jobs, backend = backend, log_dir = log_dir, max_cpus = max_cpus, script_file = modeldir+'_jobs.sh', pack = pack)
 
 
 # ## Assemble outputs
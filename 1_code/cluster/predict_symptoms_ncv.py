@@ -15,55 +15,42 @@ from scipy import stats
 # Sklearn
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import KFold, GridSearchCV, cross_val_score
+from sklearn.model_selection import KFold
 from sklearn.linear_model import Ridge, Lasso
 from sklearn.kernel_ridge import KernelRidge
 from sklearn.svm import SVR, LinearSVR
 from sklearn.metrics import make_scorer, r2_score, mean_squared_error, mean_absolute_error
 
+# Project
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from prediction_func import _as_array, corr_true_pred, root_mean_squared_error
+from solver_func import KernelCache, RidgePathCV
+from ncv_func import run_ncv
+from split_func import get_split_plan, get_plan_cv, get_plan_inner_cv
+from pack_func import read_data
+
 # --------------------------------------------------------------------------------------------------------------------
 # parse input arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-x", help="IVs", dest="X_file", default=None)
-parser.add_argument("-y", help="DVs", dest="y_file", default=None)
-parser.add_argument("-metric", help="brain feature (e.g., ac)", dest="metric", default=None)
-parser.add_argument("-pheno", help="psychopathology dimension", dest="pheno", default=None)
-parser.add_argument("-seed", help="seed for shuffle_data", dest="seed", default=None)
-parser.add_argument("-alg", help="estimator", dest="alg", default=None)
-parser.add_argument("-score", help="score set order", dest="score", default=None)
-parser.add_argument("-o", help="output directory", dest="outroot", default=None)
-
-args = parser.parse_args()
-print(args)
-X_file = args.X_file
-y_file = args.y_file
-metric = args.metric
-pheno = args.pheno
-# seed = int(args.seed)
-seed = int(os.environ['SGE_TASK_ID'])-1
-alg = args.alg
-score = args.score
-outroot = args.outroot
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-x", help="IVs", dest="X_file", default=None)
+    parser.add_argument("-y", help="DVs", dest="y_file", default=None)
+    parser.add_argument("-metric", help="brain feature (e.g., ac)", dest="metric", default=None)
+    parser.add_argument("-pheno", help="psychopathology dimension", dest="pheno", default=None)
+    parser.add_argument("-seed", help="seed for shuffle_data", dest="seed", default=None)
+    parser.add_argument("-alg", help="estimator", dest="alg", default=None)
+    parser.add_argument("-score", help="score set order", dest="score", default=None)
+    parser.add_argument("-search", help="inner hyperparameter search: grid (exhaustive) or halving (successive halving)", dest="search", default='grid')
+    parser.add_argument("-kernel_cache", help="exact (per fold) or approx (one full-sample kernel sub-indexed by every outer and inner fold)", dest="kernel_cache", default='exact')
+    parser.add_argument("-n_jobs", help="threads for the outer folds", dest="n_jobs", default=1)
+    parser.add_argument("-split_dir", help="shared split plan directory (default: folds are made in memory and not stored)", dest="split_dir", default=None)
+    parser.add_argument("-o", help="output directory", dest="outroot", default=None)
+
+    return parser
 # --------------------------------------------------------------------------------------------------------------------
 
 # --------------------------------------------------------------------------------------------------------------------
 # prediction functions
-def corr_true_pred(y_true, y_pred):
-    if type(y_true) == np.ndarray:
-        y_true = y_true.flatten()
-    if type(y_pred) == np.ndarray:
-        y_pred = y_pred.flatten()
-        
-    r,p = sp.stats.pearsonr(y_true, y_pred)
-    return r
-
-
-def root_mean_squared_error(y_true, y_pred):
-    mse = np.mean((y_true - y_pred)**2, axis=0)
-    rmse = np.sqrt(mse)
-    return rmse
-
-
 def shuffle_data(X, y, seed = 0):
     np.random.seed(seed)
     idx = np.arange(y.shape[0])
@@ -80,7 +67,8 @@ def get_reg(num_params = 10):
             'krr_lin': KernelRidge(kernel='linear'),
             'krr_rbf': KernelRidge(kernel='rbf'),
             'svr_lin': SVR(kernel='linear'),
-            'svr_rbf': SVR(kernel='rbf')
+            'svr_rbf': SVR(kernel='rbf'),
+            'rr_gcv': RidgePathCV(alphas = np.logspace(0.5, -1, num_params))
             }
     
     # From the sklearn docs, gamma defaults to 1/n_features. In my cases that will be either 1/400 features = 0.0025 or 1/200 = 0.005.
@@ -90,107 +78,135 @@ def get_reg(num_params = 10):
                    'krr_lin': {'reg__alpha': np.logspace(0.5, -1, num_params)},
                    'krr_rbf': {'reg__alpha': np.logspace(0.5, -1, num_params)},
                     'svr_lin': {'reg__C': np.logspace(0, 4, num_params)},
-                    'svr_rbf': {'reg__C': np.logspace(0, 4, num_params), 'reg__gamma': np.logspace(0, -3, num_params)}
+                    'svr_rbf': {'reg__C': np.logspace(0, 4, num_params), 'reg__gamma': np.logspace(0, -3, num_params)},
+                    'rr_gcv': {} # alpha is picked inside each fit by efficient leave-one-out (see solver_func.RidgePathCV)
                     }
     
     return regs, param_grids
 
-def run_reg_ncv(X, y, reg, param_grid, n_splits = 10, scoring = 'r2'):
+def run_reg_ncv(X, y, reg, param_grid, n_splits = 10, scoring = 'r2', search = 'grid', kernel_cache = 'exact', n_jobs = 1, outer_cv = None, inner_cvs = None):
     
-    pipe = Pipeline(steps=[('standardize', StandardScaler()),
-                           ('reg', reg)])
-    
-    inner_cv = KFold(n_splits = n_splits, shuffle = False, random_state = None)
-    outer_cv = KFold(n_splits = n_splits, shuffle = False, random_state = None)
-    
-    # if scoring is a dictionary then we run GridSearchCV with multiple scoring metrics and refit using the first one in the dict
-    if type(scoring) == dict: grid = GridSearchCV(pipe, param_grid, cv = inner_cv, scoring = scoring, refit = list(scoring.keys())[0])
-    else: grid = GridSearchCV(pipe, param_grid, cv = inner_cv, scoring = scoring)
-    
-    grid.fit(X, y);
-    nested_score = cross_val_score(grid, X, y, cv = outer_cv)
-    
-    return grid, nested_score
+    # nested cv in one pass (see ncv_func.run_ncv). Same outputs as fitting GridSearchCV(pipe, param_grid, cv = inner_cv)
+    # on the full sample and cross_val_score(grid, X, y, cv = outer_cv) with KFold(n_splits) for both, refitting on the
+    # first score if scoring is a dictionary. outer_cv and inner_cvs replace those KFolds (see ncv_func.run_ncv)
+    if type(scoring) == dict: score = list(scoring.keys())[0]
+    else: score = scoring
+
+    X = _as_array(X); y = _as_array(y)
+    if kernel_cache == 'approx': cache = KernelCache(X, standardize = True)
+    else: cache = None
+
+    best_params, best_scores, nested_score, search_log = run_ncv(X, y, reg, param_grid, scores = [score,], n_splits = n_splits,
+                                                                    search = search, kernel_cache = cache, n_jobs = n_jobs, outer_cv = outer_cv, inner_cvs = inner_cvs)
 
-def reg_ncv_wrapper(X, y, alg = 'krr_rbf', seed = 0, scoring = 'r2'):
+    if type(scoring) == dict: best_scores = {key: best_scores[score][key] for key in scoring.keys()}
+    else: best_scores = best_scores[score][score]
+
+    return best_params[score], best_scores, nested_score[score], search_log
+
+def reg_ncv_wrapper(X, y, alg = 'krr_rbf', seed = 0, scoring = 'r2', search = 'grid', kernel_cache = 'exact', n_jobs = 1, split_dir = None):
         
     # get regression estimator
     regs, param_grids = get_reg()
     
-    # run nested cv w/ shuffle
-    X_shuf, y_shuf = shuffle_data(X = X, y = y, seed = seed)
-    grid, nested_score = run_reg_ncv(X = X_shuf, y = y_shuf, reg = regs[alg], param_grid = param_grids[alg], scoring = scoring)
-    
-    best_params = grid.best_params_
-
-    if type(scoring) == dict:
-        best_scores = dict()
-        for key in scoring.keys():
-            best_scores[key] = grid.cv_results_['mean_test_'+key][grid.best_index_]
+    # run nested cv w/ shuffle. with split_dir the shuffle and the outer and inner folds are read from the seed's stored
+    # nested split plan (see split_func.py), the same one predict_symptoms_ncv_pool.py uses
+    if split_dir is None:
+        X_shuf, y_shuf = shuffle_data(X = X, y = y, seed = seed)
+        outer_cv = None; inner_cvs = None
     else:
-        best_scores = grid.best_score_
+        plan = get_split_plan(split_dir, y.index, 'nested', seed = seed, n_splits = 10)
+        idx, outer_cv = get_plan_cv(plan)
+        inner_cvs = [get_plan_inner_cv(plan, k = k) for k in np.arange(len(outer_cv))]
+        X_shuf = X.iloc[idx,:]; y_shuf = y.iloc[idx]
+
+    best_params, best_scores, nested_score, search_log = run_reg_ncv(X = X_shuf, y = y_shuf, reg = regs[alg], param_grid = param_grids[alg], scoring = scoring,
+                                                                    search = search, kernel_cache = kernel_cache, n_jobs = n_jobs,
+                                                                    outer_cv = outer_cv, inner_cvs = inner_cvs)
     
-    return best_params, best_scores, nested_score
-# --------------------------------------------------------------------------------------------------------------------
-
-# --------------------------------------------------------------------------------------------------------------------
-# start timer
-start = datetime.now()
-
-# inputs
-X = pd.read_csv(X_file)
-X.set_index(['bblid', 'scanid'], inplace = True)
-X = X.filter(regex = metric)
-
-y = pd.read_csv(y_file)
-y.set_index(['bblid', 'scanid'], inplace = True)
-y = y.loc[:,pheno]
-
-# outdir
-outdir = os.path.join(outroot, 'split_' + str(seed), alg + '_' + score + '_' + metric + '_' + pheno)
-if not os.path.exists(outdir): os.makedirs(outdir);
+    return best_params, best_scores, nested_score, search_log
 # --------------------------------------------------------------------------------------------------------------------
 
 # --------------------------------------------------------------------------------------------------------------------
-# set scorer
-my_scorer_corr = make_scorer(corr_true_pred, greater_is_better = True)
-my_scorer_rmse = make_scorer(root_mean_squared_error, greater_is_better = False)
-
-if score == 'r2':
-    scoring = {'r2': 'r2', 'mse': 'neg_mean_squared_error', 'rmse': my_scorer_rmse, 'mae': 'neg_mean_absolute_error', 'corr': my_scorer_corr}
-elif score == 'corr':
-    scoring = {'corr': my_scorer_corr, 'r2': 'r2', 'mse': 'neg_mean_squared_error', 'rmse': my_scorer_rmse, 'mae': 'neg_mean_absolute_error'}
-elif score == 'mse':
-    scoring = {'mse': 'neg_mean_squared_error', 'r2': 'r2', 'rmse': my_scorer_rmse, 'mae': 'neg_mean_absolute_error', 'corr': my_scorer_corr}
-elif score == 'rmse':
-    scoring = {'rmse': my_scorer_rmse, 'r2': 'r2', 'mse': 'neg_mean_squared_error', 'mae': 'neg_mean_absolute_error', 'corr': my_scorer_corr}
-elif score == 'mae':
-    scoring = {'mae': 'neg_mean_absolute_error', 'r2': 'r2', 'mse': 'neg_mean_squared_error', 'rmse': my_scorer_rmse, 'corr': my_scorer_corr}
-
-# prediction
-best_params, best_scores, nested_score = reg_ncv_wrapper(X = X, y = y, alg = alg, seed = seed, scoring = scoring)
-
-# stop timer
-stop = datetime.now()
+# entry point, see pack_func.run_task
+def main(args):
+    print(args)
+    X_file = args.X_file
+    y_file = args.y_file
+    metric = args.metric
+    pheno = args.pheno
+    # seed = int(args.seed)
+    seed = int(os.environ['SGE_TASK_ID'])-1
+    alg = args.alg
+    score = args.score
+    search = args.search
+    kernel_cache = args.kernel_cache
+    n_jobs = int(args.n_jobs)
+    split_dir = args.split_dir
+    outroot = args.outroot
+
+    # start timer
+    start = datetime.now()
+
+    # inputs
+    X = read_data(X_file)
+    X = X.filter(regex = metric)
+
+    y = read_data(y_file)
+    y = y.loc[:,pheno]
+
+    # outdir
+    outdir = os.path.join(outroot, 'split_' + str(seed), alg + '_' + score + '_' + metric + '_' + pheno)
+    if not os.path.exists(outdir): os.makedirs(outdir);
+
+    # set scorer
+    my_scorer_corr = make_scorer(corr_true_pred, greater_is_better = True)
+    my_scorer_rmse = make_scorer(root_mean_squared_error, greater_is_better = False)
+
+    if score == 'r2':
+        scoring = {'r2': 'r2', 'mse': 'neg_mean_squared_error', 'rmse': my_scorer_rmse, 'mae': 'neg_mean_absolute_error', 'corr': my_scorer_corr}
+    elif score == 'corr':
+        scoring = {'corr': my_scorer_corr, 'r2': 'r2', 'mse': 'neg_mean_squared_error', 'rmse': my_scorer_rmse, 'mae': 'neg_mean_absolute_error'}
+    elif score == 'mse':
+        scoring = {'mse': 'neg_mean_squared_error', 'r2': 'r2', 'rmse': my_scorer_rmse, 'mae': 'neg_mean_absolute_error', 'corr': my_scorer_corr}
+    elif score == 'rmse':
+        scoring = {'rmse': my_scorer_rmse, 'r2': 'r2', 'mse': 'neg_mean_squared_error', 'mae': 'neg_mean_absolute_error', 'corr': my_scorer_corr}
+    elif score == 'mae':
+        scoring = {'mae': 'neg_mean_absolute_error', 'r2': 'r2', 'mse': 'neg_mean_squared_error', 'rmse': my_scorer_rmse, 'corr': my_scorer_corr}
+
+    # prediction
+    best_params, best_scores, nested_score, search_log = reg_ncv_wrapper(X = X, y = y, alg = alg, seed = seed, scoring = scoring, search = search,
+                                                                        kernel_cache = kernel_cache, n_jobs = n_jobs, split_dir = split_dir)
+
+    # stop timer
+    stop = datetime.now()
+
+    # outputs
+    json_data = json.dumps(best_params)
+    f = open(os.path.join(outdir,'best_params.json'),'w')
+    f.write(json_data)
+    f.close()
+
+    json_data = json.dumps(best_scores)
+    f = open(os.path.join(outdir,'best_scores.json'),'w')
+    f.write(json_data)
+    f.close()
+
+    if search_log is not None:
+        json_data = json.dumps(search_log)
+        f = open(os.path.join(outdir,'search_log.json'),'w')
+        f.write(json_data)
+        f.close()
+
+    np.savetxt(os.path.join(outdir,'nested_score.csv'), nested_score, delimiter=',')
+
+    # runtime
+    run_time = stop - start
+    np.savetxt(os.path.join(outdir,'run_time_seconds.txt'), np.array([run_time.seconds]))
+
+    print('Finished!')
 # --------------------------------------------------------------------------------------------------------------------
 
-# --------------------------------------------------------------------------------------------------------------------
-# outputs
-json_data = json.dumps(best_params)
-f = open(os.path.join(outdir,'best_params.json'),'w')
-f.write(json_data)
-f.close()
-
-json_data = json.dumps(best_scores)
-f = open(os.path.join(outdir,'best_scores.json'),'w')
-f.write(json_data)
-f.close()
-
-np.savetxt(os.path.join(outdir,'nested_score.csv'), nested_score, delimiter=',')
-
-# runtime
-run_time = stop - start
-np.savetxt(os.path.join(outdir,'run_time_seconds.txt'), np.array([run_time.seconds]))
-# --------------------------------------------------------------------------------------------------------------------
 
-print('Finished!')
+if __name__ == '__main__':
+    main(get_parser().parse_args())
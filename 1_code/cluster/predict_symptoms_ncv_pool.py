@@ -0,0 +1,138 @@
+import argparse
+
+# Essentials
+import os, sys, glob
+import pandas as pd
+import numpy as np
+import json
+from datetime import datetime
+
+# Sklearn
+from sklearn.linear_model import Ridge, Lasso
+from sklearn.kernel_ridge import KernelRidge
+from sklearn.svm import SVR
+
+# Project
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from solver_func import RidgePathCV
+from ncv_func import score_keys, run_ncv_pool
+
+# --------------------------------------------------------------------------------------------------------------------
+# parse input arguments
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-x", help="IVs", dest="X_file", default=None)
+    parser.add_argument("-y", help="DVs", dest="y_file", default=None)
+    parser.add_argument("-metric", help="brain feature(s), comma separated (e.g., str,ac)", dest="metric", default=None)
+    parser.add_argument("-pheno", help="psychopathology dimension(s), comma separated", dest="pheno", default=None)
+    parser.add_argument("-alg", help="estimator(s), comma separated", dest="alg", default=None)
+    parser.add_argument("-score", help="score(s), comma separated", dest="score", default=None)
+    parser.add_argument("-seeds", help="number of seeds for shuffle_data (seeds 0 to seeds-1)", dest="seeds", default=100)
+    parser.add_argument("-n_jobs", help="worker processes", dest="n_jobs", default=1)
+    parser.add_argument("-search", help="inner hyperparameter search: grid or halving", dest="search", default='grid')
+    parser.add_argument("-kernel_cache", help="exact (per fold) or approx (one full-sample kernel shared by every seed)", dest="kernel_cache", default='exact')
+    parser.add_argument("-split_dir", help="shared split plan directory (default: folds are made in memory and not stored)", dest="split_dir", default=None)
+    parser.add_argument("-o", help="output directory", dest="outroot", default=None)
+
+    return parser
+# --------------------------------------------------------------------------------------------------------------------
+
+# --------------------------------------------------------------------------------------------------------------------
+# prediction functions
+def get_reg(num_params = 10):
+    regs = {'rr': Ridge(),
+            'lr': Lasso(),
+            'krr_lin': KernelRidge(kernel='linear'),
+            'krr_rbf': KernelRidge(kernel='rbf'),
+            'svr_lin': SVR(kernel='linear'),
+            'svr_rbf': SVR(kernel='rbf'),
+            'rr_gcv': RidgePathCV(alphas = np.logspace(0.5, -1, num_params))
+            }
+    
+    # From the sklearn docs, gamma defaults to 1/n_features. In my cases that will be either 1/400 features = 0.0025 or 1/200 = 0.005.
+    # I'll set gamma to same range as alpha then [0.001 to 1] - this way, the defaults will be included in the gridsearch
+    param_grids = {'rr': {'reg__alpha': np.logspace(0.5, -1, num_params)},
+                    'lr': {'reg__alpha': np.logspace(0.5, -1, num_params)},
+                   'krr_lin': {'reg__alpha': np.logspace(0.5, -1, num_params)},
+                   'krr_rbf': {'reg__alpha': np.logspace(0.5, -1, num_params)},
+                    'svr_lin': {'reg__C': np.logspace(0, 4, num_params)},
+                    'svr_rbf': {'reg__C': np.logspace(0, 4, num_params), 'reg__gamma': np.logspace(0, -3, num_params)},
+                    'rr_gcv': {} # alpha is picked inside each fit by efficient leave-one-out (see solver_func.RidgePathCV)
+                    }
+    
+    return regs, param_grids
+# --------------------------------------------------------------------------------------------------------------------
+
+# --------------------------------------------------------------------------------------------------------------------
+# entry point, see pack_func.run_task
+def main(args):
+    print(args)
+    X_file = args.X_file
+    y_file = args.y_file
+    metrics = args.metric.split(',')
+    phenos = args.pheno.split(',')
+    algs = args.alg.split(',')
+    scores = args.score.split(',')
+    seeds = np.arange(int(args.seeds))
+    n_jobs = int(args.n_jobs)
+    search = args.search
+    kernel_cache = args.kernel_cache
+    split_dir = args.split_dir
+    outroot = args.outroot
+
+    # start timer
+    start = datetime.now()
+
+    # tasks: one per alg, metric, pheno and seed; every score is computed within a task. seeds of the same metric are
+    # adjacent so workers reuse their kernel cache. with -split_dir every seed's shuffle and folds come from its stored
+    # nested split plan (see split_func.py), shared by every alg, metric and pheno
+    regs, param_grids = get_reg()
+
+    tasks = []
+    for alg in algs:
+        for metric in metrics:
+            for pheno in phenos:
+                for seed in seeds:
+                    tasks.append({'alg': alg, 'reg': regs[alg], 'param_grid': param_grids[alg], 'metric': metric, 'pheno': pheno,
+                                'seed': int(seed), 'scores': scores, 'n_splits': 10, 'search': search, 'kernel_cache': kernel_cache,
+                                'split_dir': split_dir})
+
+    results = run_ncv_pool(X_file, y_file, tasks, n_jobs = n_jobs)
+
+    # stop timer
+    stop = datetime.now()
+
+    # outputs: everything predict_symptoms_ncv.py writes per split/alg/score/metric/pheno directory, consolidated into one
+    # file with arrays indexed (seed, alg, score, metric, pheno) as in the job submitter's assembly step
+    if not os.path.exists(outroot): os.makedirs(outroot);
+
+    shape = (len(seeds), len(algs), len(scores), len(metrics), len(phenos))
+    nested_score = np.zeros(shape + (10,))
+    best_scores = np.zeros(shape + (len(score_keys),))
+    best_alpha = np.full(shape, np.nan)
+    best_params = np.empty(shape, dtype = object)
+    run_time_seconds = np.zeros(shape)
+
+    for r in results:
+        a = algs.index(r['alg']); m = metrics.index(r['metric']); p = phenos.index(r['pheno']); se = r['seed']
+        for s, score in enumerate(scores):
+            nested_score[se,a,s,m,p,:] = r['nested_score'][score]
+            best_scores[se,a,s,m,p,:] = [r['best_scores'][score][key] for key in score_keys]
+            best_params[se,a,s,m,p] = json.dumps(r['best_params'][score])
+            if 'reg__alpha' in r['best_params'][score]: best_alpha[se,a,s,m,p] = r['best_params'][score]['reg__alpha']
+            run_time_seconds[se,a,s,m,p] = r['run_time_seconds']
+
+    np.savez(os.path.join(outroot, 'ncv_results.npz'), nested_score = nested_score, nested_score_mean = nested_score.mean(axis = -1),
+                best_scores = best_scores, best_alpha = best_alpha, best_params = best_params.astype(str), run_time_seconds = run_time_seconds,
+                seeds = seeds, algs = algs, scores = scores, metrics = metrics, phenos = phenos, score_keys = score_keys)
+
+    # runtime
+    run_time = stop - start
+    print('Run time (seconds): ' + str(run_time.seconds))
+
+    print('Finished!')
+# --------------------------------------------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -1,7 +1,7 @@
 import argparse
 
 # Essentials
-import os, sys, glob
+import os, sys, glob, shutil
 import pandas as pd
 import numpy as np
 import copy
@@ -20,58 +20,49 @@ from sklearn.kernel_ridge import KernelRidge
 from sklearn.svm import SVR, LinearSVR
 from sklearn.metrics import make_scorer, r2_score, mean_squared_error, mean_absolute_error
 
+# Project
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from prediction_func import get_scorer, get_stratified_cv, get_fold_stats, get_X_folds, cross_val_score_nuis
+from solver_func import KernelCache, RidgePathCV, is_linear_smoother, has_kernel, get_kernel_folds, get_precomputed_reg
+from search_func import grid_search_folds, halving_search_folds
+from split_func import get_split_plan
+from perm_func import permute_linear_batch, permute_loop, permute_chunked, permute_sequential, get_perm_stats
+from pack_func import read_data
+
 # --------------------------------------------------------------------------------------------------------------------
 # parse input arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-x", help="IVs", dest="X_file", default=None)
-parser.add_argument("-y", help="DVs", dest="y_file", default=None)
-parser.add_argument("-c", help="DVs", dest="c_file", default=None)
-parser.add_argument("-metric", help="brain feature (e.g., ac)", dest="metric", default=None)
-parser.add_argument("-pheno", help="psychopathology dimension", dest="pheno", default=None)
-parser.add_argument("-seed", help="seed for shuffle_data", dest="seed", default=1)
-parser.add_argument("-alg", help="estimator", dest="alg", default=None)
-parser.add_argument("-score", help="score set order", dest="score", default=None)
-parser.add_argument("-o", help="output directory", dest="outroot", default=None)
-
-args = parser.parse_args()
-print(args)
-X_file = args.X_file
-y_file = args.y_file
-c_file = args.c_file
-metric = args.metric
-pheno = args.pheno
-# seed = int(args.seed)
-# seed = int(os.environ['SGE_TASK_ID'])-1
-alg = args.alg
-score = args.score
-outroot = args.outroot
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-x", help="IVs", dest="X_file", default=None)
+    parser.add_argument("-y", help="DVs", dest="y_file", default=None)
+    parser.add_argument("-c", help="DVs", dest="c_file", default=None)
+    parser.add_argument("-metric", help="brain feature (e.g., ac)", dest="metric", default=None)
+    parser.add_argument("-pheno", help="psychopathology dimension", dest="pheno", default=None)
+    parser.add_argument("-seed", help="seed for shuffle_data", dest="seed", default=1)
+    parser.add_argument("-alg", help="estimator", dest="alg", default=None)
+    parser.add_argument("-score", help="score(s), comma separated", dest="score", default=None)
+    parser.add_argument("-perm_mode", help="permutation mode: batch (closed form where possible) or loop", dest="perm_mode", default='batch')
+    parser.add_argument("-kernel_cache", help="kernel reuse in the grid search: exact (per fold), approx (one full-sample kernel) or none", dest="kernel_cache", default='exact')
+    parser.add_argument("-search", help="hyperparameter search: grid (exhaustive) or halving (successive halving over folds and subsamples)", dest="search", default='grid')
+    parser.add_argument("-perm_seed", help="root SeedSequence seed for the permutations (default: legacy np.random.seed(i))", dest="perm_seed", default=None)
+    parser.add_argument("-perm_h", help="sequential permutations: stop a score after h permuted scores reach the observed one (default: run all 5000)", dest="perm_h", default=None)
+    parser.add_argument("-n_jobs", help="workers for the permutations (match -pe threaded)", dest="n_jobs", default=1)
+    parser.add_argument("-split_dir", help="shared split plan directory (default: folds are made in memory and not stored)", dest="split_dir", default=None)
+    parser.add_argument("-o", help="output directory", dest="outroot", default=None)
+
+    return parser
 # --------------------------------------------------------------------------------------------------------------------
 
 # --------------------------------------------------------------------------------------------------------------------
 # prediction functions
-def corr_true_pred(y_true, y_pred):
-    if type(y_true) == np.ndarray:
-        y_true = y_true.flatten()
-    if type(y_pred) == np.ndarray:
-        y_pred = y_pred.flatten()
-        
-    r,p = sp.stats.pearsonr(y_true, y_pred)
-    return r
-
-
-def root_mean_squared_error(y_true, y_pred):
-    mse = np.mean((y_true - y_pred)**2, axis=0)
-    rmse = np.sqrt(mse)
-    return rmse
-
-
 def get_reg(num_params = 10):
     regs = {'rr': Ridge(),
             'lr': Lasso(),
             'krr_lin': KernelRidge(kernel='linear'),
             'krr_rbf': KernelRidge(kernel='rbf'),
             'svr_lin': SVR(kernel='linear'),
-            'svr_rbf': SVR(kernel='rbf')
+            'svr_rbf': SVR(kernel='rbf'),
+            'rr_gcv': RidgePathCV(alphas = np.logspace(0.5, -1, num_params))
             }
     
     # From the sklearn docs, gamma defaults to 1/n_features. In my cases that will be either 1/400 features = 0.0025 or 1/200 = 0.005.
@@ -81,203 +72,208 @@ def get_reg(num_params = 10):
                    'krr_lin': {'reg__alpha': np.logspace(0.5, -1, num_params)},
                    'krr_rbf': {'reg__alpha': np.logspace(0.5, -1, num_params)},
                     'svr_lin': {'reg__C': np.logspace(0, 4, num_params)},
-                    'svr_rbf': {'reg__C': np.logspace(0, 4, num_params), 'reg__gamma': np.logspace(0, -3, num_params)}
+                    'svr_rbf': {'reg__C': np.logspace(0, 4, num_params), 'reg__gamma': np.logspace(0, -3, num_params)},
+                    'rr_gcv': {} # alpha is picked inside each fit by efficient leave-one-out (see solver_func.RidgePathCV)
                     }
     
     return regs, param_grids
 
 
-def get_stratified_cv(X, y, c = None, n_splits = 10):
-
-    # sort data on outcome variable in ascending order
-    idx = y.sort_values(ascending = True).index
-    if X.ndim == 2: X_sort = X.loc[idx,:]
-    elif X.ndim == 1: X_sort = X.loc[idx]
-    y_sort = y.loc[idx]
-    if c is not None:
-        if c.ndim == 2: c_sort = c.loc[idx,:]
-        elif c.ndim == 1: c_sort = c.loc[idx]
-    
-    # create custom stratified kfold on outcome variable
-    my_cv = []
-    for k in range(n_splits):
-        my_bool = np.zeros(y.shape[0]).astype(bool)
-        my_bool[np.arange(k,y.shape[0],n_splits)] = True
-
-        train_idx = np.where(my_bool == False)[0]
-        test_idx = np.where(my_bool == True)[0]
-        my_cv.append( (train_idx, test_idx) )
-
-    if c is not None:
-        return X_sort, y_sort, my_cv, c_sort
-    else:
-        return X_sort, y_sort, my_cv
-
-
-def cross_val_score_nuis(X, y, c, my_cv, reg, my_scorer, c_y = None):
-    
-    accuracy = np.zeros(len(my_cv),)
-
-    for k in np.arange(len(my_cv)):
-        tr = my_cv[k][0]
-        te = my_cv[k][1]
-
-        # Split into train test
-        X_train = X.iloc[tr,:]; X_test = X.iloc[te,:]
-        y_train = y.iloc[tr]; y_test = y.iloc[te]
-        c_train = c.iloc[tr,:]; c_test = c.iloc[te,:]
-        if c_y is not None: c_y_train = c_y.iloc[tr,:]; c_y_test = c_y.iloc[te,:]
-
-        # standardize predictors
-        sc = StandardScaler(); sc.fit(X_train); X_train = sc.transform(X_train); X_test = sc.transform(X_test)
-        X_train = pd.DataFrame(data = X_train, index = X.iloc[tr,:].index, columns = X.iloc[tr,:].columns)
-        X_test = pd.DataFrame(data = X_test, index = X.iloc[te,:].index, columns = X.iloc[te,:].columns)
-
-        # standardize covariates
-        sc = StandardScaler(); sc.fit(c_train); c_train = sc.transform(c_train); c_test = sc.transform(c_test)
-        c_train = pd.DataFrame(data = c_train, index = c.iloc[tr,:].index, columns = c.iloc[tr,:].columns)
-        c_test = pd.DataFrame(data = c_test, index = c.iloc[te,:].index, columns = c.iloc[te,:].columns)
-
-        if c_y is not None:
-            sc = StandardScaler(); sc.fit(c_y_train); c_y_train = sc.transform(c_y_train); c_y_test = sc.transform(c_y_test)
-            c_y_train = pd.DataFrame(data = c_y_train, index = c.iloc[tr,:].index, columns = c.iloc[tr,:].columns)
-            c_y_test = pd.DataFrame(data = c_y_test, index = c.iloc[te,:].index, columns = c.iloc[te,:].columns)
-
-        # regress nuisance (X)
-        # nuis_reg = LinearRegression(); nuis_reg.fit(c_train, X_train)
-        nuis_reg = KernelRidge(kernel='rbf'); nuis_reg.fit(c_train, X_train)
-        X_pred = nuis_reg.predict(c_train); X_train = X_train - X_pred
-        X_pred = nuis_reg.predict(c_test); X_test = X_test - X_pred
-
-        # # regress nuisance (y)
-        # if c_y is None:  
-        #     # nuis_reg = LinearRegression(); nuis_reg.fit(c_train, y_train)
-        #     nuis_reg = KernelRidge(kernel='rbf'); nuis_reg.fit(c_train, y_train)
-        #     y_pred = nuis_reg.predict(c_train); y_train = y_train - y_pred
-        #     y_pred = nuis_reg.predict(c_test); y_test = y_test - y_pred
-        # elif c_y is not None:
-        #     # nuis_reg = LinearRegression(); nuis_reg.fit(c_y_train, y_train)
-        #     nuis_reg = KernelRidge(kernel='rbf'); nuis_reg.fit(c_y_train, y_train)
-        #     y_pred = nuis_reg.predict(c_y_train); y_train = y_train - y_pred
-        #     y_pred = nuis_reg.predict(c_y_test); y_test = y_test - y_pred
-
-        reg.fit(X_train, y_train)
-        accuracy[k] = my_scorer(reg, X_test, y_test)
-        
-    return accuracy
-
-
-
-def run_reg_scv(X, y, c, reg, param_grid, n_splits = 10, scoring = 'r2', run_perm = False):
+def run_reg_scv(X, y, c, reg, param_grid, n_splits = 10, scores = ['corr',], run_perm = False, perm_mode = 'batch', kernel_cache = 'exact', search = 'grid',
+                perm_seed = None, perm_h = None, n_jobs = 1, checkpoint_dir = None, plan = None):
     
     pipe = Pipeline(steps=[('standardize', StandardScaler()),
                            ('reg', reg)])
     
     # X_sort, y_sort, my_cv = get_stratified_cv(X, y, n_splits = n_splits)
-    X_sort, y_sort, my_cv, c_sort = get_stratified_cv(X = X, y = y, c = c, n_splits = n_splits)
-
-    # if scoring is a dictionary then we run GridSearchCV with multiple scoring metrics and refit using the first one in the dict
-    grid = GridSearchCV(pipe, param_grid, cv = my_cv, scoring = scoring)
-    grid.fit(X_sort, y_sort);
+    X_sort, y_sort, my_cv, c_sort = get_stratified_cv(X = X, y = y, c = c, n_splits = n_splits, plan = plan)
+
+    # standardization (and nuisance regression) don't depend on y or the hyperparameters, so do them once per fold
+    # for the grid search and all permutations. every fold's scaler (and, for Ridge, standardized Gram for the
+    # alpha path) comes from one pass over X (see get_fold_stats)
+    fold_stats = get_fold_stats(X_sort, my_cv, gram = type(reg) == Ridge)
+    X_folds = get_X_folds(X = X_sort, c = c_sort, my_cv = my_cv, nuis = False, fold_stats = fold_stats)
+
+    # one grid search scores every candidate on all scores from a single prediction per fold. each score then
+    # selects its own best candidate, exactly as a separate GridSearchCV(scoring = score) would.
+    # kernel_cache = 'exact': kernels are computed once per fold from X_folds and reused for every candidate
+    # kernel_cache = 'approx': one kernel on the full-sample standardized X, sub-indexed for every fold
+    # kernel_cache = 'none': plain GridSearchCV
+    # search = 'halving' replaces the exhaustive search with successive halving (see search_func.halving_search_folds);
+    # candidates are then selected on the first score and the other scores pick among the fully evaluated survivors
+    if search == 'halving':
+        if kernel_cache == 'approx': grid = halving_search_folds(X_folds, y_sort, my_cv, reg, param_grid, scores = scores, kernel_cache = KernelCache(X_sort, standardize = True))
+        else: grid = halving_search_folds(X_folds, y_sort, my_cv, reg, param_grid, scores = scores)
+    elif kernel_cache == 'exact':
+        grid = grid_search_folds(X_folds, y_sort, my_cv, reg, param_grid, scores = scores, fold_stats = fold_stats)
+    elif kernel_cache == 'approx':
+        grid = grid_search_folds(X_folds, y_sort, my_cv, reg, param_grid, scores = scores, kernel_cache = KernelCache(X_sort, standardize = True))
+    else:
+        scoring = {s: get_scorer(s) for s in scores}
+        grid = GridSearchCV(pipe, param_grid, cv = my_cv, scoring = scoring, refit = False)
+        grid.fit(X_sort, y_sort);
 
-    # rescore with nuisance regression
-    new_reg = copy.deepcopy(reg)
-    if 'reg__alpha' in grid.best_params_: new_reg.alpha = grid.best_params_['reg__alpha']
-    if 'reg__gamma' in grid.best_params_: new_reg.gamma = grid.best_params_['reg__gamma']
-    if 'reg__C' in grid.best_params_: new_reg.C = grid.best_params_['reg__C']
+    best_index = {s: np.argmin(grid.cv_results_['rank_test_' + s]) for s in scores}
 
-    accuracy_nuis = cross_val_score_nuis(X = X_sort, y = y_sort, c = c_sort, my_cv = my_cv, reg = new_reg, my_scorer = scoring)
+    X_sort.reset_index(drop = True, inplace = True)
+    c_sort.reset_index(drop = True, inplace = True)
 
     if run_perm:
-        null_reg = copy.deepcopy(reg)
-        if 'reg__alpha' in grid.best_params_: null_reg.alpha = grid.best_params_['reg__alpha']
-        if 'reg__gamma' in grid.best_params_: null_reg.gamma = grid.best_params_['reg__gamma']
-        if 'reg__C' in grid.best_params_: null_reg.C = grid.best_params_['reg__C']
-
-        pipe = Pipeline(steps=[('standardize', StandardScaler()),
-                               ('reg', null_reg)])
-        
-        X_sort.reset_index(drop = True, inplace = True)
-        c_sort.reset_index(drop = True, inplace = True)
-
         n_perm = 5000
-        permuted_acc = np.zeros((n_perm,))
-        permuted_acc_nuis = np.zeros((n_perm,))
-
-        for i in np.arange(n_perm):
-            np.random.seed(i)
-            idx = np.arange(y_sort.shape[0])
-            np.random.shuffle(idx)
-
-            y_perm = y_sort.iloc[idx]
-            y_perm.reset_index(drop = True, inplace = True)
-            c_y = c_sort.iloc[idx,:]
-            c_y.reset_index(drop = True, inplace = True)
-            
-            permuted_acc[i] = cross_val_score(pipe, X_sort, y_perm, scoring = my_scorer, cv = my_cv).mean()
-            permuted_acc_nuis[i] = cross_val_score_nuis(X = X_sort, y = y_perm, c = c_sort, my_cv = my_cv, reg = null_reg, my_scorer = scoring, c_y = c_y).mean()
-
-    if run_perm:
-        return grid, accuracy_nuis, permuted_acc, permuted_acc_nuis
-    else:
-        return grid, accuracy_nuis
-
-
-# --------------------------------------------------------------------------------------------------------------------
 
-# --------------------------------------------------------------------------------------------------------------------
-# inputs
-X = pd.read_csv(X_file)
-X.set_index(['bblid', 'scanid'], inplace = True)
-X = X.filter(regex = metric)
-
-y = pd.read_csv(y_file)
-y.set_index(['bblid', 'scanid'], inplace = True)
-y = y.loc[:,pheno]
+        X_folds_nuis = get_X_folds(X = X_sort, c = c_sort, my_cv = my_cv, nuis = True, fold_stats = fold_stats)
+
+    results = dict()
+
+    # scores that agree on the best candidate share the nuisance rescoring and the permutations
+    for idx in np.unique(list(best_index.values())):
+        idx_scores = [s for s in scores if best_index[s] == idx]
+        best_params = grid.cv_results_['params'][idx]
+
+        # rescore with nuisance regression
+        new_reg = copy.deepcopy(reg)
+        if 'reg__alpha' in best_params: new_reg.alpha = best_params['reg__alpha']
+        if 'reg__gamma' in best_params: new_reg.gamma = best_params['reg__gamma']
+        if 'reg__C' in best_params: new_reg.C = best_params['reg__C']
+
+        accuracy_nuis, _ = cross_val_score_nuis(X = X_sort, y = y_sort, c = c_sort, my_cv = my_cv, reg = new_reg, my_scorer = idx_scores)
+
+        for s in idx_scores:
+            results[s] = {'best_params': best_params,
+                        'accuracy_mean': grid.cv_results_['mean_test_' + s][idx],
+                        'accuracy_std': grid.cv_results_['std_test_' + s][idx],
+                        'accuracy_nuis': accuracy_nuis[s]}
+            if hasattr(grid, 'search_log_'): results[s]['search_log'] = grid.search_log_
+
+        if run_perm:
+            null_reg = copy.deepcopy(new_reg)
+
+            perm_folds = X_folds; perm_folds_nuis = X_folds_nuis
+            if perm_mode == 'batch' and is_linear_smoother(null_reg):
+                # predictions are linear in y at fixed hyperparameters: one smoother per fold, all permutations at once
+                permute_fn = permute_linear_batch
+            else:
+                # kernel estimators get their train/test kernels once per fold rather than once per permutation
+                permute_fn = permute_loop
+                if has_kernel(null_reg):
+                    perm_folds = get_kernel_folds(X_folds, null_reg)
+                    perm_folds_nuis = get_kernel_folds(X_folds_nuis, null_reg)
+                    null_reg = get_precomputed_reg(null_reg)
+
+            # permutations run in checkpointed chunks across n_jobs processes. both nulls use the same permutations.
+            # with perm_h, a score stops sampling once perm_h permutations have reached its observed accuracy
+            # (see perm_func.permute_sequential). the candidate index doesn't identify the hyperparameters across
+            # searches, so saved chunks are only reused by a rerun that picked the same ones with the same search
+            # (see perm_func.get_chunk_fingerprint)
+            idx_dir = None if checkpoint_dir is None else os.path.join(checkpoint_dir, str(idx))
+            checkpoint_key = {'best_params': best_params, 'search': search, 'kernel_cache': kernel_cache, 'perm_mode': perm_mode}
+            for key, folds, acc_obs in [('permuted_acc', perm_folds, {s: results[s]['accuracy_mean'] for s in idx_scores}),
+                                        ('permuted_acc_nuis', perm_folds_nuis, {s: accuracy_nuis[s].mean() for s in idx_scores})]:
+                key_dir = None if idx_dir is None else os.path.join(idx_dir, key)
+                if perm_h is None:
+                    permuted_acc = permute_chunked(permute_fn, y = y_sort, my_cv = my_cv, reg = null_reg, X_folds = folds, n_perm = n_perm, score = idx_scores,
+                                                   seed = perm_seed, n_jobs = n_jobs, checkpoint_dir = key_dir,
+                                                   checkpoint_key = checkpoint_key)
+                    perm_stats = {s: get_perm_stats(permuted_acc[s], acc_obs[s], n_perm = n_perm) for s in idx_scores}
+                else:
+                    permuted_acc, perm_stats = permute_sequential(permute_fn, y = y_sort, my_cv = my_cv, reg = null_reg, X_folds = folds, accuracy = acc_obs,
+                                                                  n_perm = n_perm, h = perm_h, score = idx_scores, seed = perm_seed, n_jobs = n_jobs, checkpoint_dir = key_dir,
+                                                                  checkpoint_key = checkpoint_key)
+
+                for s in idx_scores:
+                    results[s][key] = permuted_acc[s]
+                    results[s][key.replace('permuted_acc', 'perm_stats')] = perm_stats[s]
+
+    return results
 
-c = pd.read_csv(c_file)
-c.set_index(['bblid', 'scanid'], inplace = True)
 
-# outdir
-outdir = os.path.join(outroot, alg + '_' + score + '_' + metric + '_' + pheno)
-if not os.path.exists(outdir): os.makedirs(outdir);
 # --------------------------------------------------------------------------------------------------------------------
 
 # --------------------------------------------------------------------------------------------------------------------
-# set scorer
-if score == 'r2':
-    my_scorer = make_scorer(r2_score, greater_is_better = True)
-elif score == 'corr':
-    my_scorer = make_scorer(corr_true_pred, greater_is_better = True)
-elif score == 'mse':
-    my_scorer = make_scorer(mean_squared_error, greater_is_better = False)
-elif score == 'rmse':
-    my_scorer = make_scorer(root_mean_squared_error, greater_is_better = False)
-elif score == 'mae':
-    my_scorer = make_scorer(mean_absolute_error, greater_is_better = False)
-
-# prediction
-regs, param_grids = get_reg()
-
-grid, accuracy_nuis, permuted_acc, permuted_acc_nuis = run_reg_scv(X = X, y = y, c = c, reg = regs[alg], param_grid = param_grids[alg], scoring = my_scorer, run_perm = True)
-# --------------------------------------------------------------------------------------------------------------------
-
+# entry point, see pack_func.run_task
+def main(args):
+    print(args)
+    X_file = args.X_file
+    y_file = args.y_file
+    c_file = args.c_file
+    metric = args.metric
+    pheno = args.pheno
+    # seed = int(args.seed)
+    # seed = int(os.environ['SGE_TASK_ID'])-1
+    alg = args.alg
+    score = args.score
+    perm_mode = args.perm_mode
+    kernel_cache = args.kernel_cache
+    search = args.search
+    perm_seed = args.perm_seed
+    if perm_seed is not None: perm_seed = int(perm_seed)
+    perm_h = args.perm_h
+    if perm_h is not None: perm_h = int(perm_h)
+    n_jobs = int(args.n_jobs)
+    split_dir = args.split_dir
+    outroot = args.outroot
+
+    # inputs
+    X = read_data(X_file)
+    X = X.filter(regex = metric)
+
+    y = read_data(y_file)
+    y = y.loc[:,pheno]
+
+    c = read_data(c_file)
+
+    # set scorers. -score takes a comma separated list (e.g., corr,rmse); every score is computed from the same fits
+    scores = score.split(',')
+
+    # prediction
+    regs, param_grids = get_reg()
+
+    # finished permutation chunks are kept here until the outputs are written, so a killed job resumes where it stopped
+    checkpoint_dir = os.path.join(outroot, 'perm_chunks', alg + '_' + metric + '_' + pheno)
+
+    # the stratified folds, read from (or, for the first job, written to) the shared split plan directory (see split_func.py)
+    plan = get_split_plan(split_dir, y.index, 'stratified', n_splits = 10, y = y)
+
+    results = run_reg_scv(X = X, y = y, c = c, reg = regs[alg], param_grid = param_grids[alg], scores = scores, run_perm = True, perm_mode = perm_mode, kernel_cache = kernel_cache, search = search,
+                          perm_seed = perm_seed, perm_h = perm_h, n_jobs = n_jobs, checkpoint_dir = checkpoint_dir, plan = plan)
+
+    # outputs
+    for s in scores:
+        outdir = os.path.join(outroot, alg + '_' + s + '_' + metric + '_' + pheno)
+        if not os.path.exists(outdir): os.makedirs(outdir);
+
+        json_data = json.dumps(results[s]['best_params'])
+        f = open(os.path.join(outdir,'best_params.json'),'w')
+        f.write(json_data)
+        f.close()
+
+        if 'search_log' in results[s]:
+            json_data = json.dumps(results[s]['search_log'])
+            f = open(os.path.join(outdir,'search_log.json'),'w')
+            f.write(json_data)
+            f.close()
+
+        np.savetxt(os.path.join(outdir,'accuracy_mean.txt'), np.array([results[s]['accuracy_mean']]))
+        np.savetxt(os.path.join(outdir,'accuracy_std.txt'), np.array([results[s]['accuracy_std']]))
+        np.savetxt(os.path.join(outdir,'permuted_acc.txt'), results[s]['permuted_acc'])
+
+        accuracy_nuis = results[s]['accuracy_nuis']
+        np.savetxt(os.path.join(outdir,'accuracy_nuis.txt'), accuracy_nuis)
+        np.savetxt(os.path.join(outdir,'accuracy_mean_nuis.txt'), np.array([accuracy_nuis.mean()]))
+        np.savetxt(os.path.join(outdir,'accuracy_std_nuis.txt'), np.array([accuracy_nuis.std()]))
+        np.savetxt(os.path.join(outdir,'permuted_acc_nuis.txt'), results[s]['permuted_acc_nuis'])
+
+        for key in ['perm_stats', 'perm_stats_nuis']:
+            json_data = json.dumps(results[s][key])
+            f = open(os.path.join(outdir,key+'.json'),'w')
+            f.write(json_data)
+            f.close()
+
+    shutil.rmtree(checkpoint_dir)
+
+    print('Finished!')
 # --------------------------------------------------------------------------------------------------------------------
-# outputs
-json_data = json.dumps(grid.best_params_)
-f = open(os.path.join(outdir,'best_params.json'),'w')
-f.write(json_data)
-f.close()
 
-np.savetxt(os.path.join(outdir,'accuracy_mean.txt'), np.array([grid.cv_results_['mean_test_score'][grid.best_index_]]))
-np.savetxt(os.path.join(outdir,'accuracy_std.txt'), np.array([grid.cv_results_['std_test_score'][grid.best_index_]]))
-np.savetxt(os.path.join(outdir,'permuted_acc.txt'), permuted_acc)
-
-np.savetxt(os.path.join(outdir,'accuracy_nuis.txt'), accuracy_nuis)
-np.savetxt(os.path.join(outdir,'accuracy_mean_nuis.txt'), np.array([accuracy_nuis.mean()]))
-np.savetxt(os.path.join(outdir,'accuracy_std_nuis.txt'), np.array([accuracy_nuis.std()]))
-np.savetxt(os.path.join(outdir,'permuted_acc_nuis.txt'), permuted_acc_nuis)
-
-# --------------------------------------------------------------------------------------------------------------------
 
-print('Finished!')
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -1,7 +1,7 @@
 import argparse
 
 # Essentials
-import os, sys, glob
+import os, sys, glob, shutil
 import pandas as pd
 import numpy as np
 import copy
@@ -21,51 +21,40 @@ from sklearn.svm import SVR, LinearSVR
 from sklearn.metrics import make_scorer, r2_score, mean_squared_error, mean_absolute_error
 from sklearn.decomposition import PCA
 
+# Project
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from prediction_func import nuis_modes, get_stratified_cv, get_nuis_folds, get_X_folds, cross_val_score_nuis, save_fold_artifacts, get_fold_artifact_file
+from solver_func import is_linear_smoother, has_kernel, get_kernel_folds, get_precomputed_reg
+from split_func import get_split_plan
+from perm_func import permute_linear_batch, permute_loop, permute_chunked, permute_sequential, get_perm_stats
+from pack_func import read_data
+
 # --------------------------------------------------------------------------------------------------------------------
 # parse input arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-x", help="IVs", dest="X_file", default=None)
-parser.add_argument("-y", help="DVs", dest="y_file", default=None)
-parser.add_argument("-c", help="DVs", dest="c_file", default=None)
-parser.add_argument("-metric", help="brain feature (e.g., ac)", dest="metric", default=None)
-parser.add_argument("-pheno", help="psychopathology dimension", dest="pheno", default=None)
-parser.add_argument("-seed", help="seed for shuffle_data", dest="seed", default=1)
-parser.add_argument("-alg", help="estimator", dest="alg", default=None)
-parser.add_argument("-score", help="score set order", dest="score", default=None)
-parser.add_argument("-o", help="output directory", dest="outroot", default=None)
-
-args = parser.parse_args()
-print(args)
-X_file = args.X_file
-y_file = args.y_file
-c_file = args.c_file
-metric = args.metric
-pheno = args.pheno
-# seed = int(args.seed)
-# seed = int(os.environ['SGE_TASK_ID'])-1
-alg = args.alg
-score = args.score
-outroot = args.outroot
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-x", help="IVs", dest="X_file", default=None)
+    parser.add_argument("-y", help="DVs", dest="y_file", default=None)
+    parser.add_argument("-c", help="DVs", dest="c_file", default=None)
+    parser.add_argument("-metric", help="brain feature (e.g., ac)", dest="metric", default=None)
+    parser.add_argument("-pheno", help="psychopathology dimension", dest="pheno", default=None)
+    parser.add_argument("-seed", help="seed for shuffle_data", dest="seed", default=1)
+    parser.add_argument("-alg", help="estimator", dest="alg", default=None)
+    parser.add_argument("-score", help="score(s), comma separated", dest="score", default=None)
+    parser.add_argument("-perm_mode", help="permutation mode: batch (closed form where possible) or loop", dest="perm_mode", default='batch')
+    parser.add_argument("-nuis_mode", help="nuisance model: krr_rbf (default), ridge or ols", dest="nuis_mode", default='krr_rbf')
+    parser.add_argument("-nuis_y", help="also regress nuisance out of y (0 or 1)", dest="nuis_y", default=0)
+    parser.add_argument("-perm_seed", help="root SeedSequence seed for the permutations (default: legacy np.random.seed(i))", dest="perm_seed", default=None)
+    parser.add_argument("-perm_h", help="sequential permutations: stop a score after h permuted scores reach the observed one (default: run all 5000)", dest="perm_h", default=None)
+    parser.add_argument("-n_jobs", help="workers for the permutations (match -pe threaded)", dest="n_jobs", default=4)
+    parser.add_argument("-split_dir", help="shared split plan directory (default: folds are made in memory and not stored)", dest="split_dir", default=None)
+    parser.add_argument("-o", help="output directory", dest="outroot", default=None)
+
+    return parser
 # --------------------------------------------------------------------------------------------------------------------
 
 # --------------------------------------------------------------------------------------------------------------------
 # prediction functions
-def corr_true_pred(y_true, y_pred):
-    if type(y_true) == np.ndarray:
-        y_true = y_true.flatten()
-    if type(y_pred) == np.ndarray:
-        y_pred = y_pred.flatten()
-        
-    r,p = sp.stats.pearsonr(y_true, y_pred)
-    return r
-
-
-def root_mean_squared_error(y_true, y_pred):
-    mse = np.mean((y_true - y_pred)**2, axis=0)
-    rmse = np.sqrt(mse)
-    return rmse
-
-
 def get_reg():
     regs = {'rr': Ridge(),
             'lr': Lasso(),
@@ -78,164 +67,146 @@ def get_reg():
     return regs
 
 
-def get_stratified_cv(X, y, c = None, n_splits = 10):
-
-    # sort data on outcome variable in ascending order
-    idx = y.sort_values(ascending = True).index
-    if X.ndim == 2: X_sort = X.loc[idx,:]
-    elif X.ndim == 1: X_sort = X.loc[idx]
-    y_sort = y.loc[idx]
-    if c is not None:
-        if c.ndim == 2: c_sort = c.loc[idx,:]
-        elif c.ndim == 1: c_sort = c.loc[idx]
+def run_reg_scv(X, y, c, reg, n_splits = 10, scores = ['corr',], run_perm = False, perm_mode = 'batch', perm_seed = None, perm_h = None, n_jobs = 1, checkpoint_dir = None,
+                nuis_mode = 'krr_rbf', nuis_y = False, plan = None):
+    # every score in scores is computed from the same fits and predictions; outputs are dicts keyed on score. the
+    # fitted scalers, nuisance and estimator coefficients and out-of-fold predictions are returned in artifacts (see
+    # prediction_func.save_fold_artifacts)
     
-    # create custom stratified kfold on outcome variable
-    my_cv = []
-    for k in range(n_splits):
-        my_bool = np.zeros(y.shape[0]).astype(bool)
-        my_bool[np.arange(k,y.shape[0],n_splits)] = True
-
-        train_idx = np.where(my_bool == False)[0]
-        test_idx = np.where(my_bool == True)[0]
-        my_cv.append( (train_idx, test_idx) )
-
-    if c is not None:
-        return X_sort, y_sort, my_cv, c_sort
-    else:
-        return X_sort, y_sort, my_cv
-
+    X_sort, y_sort, my_cv, c_sort = get_stratified_cv(X = X, y = y, c = c, n_splits = n_splits, plan = plan)
 
-def cross_val_score_nuis(X, y, c, my_cv, reg, my_scorer, c_y = None):
-    
-    accuracy = np.zeros(len(my_cv),)
-
-    for k in np.arange(len(my_cv)):
-        tr = my_cv[k][0]
-        te = my_cv[k][1]
-
-        # Split into train test
-        X_train = X.iloc[tr,:]; X_test = X.iloc[te,:]
-        y_train = y.iloc[tr]; y_test = y.iloc[te]
-        c_train = c.iloc[tr,:]; c_test = c.iloc[te,:]
-        if c_y is not None: c_y_train = c_y.iloc[tr,:]; c_y_test = c_y.iloc[te,:]
-
-        # standardize predictors
-        sc = StandardScaler(); sc.fit(X_train); X_train = sc.transform(X_train); X_test = sc.transform(X_test)
-        X_train = pd.DataFrame(data = X_train, index = X.iloc[tr,:].index, columns = X.iloc[tr,:].columns)
-        X_test = pd.DataFrame(data = X_test, index = X.iloc[te,:].index, columns = X.iloc[te,:].columns)
-
-        # standardize covariates
-        sc = StandardScaler(); sc.fit(c_train); c_train = sc.transform(c_train); c_test = sc.transform(c_test)
-        c_train = pd.DataFrame(data = c_train, index = c.iloc[tr,:].index, columns = c.iloc[tr,:].columns)
-        c_test = pd.DataFrame(data = c_test, index = c.iloc[te,:].index, columns = c.iloc[te,:].columns)
-
-        if c_y is not None:
-            sc = StandardScaler(); sc.fit(c_y_train); c_y_train = sc.transform(c_y_train); c_y_test = sc.transform(c_y_test)
-            c_y_train = pd.DataFrame(data = c_y_train, index = c.iloc[tr,:].index, columns = c.iloc[tr,:].columns)
-            c_y_test = pd.DataFrame(data = c_y_test, index = c.iloc[te,:].index, columns = c.iloc[te,:].columns)
-
-        # regress nuisance (X)
-        # nuis_reg = LinearRegression(); nuis_reg.fit(c_train, X_train)
-        nuis_reg = KernelRidge(kernel='rbf'); nuis_reg.fit(c_train, X_train)
-        X_pred = nuis_reg.predict(c_train); X_train = X_train - X_pred
-        X_pred = nuis_reg.predict(c_test); X_test = X_test - X_pred
-
-        # # regress nuisance (y)
-        # if c_y is None:  
-        #     # nuis_reg = LinearRegression(); nuis_reg.fit(c_train, y_train)
-        #     nuis_reg = KernelRidge(kernel='rbf'); nuis_reg.fit(c_train, y_train)
-        #     y_pred = nuis_reg.predict(c_train); y_train = y_train - y_pred
-        #     y_pred = nuis_reg.predict(c_test); y_test = y_test - y_pred
-        # elif c_y is not None:
-        #     # nuis_reg = LinearRegression(); nuis_reg.fit(c_y_train, y_train)
-        #     nuis_reg = KernelRidge(kernel='rbf'); nuis_reg.fit(c_y_train, y_train)
-        #     y_pred = nuis_reg.predict(c_y_train); y_train = y_train - y_pred
-        #     y_pred = nuis_reg.predict(c_y_test); y_test = y_test - y_pred
-
-        reg.fit(X_train, y_train)
-        accuracy[k] = my_scorer(reg, X_test, y_test)
-        
-    return accuracy
-
-
-
-def run_reg_scv(X, y, c, reg, n_splits = 10, scoring = 'r2', run_perm = False):
-    
-    X_sort, y_sort, my_cv, c_sort = get_stratified_cv(X = X, y = y, c = c, n_splits = n_splits)
+    # the default (krr_rbf, X only) keeps the per-fold KernelRidge fits. any other nuisance mode, or nuis_y, computes
+    # each fold's residual-forming matrices once (see prediction_func.get_nuis_fold) and applies them to X and y
+    nuis_folds = None
+    if nuis_mode != 'krr_rbf' or nuis_y: nuis_folds = get_nuis_folds(c = c_sort, my_cv = my_cv, mode = nuis_mode)
 
-    accuracy_nuis = cross_val_score_nuis(X = X_sort, y = y_sort, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = scoring)
+    artifacts = dict()
+    accuracy_nuis, y_pred = cross_val_score_nuis(X = X_sort, y = y_sort, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = scores, nuis_mode = nuis_mode,
+                                                 nuis_y = nuis_y, nuis_folds = nuis_folds, artifacts = artifacts)
+    artifacts['y_pred'] = y_pred
 
     if run_perm:
         X_sort.reset_index(drop = True, inplace = True)
         c_sort.reset_index(drop = True, inplace = True)
 
         n_perm = 5000
-        permuted_acc_nuis = np.zeros((n_perm,))
 
-        for i in np.arange(n_perm):
-            np.random.seed(i)
-            idx = np.arange(y_sort.shape[0])
-            np.random.shuffle(idx)
-
-            y_perm = y_sort.iloc[idx].copy()
-            y_perm.reset_index(drop = True, inplace = True)
-            c_y = c_sort.iloc[idx,:]
-            c_y.reset_index(drop = True, inplace = True)
-            
-            permuted_acc_nuis[i] = cross_val_score_nuis(X = X_sort, y = y_perm, c = c_sort, my_cv = my_cv, reg = reg, my_scorer = scoring, c_y = c_y).mean()
+        # standardization and nuisance regression don't depend on y, so do them once per fold for all permutations
+        X_folds_nuis = get_X_folds(X = X_sort, c = c_sort, my_cv = my_cv, nuis = True, nuis_folds = nuis_folds)
+        # with nuis_y, each permuted y is residualized on the covariates permuted along with it, as y is on its own
+        # covariates in the observed fit (see perm_func.permute_linear_batch)
+        c_y = c_sort if nuis_y else None
+
+        perm_reg = reg; perm_folds_nuis = X_folds_nuis
+        if perm_mode == 'batch' and is_linear_smoother(reg):
+            # predictions are linear in y at fixed hyperparameters: one smoother per fold, all permutations at once
+            permute_fn = permute_linear_batch
+        else:
+            # kernel estimators get their train/test kernels once per fold rather than once per permutation
+            permute_fn = permute_loop
+            if has_kernel(reg):
+                perm_folds_nuis = get_kernel_folds(X_folds_nuis, reg)
+                perm_reg = get_precomputed_reg(reg)
+
+        # permutations run in checkpointed chunks across n_jobs processes. with perm_h, a score stops sampling once
+        # perm_h permutations have reached its observed accuracy (see perm_func.permute_sequential). saved chunks are
+        # only reused by a rerun with the same estimator and nuisance settings (see perm_func.get_chunk_fingerprint)
+        checkpoint_key = {'nuis_mode': nuis_mode, 'nuis_y': nuis_y, 'perm_mode': perm_mode, 'reg': reg.get_params(deep = False)}
+        if perm_h is None:
+            permuted_acc_nuis = permute_chunked(permute_fn, y = y_sort, my_cv = my_cv, reg = perm_reg, X_folds = perm_folds_nuis, n_perm = n_perm, score = scores,
+                                                seed = perm_seed, n_jobs = n_jobs, checkpoint_dir = checkpoint_dir, c_y = c_y, nuis_mode = nuis_mode,
+                                                checkpoint_key = checkpoint_key)
+            perm_stats = {s: get_perm_stats(permuted_acc_nuis[s], accuracy_nuis[s].mean(), n_perm = n_perm) for s in scores}
+        else:
+            permuted_acc_nuis, perm_stats = permute_sequential(permute_fn, y = y_sort, my_cv = my_cv, reg = perm_reg, X_folds = perm_folds_nuis,
+                                                               accuracy = {s: accuracy_nuis[s].mean() for s in scores}, n_perm = n_perm, h = perm_h, score = scores,
+                                                               seed = perm_seed, n_jobs = n_jobs, checkpoint_dir = checkpoint_dir, c_y = c_y, nuis_mode = nuis_mode,
+                                                               checkpoint_key = checkpoint_key)
 
     if run_perm:
-        return accuracy_nuis, permuted_acc_nuis
+        return accuracy_nuis, permuted_acc_nuis, perm_stats, artifacts
     else:
-        return accuracy_nuis
-
-
-# --------------------------------------------------------------------------------------------------------------------
-
-# --------------------------------------------------------------------------------------------------------------------
-# inputs
-X = pd.read_csv(X_file)
-X.set_index(['bblid', 'scanid'], inplace = True)
-X = X.filter(regex = metric)
-
-y = pd.read_csv(y_file)
-y.set_index(['bblid', 'scanid'], inplace = True)
-y = y.loc[:,pheno]
+        return accuracy_nuis, artifacts
 
-c = pd.read_csv(c_file)
-c.set_index(['bblid', 'scanid'], inplace = True)
 
-# outdir
-outdir = os.path.join(outroot, alg + '_' + score + '_' + metric + '_' + pheno)
-if not os.path.exists(outdir): os.makedirs(outdir);
 # --------------------------------------------------------------------------------------------------------------------
 
 # --------------------------------------------------------------------------------------------------------------------
-# set scorer
-if score == 'r2':
-    my_scorer = make_scorer(r2_score, greater_is_better = True)
-elif score == 'corr':
-    my_scorer = make_scorer(corr_true_pred, greater_is_better = True)
-elif score == 'mse':
-    my_scorer = make_scorer(mean_squared_error, greater_is_better = False)
-elif score == 'rmse':
-    my_scorer = make_scorer(root_mean_squared_error, greater_is_better = False)
-elif score == 'mae':
-    my_scorer = make_scorer(mean_absolute_error, greater_is_better = False)
-
-# prediction
-regs = get_reg()
-
-accuracy_nuis, permuted_acc_nuis = run_reg_scv(X = X, y = y, c = c, reg = regs[alg], scoring = my_scorer, run_perm = True)
+# entry point, see pack_func.run_task
+def main(args):
+    print(args)
+    X_file = args.X_file
+    y_file = args.y_file
+    c_file = args.c_file
+    metric = args.metric
+    pheno = args.pheno
+    # seed = int(args.seed)
+    # seed = int(os.environ['SGE_TASK_ID'])-1
+    alg = args.alg
+    score = args.score
+    perm_mode = args.perm_mode
+    nuis_mode = args.nuis_mode
+    if nuis_mode not in nuis_modes: raise ValueError('unknown -nuis_mode ' + str(nuis_mode))
+    nuis_y = bool(int(args.nuis_y))
+    perm_seed = args.perm_seed
+    if perm_seed is not None: perm_seed = int(perm_seed)
+    perm_h = args.perm_h
+    if perm_h is not None: perm_h = int(perm_h)
+    n_jobs = int(args.n_jobs)
+    split_dir = args.split_dir
+    outroot = args.outroot
+
+    # inputs
+    X = read_data(X_file)
+    X = X.filter(regex = metric)
+
+    y = read_data(y_file)
+    y = y.loc[:,pheno]
+
+    c = read_data(c_file)
+
+    # set scorers. -score takes a comma separated list (e.g., corr,rmse); every score is computed from the same fits
+    scores = score.split(',')
+
+    # prediction
+    regs = get_reg()
+
+    # finished permutation chunks are kept here until the outputs are written, so a killed job resumes where it stopped
+    checkpoint_dir = os.path.join(outroot, 'perm_chunks', alg + '_' + metric + '_' + pheno)
+
+    # the stratified folds, read from (or, for the first job, written to) the shared split plan directory (see split_func.py)
+    plan = get_split_plan(split_dir, y.index, 'stratified', n_splits = 10, y = y)
+
+    accuracy_nuis, permuted_acc_nuis, perm_stats, artifacts = run_reg_scv(X = X, y = y, c = c, reg = regs[alg], scores = scores, run_perm = True, perm_mode = perm_mode,
+                                                                          perm_seed = perm_seed, perm_h = perm_h, n_jobs = n_jobs, checkpoint_dir = checkpoint_dir,
+                                                                          nuis_mode = nuis_mode, nuis_y = nuis_y, plan = plan)
+
+    # outputs
+    for s in scores:
+        outdir = os.path.join(outroot, alg + '_' + s + '_' + metric + '_' + pheno)
+        if not os.path.exists(outdir): os.makedirs(outdir);
+
+        np.savetxt(os.path.join(outdir,'accuracy_nuis.txt'), accuracy_nuis[s])
+        np.savetxt(os.path.join(outdir,'accuracy_mean_nuis.txt'), np.array([accuracy_nuis[s].mean()]))
+        np.savetxt(os.path.join(outdir,'accuracy_std_nuis.txt'), np.array([accuracy_nuis[s].std()]))
+        np.savetxt(os.path.join(outdir,'permuted_acc_nuis.txt'), permuted_acc_nuis[s])
+
+        json_data = json.dumps(perm_stats[s])
+        f = open(os.path.join(outdir,'perm_stats_nuis.json'),'w')
+        f.write(json_data)
+        f.close()
+
+    # per-fold fits and out-of-fold predictions, so the results notebooks don't have to refit (see load_fold_artifacts).
+    # the fits are the same for every score, so one file holds them with every score's fold accuracies
+    artifact_file = get_fold_artifact_file(outroot, alg, metric, pheno)
+    if not os.path.exists(os.path.dirname(artifact_file)): os.makedirs(os.path.dirname(artifact_file))
+    save_fold_artifacts(artifact_file, artifacts, artifacts['y_pred'], accuracy = accuracy_nuis, plan = plan, nuis_mode = nuis_mode)
+
+    shutil.rmtree(checkpoint_dir)
+
+    print('Finished!')
 # --------------------------------------------------------------------------------------------------------------------
 
-# --------------------------------------------------------------------------------------------------------------------
-# outputs
-np.savetxt(os.path.join(outdir,'accuracy_nuis.txt'), accuracy_nuis)
-np.savetxt(os.path.join(outdir,'accuracy_mean_nuis.txt'), np.array([accuracy_nuis.mean()]))
-np.savetxt(os.path.join(outdir,'accuracy_std_nuis.txt'), np.array([accuracy_nuis.std()]))
-np.savetxt(os.path.join(outdir,'permuted_acc_nuis.txt'), permuted_acc_nuis)
-
-# --------------------------------------------------------------------------------------------------------------------
 
-print('Finished!')
+if __name__ == '__main__':
+    main(get_parser().parse_args())
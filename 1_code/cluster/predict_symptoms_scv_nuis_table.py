@@ -0,0 +1,145 @@
+import argparse
+
+# Essentials
+import os, sys, glob
+import pandas as pd
+import numpy as np
+import json
+
+# Sklearn
+from sklearn.linear_model import Ridge, Lasso
+from sklearn.kernel_ridge import KernelRidge
+from sklearn.svm import SVR
+
+# Project
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from prediction_func import nuis_modes, get_stratified_cv, get_nuis_folds, get_X_folds, cross_val_score_nuis
+from split_func import get_split_plan
+from perm_func import get_perm_idx, get_perm_stats, permute_table
+from pack_func import read_data
+
+# --------------------------------------------------------------------------------------------------------------------
+# parse input arguments
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-x", help="IVs", dest="X_file", default=None)
+    parser.add_argument("-y", help="DVs", dest="y_file", default=None)
+    parser.add_argument("-c", help="DVs", dest="c_file", default=None)
+    parser.add_argument("-metric", help="brain feature(s), comma separated (e.g., str,ac)", dest="metric", default=None)
+    parser.add_argument("-pheno", help="psychopathology dimension", dest="pheno", default=None)
+    parser.add_argument("-alg", help="estimator(s), comma separated", dest="alg", default=None)
+    parser.add_argument("-score", help="score(s), comma separated", dest="score", default=None)
+    parser.add_argument("-perm_mode", help="permutation mode: batch (closed form where possible) or loop", dest="perm_mode", default='batch')
+    parser.add_argument("-nuis_mode", help="nuisance model: krr_rbf (default), ridge or ols", dest="nuis_mode", default='krr_rbf')
+    parser.add_argument("-nuis_y", help="also regress nuisance out of y (0 or 1)", dest="nuis_y", default=0)
+    parser.add_argument("-perm_seed", help="root SeedSequence seed for the permutations (default: legacy np.random.seed(i))", dest="perm_seed", default=None)
+    parser.add_argument("-n_jobs", help="worker processes (one model per worker)", dest="n_jobs", default=1)
+    parser.add_argument("-split_dir", help="shared split plan directory (default: folds are made in memory and not stored)", dest="split_dir", default=None)
+    parser.add_argument("-o", help="output directory", dest="outroot", default=None)
+
+    return parser
+# --------------------------------------------------------------------------------------------------------------------
+
+# --------------------------------------------------------------------------------------------------------------------
+# prediction functions
+def get_reg():
+    regs = {'rr': Ridge(),
+            'lr': Lasso(),
+            'krr_lin': KernelRidge(kernel='linear'),
+            'krr_rbf': KernelRidge(kernel='rbf'),
+            'svr_lin': SVR(kernel='linear'),
+            'svr_rbf': SVR(kernel='rbf')
+            }
+
+    return regs
+
+# --------------------------------------------------------------------------------------------------------------------
+
+# --------------------------------------------------------------------------------------------------------------------
+# entry point, see pack_func.run_task
+def main(args):
+    print(args)
+    X_file = args.X_file
+    y_file = args.y_file
+    c_file = args.c_file
+    metrics = args.metric.split(',')
+    pheno = args.pheno
+    algs = args.alg.split(',')
+    scores = args.score.split(',')
+    perm_mode = args.perm_mode
+    nuis_mode = args.nuis_mode
+    if nuis_mode not in nuis_modes: raise ValueError('unknown -nuis_mode ' + str(nuis_mode))
+    nuis_y = bool(int(args.nuis_y))
+    perm_seed = args.perm_seed
+    if perm_seed is not None: perm_seed = int(perm_seed)
+    n_jobs = int(args.n_jobs)
+    split_dir = args.split_dir
+    outroot = args.outroot
+
+    # inputs
+    X = read_data(X_file)
+
+    y = read_data(y_file)
+    y = y.loc[:,pheno]
+
+    c = read_data(c_file)
+
+    # Same models as predict_symptoms_scv_nuis.py, but every metric and alg for one phenotype runs in a single job.
+    # The stratified folds only depend on y, so they (and the permutation indices) are built once per phenotype, and each
+    # metric's standardized, nuisance-residualized folds are computed once and shared by every alg. The nuisance model's
+    # residual-forming matrices are computed once per fold and applied to every metric (and, with -nuis_y 1, to y;
+    # each permuted y is residualized on the covariates permuted along with it).
+    # With -split_dir the folds are read from the shared split plan (see split_func.py).
+    regs = get_reg(); regs = {alg: regs[alg] for alg in algs}
+
+    n_perm = 5000
+    perm_idx = get_perm_idx(y.shape[0], n_perm = n_perm, seed = perm_seed)
+
+    plan = get_split_plan(split_dir, y.index, 'stratified', n_splits = 10, y = y)
+    X_sort, y_sort, my_cv, c_sort = get_stratified_cv(X = X, y = y, c = c, n_splits = 10, plan = plan)
+
+    nuis_folds = get_nuis_folds(c = c_sort, my_cv = my_cv, mode = nuis_mode)
+
+    X_folds_nuis = dict()
+    accuracy_nuis = dict()
+    for metric in metrics:
+        X_folds_nuis[metric] = get_X_folds(X = X_sort.filter(regex = metric), c = None, my_cv = my_cv, nuis = True, nuis_folds = nuis_folds)
+
+        for alg in algs:
+            acc, _ = cross_val_score_nuis(X = None, y = y_sort, c = None, my_cv = my_cv, reg = regs[alg], my_scorer = scores, X_folds = X_folds_nuis[metric],
+                                          nuis_y = nuis_y, nuis_folds = nuis_folds)
+            for s in scores: accuracy_nuis[(alg, s, metric)] = acc[s]
+
+    permuted_acc_nuis = permute_table(y = y_sort, my_cv = my_cv, regs = regs, X_folds = X_folds_nuis, perm_idx = perm_idx, score = scores,
+                                      perm_mode = perm_mode, n_jobs = n_jobs, c_y = c_sort if nuis_y else None,
+                                      nuis_mode = nuis_mode)
+
+    # outputs: one null table per phenotype (permutations x models) and one table of observed accuracies and p-values.
+    # models are named as predict_symptoms_scv_nuis.py names its output directories (alg_score_metric)
+    if not os.path.exists(outroot): os.makedirs(outroot);
+
+    models = [(alg, s, metric) for alg in algs for s in scores for metric in metrics]
+    model_names = [alg + '_' + s + '_' + metric for alg, s, metric in models]
+
+    df_null = pd.DataFrame(np.stack([permuted_acc_nuis[model] for model in models], axis = 1), columns = model_names)
+    df_null.index.name = 'perm'
+    df_null.to_csv(os.path.join(outroot, 'permuted_acc_nuis_' + pheno + '.csv'))
+
+    df_acc = pd.DataFrame(index = model_names, columns = ['accuracy_mean_nuis', 'accuracy_std_nuis', 'p_value', 'p_resolution'])
+    for model, name in zip(models, model_names):
+        perm_stats = get_perm_stats(permuted_acc_nuis[model], accuracy_nuis[model].mean(), n_perm = n_perm)
+        df_acc.loc[name,:] = [accuracy_nuis[model].mean(), accuracy_nuis[model].std(), perm_stats['p_value'], perm_stats['p_resolution']]
+    df_acc.index.name = 'model'
+    df_acc.to_csv(os.path.join(outroot, 'accuracy_nuis_' + pheno + '.csv'))
+
+    json_data = json.dumps({'pheno': pheno, 'n_perm': n_perm, 'perm_seed': perm_seed, 'perm_mode': perm_mode, 'nuis_mode': nuis_mode, 'nuis_y': nuis_y})
+    f = open(os.path.join(outroot, 'perm_info_' + pheno + '.json'),'w')
+    f.write(json_data)
+    f.close()
+
+    print('Finished!')
+# --------------------------------------------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
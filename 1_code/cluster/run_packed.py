@@ -0,0 +1,57 @@
+import argparse
+
+# Essentials
+import os, sys
+from datetime import datetime
+
+# Project
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pack_func import load_tasks, run_tasks
+
+# --------------------------------------------------------------------------------------------------------------------
+# parse input arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("-tasks", help="task file (see job_func.pack_jobs)", dest="task_file", default=None)
+parser.add_argument("-batch", help="batch to run, 1-based (default: SGE_TASK_ID, or every task if unset)", dest="batch", default=None)
+parser.add_argument("-batch_size", help="tasks per batch", dest="batch_size", default=100)
+parser.add_argument("-n_jobs", help="worker processes (one task per worker)", dest="n_jobs", default=1)
+
+args = parser.parse_args()
+print(args)
+task_file = args.task_file
+batch = args.batch
+if batch is None: batch = os.environ.get('SGE_TASK_ID')
+batch_size = int(args.batch_size)
+n_jobs = int(args.n_jobs)
+# --------------------------------------------------------------------------------------------------------------------
+
+# --------------------------------------------------------------------------------------------------------------------
+# start timer
+start = datetime.now()
+
+# one batch of cluster script invocations, run in this interpreter: each script is imported and each input file
+# parsed once, then shared by every task in the batch (see pack_func.py). read before run_tasks sets each task's
+# own SGE_TASK_ID
+tasks = load_tasks(task_file)
+if batch is not None: tasks = tasks[(int(batch) - 1) * batch_size:int(batch) * batch_size]
+
+results = run_tasks(tasks, n_jobs = n_jobs)
+
+# stop timer
+stop = datetime.now()
+# --------------------------------------------------------------------------------------------------------------------
+
+# --------------------------------------------------------------------------------------------------------------------
+# outputs
+for r in results: print('{0}\t{1}\t{2:.1f}'.format(r['name'], 'ok' if r['ok'] else 'FAILED', r['run_time_seconds']))
+
+run_time = stop - start
+print('Run time (seconds): ' + str(run_time.seconds))
+
+n_failed = sum([not r['ok'] for r in results])
+if n_failed > 0:
+    print(str(n_failed) + ' of ' + str(len(results)) + ' tasks failed')
+    sys.exit(1)
+# --------------------------------------------------------------------------------------------------------------------
+
+print('Finished!')
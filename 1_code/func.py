@@ -30,87 +30,32 @@ from sklearn.linear_model import Ridge, Lasso, LinearRegression
 from sklearn.kernel_ridge import KernelRidge
 from sklearn.svm import SVR, LinearSVR
 
+# Project
+from parc_func import get_registry
+from prediction_func import corr_true_pred, root_mean_squared_error, get_stratified_cv, cross_val_score_nuis
 
 
-def set_proj_env(parc_str = 'schaefer', parc_scale = 200, edge_weight = 'streamlineCount', extra_str = ''):
-
-    # Project root directory
-    projdir = '/Users/lindenmp/Google-Drive-Penn/work/research_projects/neurodev_cs_predictive'; os.environ['PROJDIR'] = projdir
-
-    # Data directory
-    datadir = os.path.join(projdir, '0_data'); os.environ['DATADIR'] = datadir
 
-    # Imaging derivatives
-    derivsdir = os.path.join('/Volumes/work_ssd/research_data/PNC/'); os.environ['DERIVSDIR'] = derivsdir
-
-    # Pipeline directory
-    pipelinedir = os.path.join(projdir, '2_pipeline'); os.environ['PIPELINEDIR'] = pipelinedir
+def set_proj_env(parc_str = 'schaefer', parc_scale = 200, edge_weight = 'streamlineCount', extra_str = ''):
 
-    # Output directory
-    outputdir = os.path.join(projdir, '3_output'); os.environ['OUTPUTDIR'] = outputdir
+    # Parcellation specifications (names, cortex/subcortex vector, path templates) come from the memoized registry
+    # in parc_func. The paths are exported to os.environ; use get_proj_paths to get them without touching it.
+    parc = get_registry().get(parc_str = parc_str, parc_scale = parc_scale)
+    parcel_names = parc.parcel_names.copy()
+    parcel_loc = parc.parcel_loc.copy()
+    drop_parcels = parc.drop_parcels
+    num_parcels = parc.num_parcels
 
-    # Parcellation specifications
-    # Names of parcels
-    if parc_str == 'schaefer':
-        parcel_names = np.genfromtxt(os.path.join(projdir, 'figs_support/labels/schaefer' + str(parc_scale) + 'NodeNames.txt'), dtype='str')
-    elif parc_str == 'lausanne':
-        parcel_names = np.genfromtxt(os.path.join(projdir, 'figs_support/labels/lausanne_' + str(parc_scale) + '.txt'), dtype='str')
-    else:
-        parcel_names = np.genfromtxt(os.path.join(projdir, 'figs_support/labels/glasser' + str(parc_scale) + 'NodeNames.txt'), dtype='str')
+    os.environ.update(parc.paths(edge_weight = edge_weight))
 
-    # vector describing whether rois belong to cortex (1) or subcortex (0)
-    if parc_str == 'schaefer':
-        parcel_loc = np.loadtxt(os.path.join(projdir, 'figs_support/labels/schaefer' + str(parc_scale) + 'NodeNames_loc.txt'), dtype='int')
-    elif parc_str == 'lausanne':
-        parcel_loc = np.loadtxt(os.path.join(projdir, 'figs_support/labels/lausanne_' + str(parc_scale) + '_loc.txt'), dtype='int')
-    else:
-        parcel_loc = []
+    return parcel_names, parcel_loc, drop_parcels, num_parcels
 
-    drop_parcels = []
 
-    if len(parcel_names)>0:
-        num_parcels = parcel_names.shape[0]
-    else:
-        if parc_str == 'glasser':
-            num_parcels = 360
-        else:
-            num_parcels = []
-
-    if parc_str == 'schaefer':
-        scdir = os.path.join(derivsdir, 'processedData/diffusion/deterministic_20171118'); os.environ['SCDIR'] = scdir
-        sc_name_tmp = 'bblid/*xscanid/tractography/connectivity/bblid_*xscanid_SchaeferPNC_' + str(parc_scale) + '_dti_' + edge_weight + '_connectivity.mat'; os.environ['SC_NAME_TMP'] = sc_name_tmp
-
-        os.environ['CONN_STR'] = 'connectivity'
-
-        rstsdir = os.path.join(derivsdir, 'processedData/restbold/restbold_201607151621'); os.environ['RSTSDIR'] = rstsdir
-        if parc_scale == 200:
-            rsts_name_tmp = 'bblid/*xscanid/net/Schaefer' + str(parc_scale) + 'PNC/bblid_*xscanid_Schaefer' + str(parc_scale) + 'PNC_ts.1D'; os.environ['RSTS_NAME_TMP'] = rsts_name_tmp
-        elif parc_scale == 400:
-            rsts_name_tmp = 'bblid/*xscanid/net/SchaeferPNC/bblid_*xscanid_SchaeferPNC_ts.1D'; os.environ['RSTS_NAME_TMP'] = rsts_name_tmp
-    elif parc_str == 'glasser':
-        scdir = os.path.join(derivsdir, 'processedData/diffusion/deterministic_dec2016', edge_weight, 'GlasserPNC'); os.environ['SCDIR'] = scdir
-        sc_name_tmp = 'scanid_' + edge_weight + '_GlasserPNC.mat'; os.environ['SC_NAME_TMP'] = sc_name_tmp
-        
-        if edge_weight == 'streamlineCount':
-            os.environ['CONN_STR'] = 'connectivity'
-        elif edge_weight == 'volNormStreamline':
-            os.environ['CONN_STR'] = 'volNorm_connectivity'
-
-        rstsdir = os.path.join(derivsdir, 'processedData/restbold/restbold_201607151621'); os.environ['RSTSDIR'] = rstsdir
-        rsts_name_tmp = 'bblid/*xscanid/net/GlasserPNC/bblid_*xscanid_GlasserPNC_ts.1D'; os.environ['RSTS_NAME_TMP'] = rsts_name_tmp
-    elif parc_str == 'lausanne':
-        scdir = os.path.join(derivsdir, 'processedData/diffusion/deterministic_dec2016', edge_weight, 'LausanneScale' + str(parc_scale)); os.environ['SCDIR'] = scdir
-        sc_name_tmp = 'scanid_' + edge_weight + '_LausanneScale' + str(parc_scale) + '.mat'; os.environ['SC_NAME_TMP'] = sc_name_tmp
-        
-        if edge_weight == 'streamlineCount':
-            os.environ['CONN_STR'] = 'connectivity'
-        elif edge_weight == 'volNormStreamline':
-            os.environ['CONN_STR'] = 'volNorm_connectivity'
-
-        rstsdir = os.path.join(derivsdir, 'processedData/restbold/restbold_201607151621'); os.environ['RSTSDIR'] = rstsdir
-        rsts_name_tmp = 'bblid/*xscanid/net/Lausanne' + str(parc_scale) + '/bblid_*xscanid_Lausanne' + str(parc_scale) + '_ts.1D'; os.environ['RSTS_NAME_TMP'] = rsts_name_tmp
+def get_proj_paths(parc_str = 'schaefer', parc_scale = 200, edge_weight = 'streamlineCount'):
 
-    return parcel_names, parcel_loc, drop_parcels, num_parcels
+    # The paths set_proj_env exports, as a dict, leaving os.environ untouched, e.g., when running several
+    # parcellations in parallel within one process.
+    return get_registry().get(parc_str = parc_str, parc_scale = parc_scale).paths(edge_weight = edge_weight)
 
 
 def my_get_cmap(which_type = 'qual1', num_classes = 8):
@@ -301,22 +246,6 @@ def get_fdr_p_df(p_vals, alpha = 0.05, rows = False):
     return p_fdr
 
 
-def corr_true_pred(y_true, y_pred):
-    if type(y_true) == np.ndarray:
-        y_true = y_true.flatten()
-    if type(y_pred) == np.ndarray:
-        y_pred = y_pred.flatten()
-        
-    r,p = sp.stats.pearsonr(y_true, y_pred)
-    return r
-
-
-def root_mean_squared_error(y_true, y_pred):
-    mse = np.mean((y_true - y_pred)**2, axis=0)
-    rmse = np.sqrt(mse)
-    return rmse
-
-
 def get_reg(num_params = 10):
     regs = {'rr': Ridge(),
             'lr': Lasso(),
@@ -339,76 +268,6 @@ def get_reg(num_params = 10):
     return regs, param_grids
 
 
-def get_stratified_cv(X, y, c = None, n_splits = 10):
-
-    # sort data on outcome variable in ascending order
-    idx = y.sort_values(ascending = True).index
-    if X.ndim == 2: X_sort = X.loc[idx,:]
-    elif X.ndim == 1: X_sort = X.loc[idx]
-    y_sort = y.loc[idx]
-    if c is not None:
-        if c.ndim == 2: c_sort = c.loc[idx,:]
-        elif c.ndim == 1: c_sort = c.loc[idx]
-    
-    # create custom stratified kfold on outcome variable
-    my_cv = []
-    for k in range(n_splits):
-        my_bool = np.zeros(y.shape[0]).astype(bool)
-        my_bool[np.arange(k,y.shape[0],n_splits)] = True
-
-        train_idx = np.where(my_bool == False)[0]
-        test_idx = np.where(my_bool == True)[0]
-        my_cv.append( (train_idx, test_idx) )
-
-    if c is not None:
-        return X_sort, y_sort, my_cv, c_sort
-    else:
-        return X_sort, y_sort, my_cv
-
-
-def cross_val_score_nuis(X, y, c, my_cv, reg, my_scorer):
-    
-    accuracy = np.zeros(len(my_cv),)
-    y_pred_out = np.zeros(y.shape)
-    
-    for k in np.arange(len(my_cv)):
-        tr = my_cv[k][0]
-        te = my_cv[k][1]
-
-        # Split into train test
-        X_train = X.iloc[tr,:]; X_test = X.iloc[te,:]
-        y_train = y.iloc[tr]; y_test = y.iloc[te]
-        c_train = c.iloc[tr,:]; c_test = c.iloc[te,:]
-
-        # standardize predictors
-        sc = StandardScaler(); sc.fit(X_train); X_train = sc.transform(X_train); X_test = sc.transform(X_test)
-        X_train = pd.DataFrame(data = X_train, index = X.iloc[tr,:].index, columns = X.iloc[tr,:].columns)
-        X_test = pd.DataFrame(data = X_test, index = X.iloc[te,:].index, columns = X.iloc[te,:].columns)
-
-        # standardize covariates
-        sc = StandardScaler(); sc.fit(c_train); c_train = sc.transform(c_train); c_test = sc.transform(c_test)
-        c_train = pd.DataFrame(data = c_train, index = c.iloc[tr,:].index, columns = c.iloc[tr,:].columns)
-        c_test = pd.DataFrame(data = c_test, index = c.iloc[te,:].index, columns = c.iloc[te,:].columns)
-
-        # regress nuisance (X)
-        # nuis_reg = LinearRegression(); nuis_reg.fit(c_train, X_train)
-        nuis_reg = KernelRidge(kernel='rbf'); nuis_reg.fit(c_train, X_train)
-        X_pred = nuis_reg.predict(c_train); X_train = X_train - X_pred
-        X_pred = nuis_reg.predict(c_test); X_test = X_test - X_pred
-
-        # # regress nuisance (y)
-        # nuis_reg = LinearRegression(); nuis_reg.fit(c_train, y_train)
-        # y_pred = nuis_reg.predict(c_train); y_train = y_train - y_pred
-        # y_pred = nuis_reg.predict(c_test); y_test = y_test - y_pred
-
-        reg.fit(X_train, y_train)
-        accuracy[k] = my_scorer(reg, X_test, y_test)
-        
-        y_pred_out[te] = reg.predict(X_test)
-        
-    return accuracy, y_pred_out
-
-
 def assemble_df(numpy_array, algs, metrics, phenos):
     df = pd.DataFrame(columns = ['score', 'alg', 'metric', 'pheno'])
 
@@ -0,0 +1,159 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# Job submission backends for 6_job_submitter. A job is one command line plus resource hints; the same list of jobs
+# can be sent to SGE (qsub, as the submitter always has), run on this machine in a process pool that never uses more
+# than a given number of cores, or written out as a shell-script job array for any other scheduler (or xargs -P).
+# Many short jobs can be packed into a few that each run a batch of them in one interpreter (see pack_jobs).
+# Only depends on the standard library.
+
+# Essentials
+import os
+import json
+import math
+import time
+import shlex
+import subprocess
+
+# sge: one qsub per job. local: subprocesses on this machine. shell: a job array script, nothing is run
+backends = ['sge', 'local', 'shell']
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# jobs
+def make_job(name, cmd, n_cpus = 1, mem = '1G', n_tasks = None):
+    # name: job name (qsub -N, log file names). cmd: the command line. n_cpus and mem are resource hints: the cores
+    # the command uses (qsub -pe threaded, and the slots it takes in a local pool, whose BLAS threads are capped to
+    # match) and the memory per core (qsub h_vmem/s_vmem). n_tasks makes an array job: the command runs n_tasks
+    # times with SGE_TASK_ID = 1, ..., n_tasks (qsub -t 1-n_tasks)
+    return {'name': name, 'cmd': cmd, 'n_cpus': int(n_cpus), 'mem': mem, 'n_tasks': n_tasks}
+
+
+def expand_tasks(jobs):
+    # one (name, cmd, n_cpus, env) per command to run: array jobs become one entry per task, with SGE_TASK_ID set
+    tasks = []
+    for job in jobs:
+        if job['n_tasks'] is None:
+            tasks.append((job['name'], job['cmd'], job['n_cpus'], dict()))
+        else:
+            for t in range(1, job['n_tasks'] + 1):
+                tasks.append((job['name'] + '.' + str(t), job['cmd'], job['n_cpus'], {'SGE_TASK_ID': str(t)}))
+    return tasks
+
+
+def pack_jobs(jobs, py_exec, worker, task_file, batch_size = 100, n_jobs = 1):
+    # Packs jobs into one array job: every task (array jobs expanded, see expand_tasks) is written to task_file, one
+    # json line (name, script, argv, env) parsed from its command line (interpreter, script, arguments), and each
+    # array task runs worker (cluster/run_packed.py) on batch_size of them in one interpreter, n_jobs at a time (see
+    # pack_func.py). The packed job asks for n_jobs times the largest n_cpus of its tasks and the first job's mem.
+    tasks = expand_tasks(jobs)
+
+    f = open(task_file, 'w')
+    for name, cmd, n_cpus, env in tasks:
+        argv = shlex.split(cmd)
+        f.write(json.dumps({'name': name, 'script': argv[1], 'argv': argv[2:], 'env': env}) + '\n')
+    f.close()
+
+    cmd = '{0} {1} -tasks {2} -batch_size {3} -n_jobs {4}'.format(py_exec, worker, task_file, batch_size, n_jobs)
+    n_cpus = n_jobs * max([task[2] for task in tasks])
+
+    return make_job('pack_' + jobs[0]['name'], cmd, n_cpus = n_cpus, mem = jobs[0]['mem'], n_tasks = int(math.ceil(len(tasks) / batch_size)))
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# backends
+def get_qsub_call(job, log_dir):
+    # the qsub prefix 6_job_submitter has always used, with the job's resource hints filled in
+    qsub_call = 'qsub -N {0} -l h_vmem={1},s_vmem={1} '.format(job['name'], job['mem'])
+    if job['n_tasks'] is not None: qsub_call += '-t 1-{0} '.format(job['n_tasks'])
+    qsub_call += '-pe threaded {0} -j y -b y -o {1} -e {1} '.format(job['n_cpus'], log_dir)
+    return qsub_call
+
+
+def submit_sge(jobs, log_dir):
+    for job in jobs:
+        os.system(get_qsub_call(job, log_dir) + job['cmd'])
+
+
+def write_shell_array(jobs, script_file):
+    # Writes script_file, a bash job array over every task (array jobs expanded, see expand_tasks): 'bash script_file
+    # i' runs task i (0-based), and with no argument it prints the number of tasks. script_file + '.tsv' lists one
+    # task per line (index, name, cores), e.g. for sbatch --array or xargs -P. Returns the number of tasks.
+    tasks = expand_tasks(jobs)
+
+    f = open(script_file, 'w')
+    f.write('#!/bin/bash\n')
+    f.write('# generated by job_func.write_shell_array\n')
+    f.write('if [ $# -eq 0 ]; then echo {0}; exit 0; fi\n'.format(len(tasks)))
+    f.write('case "$1" in\n')
+    for i, (name, cmd, n_cpus, env) in enumerate(tasks):
+        env_str = ''.join(key + '=' + shlex.quote(env[key]) + ' ' for key in env.keys())
+        f.write('    {0}) {1}OMP_NUM_THREADS={2} MKL_NUM_THREADS={2} OPENBLAS_NUM_THREADS={2} exec {3} ;;\n'.format(i, env_str, n_cpus, cmd))
+    f.write('    *) echo "no task $1" >&2; exit 1 ;;\n')
+    f.write('esac\n')
+    f.close()
+    os.chmod(script_file, 0o755)
+
+    f = open(script_file + '.tsv', 'w')
+    for i, (name, cmd, n_cpus, env) in enumerate(tasks): f.write('{0}\t{1}\t{2}\n'.format(i, name, n_cpus))
+    f.close()
+
+    return len(tasks)
+
+
+def run_local(jobs, max_cpus = None, log_dir = None, poll = 1.0):
+    # Runs every task (array jobs expanded) as a subprocess on this machine, starting tasks in order whenever enough
+    # cores are free: a task takes n_cpus of max_cpus (default: every core), and a task that asks for more than
+    # max_cpus runs on its own. BLAS/OpenMP threads are capped at each task's n_cpus so tasks don't oversubscribe the
+    # machine. stdout and stderr go to log_dir/<name>.log (or are inherited). Returns {name: exit code}.
+    if max_cpus is None: max_cpus = os.cpu_count()
+    if log_dir is not None and not os.path.exists(log_dir): os.makedirs(log_dir)
+
+    pending = expand_tasks(jobs)[::-1]
+    running = []
+    returncodes = dict()
+    free = max_cpus
+
+    while pending or running:
+        # start every task that fits, in submission order
+        while pending and (pending[-1][2] <= free or not running):
+            name, cmd, n_cpus, env = pending.pop()
+            task_env = dict(os.environ)
+            for key in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']: task_env[key] = str(n_cpus)
+            task_env.update(env)
+
+            log = open(os.path.join(log_dir, name + '.log'), 'w') if log_dir is not None else None
+            proc = subprocess.Popen(shlex.split(cmd), env = task_env, stdout = log, stderr = subprocess.STDOUT if log is not None else None)
+            running.append((name, proc, min(n_cpus, max_cpus), log))
+            free -= min(n_cpus, max_cpus)
+
+        time.sleep(poll)
+        for task in list(running):
+            name, proc, n_cpus, log = task
+            if proc.poll() is not None:
+                returncodes[name] = proc.returncode
+                if log is not None: log.close()
+                running.remove(task); free += n_cpus
+
+    return returncodes
+
+
+def submit_jobs(jobs, backend = 'sge', log_dir = None, max_cpus = None, script_file = None, pack = None):
+    # sends jobs (see make_job) to one of backends. log_dir is the qsub -o/-e directory for sge and the per-task log
+    # directory for local; max_cpus caps the cores a local run uses; script_file is where shell writes the job array.
+    # pack (the py_exec, worker, batch_size and n_jobs arguments of pack_jobs) sends the jobs packed instead, their
+    # task file written to script_file + '.tasks'
+    if len(jobs) == 0: return None
+    if pack is not None and script_file is None: raise ValueError('submit_jobs: pack needs script_file for its task file')
+    if pack is not None: jobs = [pack_jobs(jobs, task_file = script_file + '.tasks', **pack)]
+
+    if backend == 'sge':
+        submit_sge(jobs, log_dir)
+    elif backend == 'local':
+        return run_local(jobs, max_cpus = max_cpus, log_dir = log_dir)
+    elif backend == 'shell':
+        return write_shell_array(jobs, script_file)
+    else:
+        raise ValueError('submit_jobs: unknown backend ' + str(backend))
+# --------------------------------------------------------------------------------------------------------------------
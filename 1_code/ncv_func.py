@@ -0,0 +1,179 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# In-process nested cross-validation. Replaces one SGE task per seed (predict_symptoms_ncv.py) with a process pool
+# that loads the data once per worker and runs every seed (and combination of alg, metric and pheno) it is given.
+# Only depends on numpy, pandas and sklearn.
+
+# Essentials
+import time
+import numpy as np
+import multiprocessing as mp
+from joblib import Parallel, delayed
+
+# Sklearn
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import KFold
+from sklearn.linear_model import Ridge
+
+# Project
+from prediction_func import _as_array, get_scores_batch, get_fold_stats, get_X_folds_arr
+from solver_func import KernelCache, RidgePathCV
+from search_func import set_reg_params, grid_search_folds, halving_search_folds
+from split_func import get_split_plan, get_plan_cv, get_plan_inner_cv
+from pack_func import read_data
+
+# every score predict_symptoms_ncv.py records in best_scores.json
+score_keys = ['r2', 'mse', 'rmse', 'mae', 'corr']
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# nested cv
+def get_shuffle_idx(n, seed = 0):
+    # same row order as shuffle_data in predict_symptoms_ncv.py
+    np.random.seed(seed)
+    idx = np.arange(n)
+    np.random.shuffle(idx)
+    return idx
+
+
+def inner_search(X, y, reg, param_grid, scores = score_keys, n_splits = 10, search = 'grid', kernel_cache = None, my_cv = None):
+    # the search GridSearchCV(Pipeline(StandardScaler, reg), param_grid, cv = KFold(n_splits)) runs, scored on every
+    # score in one pass (see search_func). my_cv takes the folds from a split plan instead
+    if my_cv is None: my_cv = list(KFold(n_splits = n_splits, shuffle = False).split(X))
+    # one pass over X gives every fold's scaler (and, for Ridge, standardized Gram; see get_fold_stats)
+    fold_stats = get_fold_stats(X, my_cv, gram = type(reg) == Ridge)
+    X_folds = get_X_folds_arr(X = X, c = None, my_cv = my_cv, nuis = False, fold_stats = fold_stats)
+
+    if search == 'halving':
+        return halving_search_folds(X_folds, y, my_cv, reg, param_grid, scores = scores, kernel_cache = kernel_cache)
+    else:
+        return grid_search_folds(X_folds, y, my_cv, reg, param_grid, scores = scores, kernel_cache = kernel_cache, fold_stats = fold_stats)
+
+
+def get_best_index(result, scores):
+    return {s: int(np.argmin(result.cv_results_['rank_test_' + s])) for s in scores}
+
+
+def run_outer_fold(X, y, tr, te, reg, param_grid, scores, search_scores, n_splits, search, kernel_cache, inner_cv = None):
+    # inner search on one outer training fold, then each score's best candidate refit and scored on the outer test fold
+    fold_cache = kernel_cache.subset(tr) if kernel_cache is not None else None
+    result = inner_search(X[tr], y[tr], reg, param_grid, scores = search_scores, n_splits = n_splits, search = search, kernel_cache = fold_cache,
+                          my_cv = inner_cv)
+    best_index = get_best_index(result, scores)
+    nested_score = dict()
+
+    for idx in np.unique(list(best_index.values())):
+        idx_scores = [s for s in scores if best_index[s] == idx]
+        pipe = Pipeline(steps=[('standardize', StandardScaler()),
+                                ('reg', set_reg_params(reg, result.cv_results_['params'][idx]))])
+        pipe.fit(X[tr], y[tr])
+        y_pred = pipe.predict(X[te])
+        for s in idx_scores: nested_score[s] = get_scores_batch(y[te], y_pred, score = s)[0]
+
+    return nested_score
+
+
+def run_ncv(X, y, reg, param_grid, scores = ['corr',], n_splits = 10, search = 'grid', kernel_cache = None, n_jobs = 1,
+            outer_cv = None, inner_cvs = None):
+    # Nested CV on already shuffled X (n, p) and y (n,) arrays, for every selection score at once. Equivalent to
+    # GridSearchCV(Pipeline(StandardScaler, reg), cv = KFold(n_splits)) fit on the full sample plus
+    # cross_val_score(grid, cv = KFold(n_splits)), as in predict_symptoms_ncv.py, but:
+    #   - every inner fold evaluates the whole grid from one factorization or kernel (see search_func)
+    #   - the inner search is scored on all score_keys, so it is done once per outer fold and each score only picks
+    #     its own candidate from it (scores that agree share the refit)
+    #   - kernel_cache (an optional KernelCache/KernelView over the rows of X, approximate, see KernelCache) is
+    #     sub-indexed by every outer and inner fold instead of computing kernels per fold
+    #   - the outer folds and the full-sample search run on n_jobs threads (numpy, scipy and libsvm release the GIL,
+    #     and threads share kernel_cache without copying it)
+    # outer_cv and inner_cvs (one list of folds per outer fold) take the folds from a nested split plan (see
+    # split_func.get_plan_cv and get_plan_inner_cv) instead of KFold(n_splits).
+    # Returns, keyed on score, best_params and best_scores from the full-sample search and the outer fold scores,
+    # plus the full-sample search log for search = 'halving' (None otherwise).
+    search_scores = scores + [s for s in score_keys if s not in scores]
+    if outer_cv is None: outer_cv = list(KFold(n_splits = n_splits, shuffle = False).split(X))
+    if inner_cvs is None: inner_cvs = [None,] * len(outer_cv)
+
+    jobs = [delayed(run_outer_fold)(X, y, tr, te, reg, param_grid, scores, search_scores, n_splits, search, kernel_cache, inner_cv = inner_cv)
+            for (tr, te), inner_cv in zip(outer_cv, inner_cvs)]
+    # full sample search, as the refit grid in predict_symptoms_ncv.py. its folds are the outer folds
+    jobs.append(delayed(inner_search)(X, y, reg, param_grid, scores = search_scores, n_splits = n_splits, search = search, kernel_cache = kernel_cache,
+                                      my_cv = outer_cv))
+    out = Parallel(n_jobs = n_jobs, prefer = 'threads')(jobs)
+
+    nested_score = {s: np.array([out[k][s] for k in np.arange(n_splits)]) for s in scores}
+    result = out[-1]
+    best_index = get_best_index(result, scores)
+
+    best_params = {s: dict(result.cv_results_['params'][best_index[s]]) for s in scores}
+    best_scores = {s: {key: result.cv_results_['mean_test_' + key][best_index[s]] for key in score_keys} for s in scores}
+
+    if type(reg) == RidgePathCV:
+        # rr_gcv selects alpha internally; report the alpha it picks on the full sample
+        pipe = Pipeline(steps=[('standardize', StandardScaler()), ('reg', set_reg_params(reg, {}))])
+        pipe.fit(X, y)
+        for s in scores: best_params[s]['reg__alpha'] = float(pipe.named_steps['reg'].alpha_)
+
+    return best_params, best_scores, nested_score, getattr(result, 'search_log_', None)
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# process pool
+# data and full-sample kernel caches held by each worker, loaded once and shared by every task it runs
+_data = dict()
+_kernel_caches = dict()
+
+
+def init_worker(X_file, y_file):
+    # read_data keeps the parsed frames, so a packed worker (see pack_func.py) running several pools parses each file once
+    _data['X'] = read_data(X_file); _data['y'] = read_data(y_file)
+    _kernel_caches.clear()
+
+
+def run_ncv_task(task):
+    # one (alg, metric, pheno, seed) combination, for every score. task is a dict with keys alg, reg, param_grid,
+    # metric, pheno, seed, scores, n_splits, search and kernel_cache ('exact' or 'approx'), and optionally split_dir:
+    # the shuffle and outer/inner folds are then read from the seed's stored nested split plan (see split_func)
+    start = time.time()
+
+    X = _as_array(_data['X'].filter(regex = task['metric']))
+    y = _as_array(_data['y'].loc[:,task['pheno']])
+    if task.get('split_dir') is not None:
+        plan = get_split_plan(task['split_dir'], _data['y'].index, 'nested', seed = task['seed'], n_splits = task['n_splits'])
+        idx, outer_cv = get_plan_cv(plan)
+        inner_cvs = [get_plan_inner_cv(plan, k = k) for k in np.arange(len(outer_cv))]
+    else:
+        idx = get_shuffle_idx(y.shape[0], seed = task['seed'])
+        outer_cv = None; inner_cvs = None
+
+    kernel_cache = None
+    if task['kernel_cache'] == 'approx':
+        # one full-sample kernel per metric, indexed through each seed's shuffle
+        if task['metric'] not in _kernel_caches: _kernel_caches[task['metric']] = KernelCache(X, standardize = True)
+        kernel_cache = _kernel_caches[task['metric']].subset(idx)
+
+    best_params, best_scores, nested_score, _ = run_ncv(X[idx], y[idx], task['reg'], task['param_grid'], scores = task['scores'],
+                                                        n_splits = task['n_splits'], search = task['search'], kernel_cache = kernel_cache,
+                                                        outer_cv = outer_cv, inner_cvs = inner_cvs)
+
+    return {'alg': task['alg'], 'metric': task['metric'], 'pheno': task['pheno'], 'seed': task['seed'],
+            'best_params': best_params, 'best_scores': best_scores, 'nested_score': nested_score,
+            'run_time_seconds': time.time() - start}
+
+
+def run_ncv_pool(X_file, y_file, tasks, n_jobs = 1):
+    # runs tasks (see run_ncv_task) on n_jobs worker processes. tasks that share a metric should be adjacent so a
+    # worker gets them together and reuses its kernel cache; results come back in task order
+    if n_jobs == 1:
+        init_worker(X_file, y_file)
+        return [run_ncv_task(task) for task in tasks]
+
+    pool = mp.Pool(processes = n_jobs, initializer = init_worker, initargs = (X_file, y_file))
+    chunksize = max(int(np.ceil(len(tasks) / (4 * n_jobs))), 1)
+    results = pool.map(run_ncv_task, tasks, chunksize = chunksize)
+    pool.close(); pool.join()
+
+    return results
+# --------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,113 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# Job packing. Every cluster script exposes get_parser() and main(args), so one worker process (cluster/run_packed.py)
+# can run a batch of script invocations in-process, one after another or in a local pool: the interpreter start-up,
+# the pandas/scipy/sklearn imports and the parsing of each csv are then paid once per batch rather than once per task.
+# The task lists are written by job_func.pack_jobs. Only depends on pandas.
+
+# Essentials
+import os
+import sys
+import json
+import time
+import traceback
+import importlib.util
+import pandas as pd
+import multiprocessing as mp
+
+# inputs and cluster scripts already loaded by this process, keyed on file path
+_data = dict()
+_scripts = dict()
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# shared inputs
+def read_data(file):
+    # csv indexed on (bblid, scanid), parsed once per process and shared by every task that reads it. the frame is
+    # not copied, so callers take subsets (filter, loc) rather than modifying it in place
+    file = os.path.abspath(file)
+    if file not in _data:
+        df = pd.read_csv(file)
+        df.set_index(['bblid', 'scanid'], inplace = True)
+        _data[file] = df
+
+    return _data[file]
+
+
+def get_script(script):
+    # a cluster script imported as a module (its main() is not run on import), once per process. it is registered in
+    # sys.modules so its functions can be pickled for process pools
+    script = os.path.abspath(script)
+    if script not in _scripts:
+        name = os.path.splitext(os.path.basename(script))[0]
+        spec = importlib.util.spec_from_file_location(name, script)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        _scripts[script] = module
+
+    return _scripts[script]
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# tasks
+def load_tasks(task_file):
+    # one task per line, as json: name, script, argv (the script's command line arguments) and env (environment
+    # variables the script reads, e.g. SGE_TASK_ID for the seed of predict_symptoms_ncv.py)
+    f = open(task_file, 'r')
+    tasks = [json.loads(line) for line in f if line.strip() != '']
+    f.close()
+
+    return tasks
+
+
+def run_task(task):
+    # runs one task in this process: the script's main(args) is the whole job for one parsed command line, the same
+    # call its __main__ block makes when it is run on its own. a failing task is reported and does not stop the rest
+    # of the batch. the task's env is only set while it runs, so it never leaks into later tasks (or the worker's own
+    # SGE_TASK_ID)
+    start = time.time()
+    environ = dict(os.environ)
+    os.environ.update(task['env'])
+    try:
+        module = get_script(task['script'])
+        module.main(module.get_parser().parse_args(task['argv']))
+        ok = True
+    except (Exception, SystemExit):
+        traceback.print_exc()
+        ok = False
+    finally:
+        os.environ.clear(); os.environ.update(environ)
+    sys.stdout.flush()
+
+    return {'name': task['name'], 'ok': ok, 'run_time_seconds': time.time() - start}
+
+
+def preload(tasks):
+    # imports every script and parses every input file the tasks read, so pool workers forked afterwards share them
+    # tasks that fail here are skipped; run_task reports their error
+    for task in tasks:
+        try:
+            module = get_script(task['script'])
+            args = module.get_parser().parse_args(task['argv'])
+            for key in ['X_file', 'y_file', 'c_file']:
+                if getattr(args, key, None) is not None: read_data(getattr(args, key))
+        except (Exception, SystemExit):
+            continue
+
+
+def run_tasks(tasks, n_jobs = 1):
+    # runs tasks (see load_tasks) in order, or on n_jobs forked worker processes. tasks that start process pools of
+    # their own (-n_jobs > 1) should be run with n_jobs = 1, as pool workers can't have children. results (name, ok,
+    # run_time_seconds) come back in task order
+    preload(tasks)
+    if n_jobs == 1: return [run_task(task) for task in tasks]
+
+    pool = mp.get_context('fork').Pool(processes = n_jobs)
+    results = pool.map(run_task, tasks, chunksize = 1)
+    pool.close(); pool.join()
+
+    return results
+# --------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,201 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# Parcellation registry. Label metadata (parcel names, cortex/subcortex vectors) and path templates for every
+# parcellation are loaded lazily, memoized, and can be dumped to a single binary file that cluster workers load
+# at startup instead of re-reading the label text files. Nothing in here touches os.environ.
+
+# Essentials
+import os
+import pickle
+import numpy as np
+
+projdir = '/Users/lindenmp/Google-Drive-Penn/work/research_projects/neurodev_cs_predictive'
+derivsdir = '/Volumes/work_ssd/research_data/PNC/'
+
+# parcellations and scales we have labels for
+parc_scales = {'schaefer': [200, 400],
+                'lausanne': [125, 250],
+                'glasser': [360]}
+
+
+def get_proj_dirs(projdir = projdir, derivsdir = derivsdir):
+    # project level directories (previously exported by set_proj_env)
+    proj_dirs = {'PROJDIR': projdir,
+                'DATADIR': os.path.join(projdir, '0_data'),
+                'DERIVSDIR': os.path.join(derivsdir),
+                'PIPELINEDIR': os.path.join(projdir, '2_pipeline'),
+                'OUTPUTDIR': os.path.join(projdir, '3_output')}
+
+    return proj_dirs
+
+
+class Parcellation(object):
+    # Label metadata for one parcellation at one scale. Text files are only read on first access.
+
+    def __init__(self, parc_str = 'schaefer', parc_scale = 200, projdir = projdir, derivsdir = derivsdir):
+        self.parc_str = parc_str
+        self.parc_scale = parc_scale
+        self.projdir = projdir
+        self.derivsdir = derivsdir
+        self._parcel_names = None
+        self._parcel_loc = None
+        self._paths = dict()
+
+    def _label_file(self, suffix = ''):
+        labeldir = os.path.join(self.projdir, 'figs_support/labels')
+        if self.parc_str == 'schaefer':
+            return os.path.join(labeldir, 'schaefer' + str(self.parc_scale) + 'NodeNames' + suffix + '.txt')
+        elif self.parc_str == 'lausanne':
+            return os.path.join(labeldir, 'lausanne_' + str(self.parc_scale) + suffix + '.txt')
+        else:
+            return os.path.join(labeldir, 'glasser' + str(self.parc_scale) + 'NodeNames' + suffix + '.txt')
+
+    @property
+    def parcel_names(self):
+        # Names of parcels
+        if self._parcel_names is None:
+            self._parcel_names = np.genfromtxt(self._label_file(), dtype='str')
+        return self._parcel_names
+
+    @property
+    def parcel_loc(self):
+        # vector describing whether rois belong to cortex (1), subcortex (0) or brainstem (2)
+        if self._parcel_loc is None:
+            if self.parc_str == 'glasser':
+                self._parcel_loc = []
+            else:
+                self._parcel_loc = np.loadtxt(self._label_file(suffix = '_loc'), dtype='int')
+        return self._parcel_loc
+
+    @property
+    def num_parcels(self):
+        if len(self.parcel_names)>0:
+            return self.parcel_names.shape[0]
+        elif self.parc_str == 'glasser':
+            return 360
+        else:
+            return []
+
+    @property
+    def cortex_mask(self):
+        # glasser is cortex only and has no _loc file
+        if len(self.parcel_loc) == 0: return np.ones(self.num_parcels).astype(bool)
+        return self.parcel_loc == 1
+
+    @property
+    def subcortex_mask(self):
+        if len(self.parcel_loc) == 0: return np.zeros(self.num_parcels).astype(bool)
+        return self.parcel_loc == 0
+
+    @property
+    def drop_parcels(self):
+        return []
+
+    def paths(self, edge_weight = 'streamlineCount'):
+        # path templates for structural connectivity and resting state time series
+        # copies are returned so callers can't change the cached templates
+        if edge_weight in self._paths:
+            return dict(self._paths[edge_weight])
+
+        parc_str = self.parc_str; parc_scale = self.parc_scale
+        paths = get_proj_dirs(projdir = self.projdir, derivsdir = self.derivsdir)
+        derivsdir = paths['DERIVSDIR']
+
+        if parc_str == 'schaefer':
+            paths['SCDIR'] = os.path.join(derivsdir, 'processedData/diffusion/deterministic_20171118')
+            paths['SC_NAME_TMP'] = 'bblid/*xscanid/tractography/connectivity/bblid_*xscanid_SchaeferPNC_' + str(parc_scale) + '_dti_' + edge_weight + '_connectivity.mat'
+            paths['CONN_STR'] = 'connectivity'
+
+            paths['RSTSDIR'] = os.path.join(derivsdir, 'processedData/restbold/restbold_201607151621')
+            if parc_scale == 200:
+                paths['RSTS_NAME_TMP'] = 'bblid/*xscanid/net/Schaefer' + str(parc_scale) + 'PNC/bblid_*xscanid_Schaefer' + str(parc_scale) + 'PNC_ts.1D'
+            elif parc_scale == 400:
+                paths['RSTS_NAME_TMP'] = 'bblid/*xscanid/net/SchaeferPNC/bblid_*xscanid_SchaeferPNC_ts.1D'
+        elif parc_str == 'glasser':
+            paths['SCDIR'] = os.path.join(derivsdir, 'processedData/diffusion/deterministic_dec2016', edge_weight, 'GlasserPNC')
+            paths['SC_NAME_TMP'] = 'scanid_' + edge_weight + '_GlasserPNC.mat'
+
+            if edge_weight == 'streamlineCount':
+                paths['CONN_STR'] = 'connectivity'
+            elif edge_weight == 'volNormStreamline':
+                paths['CONN_STR'] = 'volNorm_connectivity'
+
+            paths['RSTSDIR'] = os.path.join(derivsdir, 'processedData/restbold/restbold_201607151621')
+            paths['RSTS_NAME_TMP'] = 'bblid/*xscanid/net/GlasserPNC/bblid_*xscanid_GlasserPNC_ts.1D'
+        elif parc_str == 'lausanne':
+            paths['SCDIR'] = os.path.join(derivsdir, 'processedData/diffusion/deterministic_dec2016', edge_weight, 'LausanneScale' + str(parc_scale))
+            paths['SC_NAME_TMP'] = 'scanid_' + edge_weight + '_LausanneScale' + str(parc_scale) + '.mat'
+
+            if edge_weight == 'streamlineCount':
+                paths['CONN_STR'] = 'connectivity'
+            elif edge_weight == 'volNormStreamline':
+                paths['CONN_STR'] = 'volNorm_connectivity'
+
+            paths['RSTSDIR'] = os.path.join(derivsdir, 'processedData/restbold/restbold_201607151621')
+            paths['RSTS_NAME_TMP'] = 'bblid/*xscanid/net/Lausanne' + str(parc_scale) + '/bblid_*xscanid_Lausanne' + str(parc_scale) + '_ts.1D'
+
+        self._paths[edge_weight] = paths
+
+        return dict(paths)
+
+    def preload(self):
+        # force the label files to be read so the object can be serialized without file access later
+        self.parcel_names; self.parcel_loc
+        return self
+
+
+class ParcellationRegistry(object):
+    # Memoized collection of Parcellation objects keyed on (parc_str, parc_scale).
+
+    def __init__(self, projdir = projdir, derivsdir = derivsdir):
+        self.projdir = projdir
+        self.derivsdir = derivsdir
+        self._parcs = dict()
+
+    def get(self, parc_str = 'schaefer', parc_scale = 200):
+        key = (parc_str, int(parc_scale))
+        if key not in self._parcs:
+            self._parcs[key] = Parcellation(parc_str = parc_str, parc_scale = int(parc_scale), projdir = self.projdir, derivsdir = self.derivsdir)
+        return self._parcs[key]
+
+    def keys(self):
+        return list(self._parcs.keys())
+
+    def preload(self, parc_scales = parc_scales, edge_weights = ['streamlineCount', 'volNormStreamline']):
+        # read every label file once and build every path template
+        for parc_str in parc_scales.keys():
+            for parc_scale in parc_scales[parc_str]:
+                parc = self.get(parc_str, parc_scale).preload()
+                for edge_weight in edge_weights:
+                    parc.paths(edge_weight)
+        return self
+
+    def save(self, fname):
+        f = open(fname, 'wb')
+        pickle.dump(self, f, protocol = pickle.HIGHEST_PROTOCOL)
+        f.close()
+
+    @staticmethod
+    def load(fname):
+        f = open(fname, 'rb')
+        registry = pickle.load(f)
+        f.close()
+        return registry
+
+
+# module level registry shared by everything imported in this process
+_registry = None
+
+
+def get_registry(registry_file = None):
+    # returns the process-wide registry. if registry_file (or $PARC_REGISTRY) points to a saved registry it is loaded
+    # from there the first time, otherwise label files are read lazily as parcellations are requested.
+    global _registry
+    if _registry is None:
+        if registry_file is None: registry_file = os.environ.get('PARC_REGISTRY')
+        if registry_file is not None and os.path.exists(registry_file):
+            _registry = ParcellationRegistry.load(registry_file)
+        else:
+            _registry = ParcellationRegistry()
+    return _registry
@@ -0,0 +1,261 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# Permutation testing helpers shared by the cluster scripts. Only depends on numpy, pandas and sklearn.
+
+# Essentials
+import os
+import hashlib
+import numpy as np
+from joblib import Parallel, delayed
+
+# Project
+from prediction_func import _as_array, get_scores_batch, cross_val_score_nuis_arr, get_nuis_fold, _apply_nuis
+from solver_func import get_smoother, is_linear_smoother, has_kernel, get_kernel_folds, get_precomputed_reg
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# permutation indices
+def get_perm_idx(n, n_perm = 5000, seed = None, start = 0):
+    # (n_perm, n) permutation indices for permutations start, ..., start + n_perm - 1.
+    # seed = None: identical to the np.random.seed(i); np.random.shuffle(idx) loop the scripts have always used, but
+    # on a private RandomState(i) so the global state is never touched.
+    # seed = int: permutation i is drawn from its own generator, the i-th child of SeedSequence(seed). Children are
+    # addressed by spawn_key, so permutation i is the same however the permutations are chunked or distributed.
+    perm_idx = np.zeros((n_perm, n), dtype = int)
+
+    for j, i in enumerate(np.arange(start, start + n_perm)):
+        if seed is None:
+            idx = np.arange(n)
+            np.random.RandomState(i).shuffle(idx)
+        else:
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key = (int(i),)))
+            idx = rng.permutation(n)
+        perm_idx[j,:] = idx
+
+    return perm_idx
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# closed-form permutation testing
+def permute_linear_batch(y, my_cv, reg, X_folds, perm_idx, score = 'corr', c_y = None, nuis_mode = 'krr_rbf'):
+    # Permutation test for estimators that are linear in y (Ridge, KernelRidge) at fixed hyperparameters.
+    # Per fold, the train->test smoother S is built once from X_folds (see get_X_folds) and every permuted y is
+    # predicted with one matrix product: S @ Y_train, where Y is (n, n_perm). Returns the mean score over folds
+    # for each permutation, i.e. the same thing as the cross_val_score_nuis(...)[0].mean() loop. score can be a list
+    # of score names, in which case a dict of (n_perm,) arrays keyed on score is returned.
+    # If c_y is given, nuisance is regressed out of every permuted y as well (nuis_y in cross_val_score_nuis), on c_y
+    # permuted by the same index: each permuted y keeps its own covariates, as in the observed fit, so the y-side
+    # nuisance model (nuis_mode, see get_nuis_fold) is refit for every permutation.
+    y = _as_array(y)
+    Y = y[perm_idx.T]
+    if c_y is not None: c_y = _as_array(c_y)
+
+    if isinstance(score, str): score_names = [score,]
+    else: score_names = list(score)
+    accuracy = {s: np.zeros((len(my_cv), perm_idx.shape[0])) for s in score_names}
+
+    for k in np.arange(len(my_cv)):
+        tr = my_cv[k][0]
+        te = my_cv[k][1]
+
+        X_train, X_test = X_folds[k]
+        S = get_smoother(X_train, X_test, reg)
+
+        Y_train = Y[tr,:]; Y_test = Y[te,:]
+        if c_y is not None:
+            for j in np.arange(perm_idx.shape[0]):
+                nuis_fold = get_nuis_fold(c_y[perm_idx[j,tr]], c_y[perm_idx[j,te]], mode = nuis_mode)
+                _apply_nuis(nuis_fold, Y_train[:,j], Y_test[:,j])
+
+        Y_pred = np.dot(S, Y_train)
+        for s in score_names: accuracy[s][k,:] = get_scores_batch(Y_test, Y_pred, score = s)
+
+    if isinstance(score, str): return accuracy[score].mean(axis = 0)
+    else: return {s: accuracy[s].mean(axis = 0) for s in score_names}
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# general permutation testing
+def permute_loop(y, my_cv, reg, X_folds, perm_idx, score = 'corr', c_y = None, nuis_mode = 'krr_rbf'):
+    # Refits reg on every permuted y. Same inputs and outputs as permute_linear_batch, for estimators that aren't
+    # linear in y (Lasso, SVR). X_folds can hold precomputed kernels (see solver_func.get_kernel_folds).
+    y = _as_array(y)
+    if c_y is not None: c_y = _as_array(c_y)
+
+    if isinstance(score, str): score_names = [score,]
+    else: score_names = list(score)
+    accuracy = {s: np.zeros((perm_idx.shape[0],)) for s in score_names}
+
+    buffers = dict()
+    for i in np.arange(perm_idx.shape[0]):
+        acc, _ = cross_val_score_nuis_arr(X = None, y = y[perm_idx[i,:]], c = None, my_cv = my_cv, reg = reg,
+                                          my_scorer = score_names, c_y = None if c_y is None else c_y[perm_idx[i,:]],
+                                          buffers = buffers, X_folds = X_folds, nuis_mode = nuis_mode, nuis_y = c_y is not None)
+        for s in score_names: accuracy[s][i] = acc[s].mean()
+
+    if isinstance(score, str): return accuracy[score]
+    else: return accuracy
+
+
+def get_chunk_fingerprint(permute_fn, reg, n, start, stop, seed = None, nuis_y = False, checkpoint_key = None):
+    # short hash of everything a chunk of permutations depends on that the checkpoint directory name doesn't pin down:
+    # the null method, the estimator and its hyperparameters, the sample size, the chunk bounds and seed, y-side
+    # nuisance regression, and checkpoint_key (a dict of the caller's settings, e.g. nuis_mode or search)
+    params = reg.get_params(deep = False)
+    items = [permute_fn.__name__, type(reg).__name__, repr(sorted((key, repr(params[key])) for key in params.keys())),
+             int(n), int(start), int(stop), str(seed), bool(nuis_y)]
+    if checkpoint_key is not None: items.append(repr(sorted((key, repr(checkpoint_key[key])) for key in checkpoint_key.keys())))
+
+    return hashlib.sha1(repr(items).encode()).hexdigest()[:16]
+
+
+def _run_perm_chunk(permute_fn, y, my_cv, reg, X_folds, score_names, seed, start, stop, checkpoint_file, c_y = None, nuis_mode = 'krr_rbf',
+                    checkpoint_key = None):
+    # one chunk of permutations; reloaded from checkpoint_file if a previous run already finished it with the same
+    # settings (see get_chunk_fingerprint), recomputed otherwise
+    fingerprint = get_chunk_fingerprint(permute_fn, reg, len(y), start, stop, seed = seed, nuis_y = c_y is not None, checkpoint_key = checkpoint_key)
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        chunk = np.load(checkpoint_file)
+        if 'fingerprint' in chunk.files and str(chunk['fingerprint']) == fingerprint and all(s in chunk.files for s in score_names):
+            return {s: chunk[s] for s in score_names}
+
+    perm_idx = get_perm_idx(len(y), n_perm = stop - start, seed = seed, start = start)
+    accuracy = permute_fn(y = y, my_cv = my_cv, reg = reg, X_folds = X_folds, perm_idx = perm_idx, score = score_names, c_y = c_y,
+                           nuis_mode = nuis_mode)
+
+    if checkpoint_file is not None:
+        # write then rename, so a job killed mid-write never leaves a truncated chunk behind
+        tmp_file = checkpoint_file + '.tmp.npz'
+        np.savez(tmp_file, seed = str(seed), fingerprint = fingerprint, **accuracy)
+        os.replace(tmp_file, checkpoint_file)
+
+    return accuracy
+
+
+def permute_chunked(permute_fn, y, my_cv, reg, X_folds, n_perm = 5000, score = 'corr', seed = None, chunk_size = 250,
+                    n_jobs = 1, checkpoint_dir = None, start = 0, c_y = None, nuis_mode = 'krr_rbf', checkpoint_key = None):
+    # Runs permute_fn (permute_linear_batch or permute_loop) over n_perm permutations in chunks of chunk_size,
+    # distributed across n_jobs processes. Permutation indices come from get_perm_idx(seed = seed), so seed = None
+    # reproduces the legacy np.random.seed(i) nulls exactly. If checkpoint_dir is given, every finished chunk is
+    # saved there and a rerun (e.g., after the job was killed) only computes the chunks that are missing. A saved
+    # chunk is only reused if it was made with the same settings (see get_chunk_fingerprint); checkpoint_key adds the
+    # caller's settings that reg, y and c_y don't show.
+    # Returns the same as permute_fn on all n_perm permutations at once. With start > 0 only permutations
+    # start, ..., n_perm - 1 are run (used by permute_sequential to extend a null). c_y and nuis_mode are passed on
+    # to permute_fn (y-side nuisance regression).
+    y = _as_array(y)
+
+    if isinstance(score, str): score_names = [score,]
+    else: score_names = list(score)
+
+    if checkpoint_dir is not None and not os.path.exists(checkpoint_dir): os.makedirs(checkpoint_dir)
+
+    chunks = [(i, min(i + chunk_size, n_perm)) for i in np.arange(start, n_perm, chunk_size)]
+    out = Parallel(n_jobs = n_jobs)(delayed(_run_perm_chunk)(permute_fn, y, my_cv, reg, X_folds, score_names, seed, i, stop,
+                                                             None if checkpoint_dir is None else
+                                                             os.path.join(checkpoint_dir, 'perm_{0}_{1}.npz'.format(i, stop)), c_y, nuis_mode, checkpoint_key)
+                                    for i, stop in chunks)
+
+    accuracy = {s: np.concatenate([acc[s] for acc in out]) for s in score_names}
+
+    if isinstance(score, str): return accuracy[score]
+    else: return accuracy
+
+
+def get_perm_stats(permuted_acc, accuracy, n_perm = 5000):
+    # permutation p-value of accuracy (permuted_acc >= accuracy, as in the results notebooks), the number of
+    # permutations it rests on and the resolution that gives
+    n_exceed = int(np.sum(permuted_acc >= accuracy))
+
+    perm_stats = {'n_perm_used': len(permuted_acc),
+                  'n_exceed': n_exceed,
+                  'p_value': n_exceed / len(permuted_acc),
+                  'p_resolution': 1 / len(permuted_acc),
+                  'stopped_early': bool(len(permuted_acc) < n_perm)}
+
+    return perm_stats
+
+
+def permute_sequential(permute_fn, y, my_cv, reg, X_folds, accuracy, n_perm = 5000, h = 10, score = 'corr', seed = None,
+                       chunk_size = 100, n_jobs = 1, checkpoint_dir = None, c_y = None, nuis_mode = 'krr_rbf', checkpoint_key = None):
+    # Sequential Monte Carlo p-values (Besag & Clifford, 1991). Permutations are run in rounds of n_jobs * chunk_size
+    # and a score stops as soon as h permuted scores have reached its observed accuracy, since its p-value can then
+    # only be large; scores that are borderline or significant keep sampling up to n_perm. Rounds continue until every
+    # score has stopped.
+    # The null for each score is cut at the permutation that produced its h-th exceedance, so the usual
+    # np.sum(permuted_acc >= accuracy) / len(permuted_acc) gives the sequential p-value h / n_perm_used for a score
+    # that stopped early and is unchanged (g / n_perm) for one that didn't.
+    # accuracy is the observed score (a float, or a dict keyed on score). Returns the permuted accuracies (as
+    # permute_chunked) and a dict of stats per score: n_perm_used, n_exceed, p_value, p_resolution (1 / n_perm_used,
+    # the smallest difference in p the null can resolve) and stopped_early.
+    if isinstance(score, str): score_names = [score,]; accuracy = {score: accuracy}
+    else: score_names = list(score)
+
+    permuted_acc = {s: np.zeros((0,)) for s in score_names}
+    n_done = 0
+    while n_done < n_perm:
+        n_next = min(n_done + n_jobs * chunk_size, n_perm)
+        acc = permute_chunked(permute_fn, y = y, my_cv = my_cv, reg = reg, X_folds = X_folds, n_perm = n_next, score = score_names,
+                              seed = seed, chunk_size = chunk_size, n_jobs = n_jobs, checkpoint_dir = checkpoint_dir, start = n_done,
+                              c_y = c_y, nuis_mode = nuis_mode, checkpoint_key = checkpoint_key)
+        for s in score_names: permuted_acc[s] = np.concatenate((permuted_acc[s], acc[s]))
+        n_done = n_next
+
+        if all(np.sum(permuted_acc[s] >= accuracy[s]) >= h for s in score_names): break
+
+    perm_stats = dict()
+    for s in score_names:
+        exceed = np.where(permuted_acc[s] >= accuracy[s])[0]
+        if len(exceed) >= h: permuted_acc[s] = permuted_acc[s][:exceed[h-1]+1]
+        perm_stats[s] = get_perm_stats(permuted_acc[s], accuracy[s], n_perm = n_perm)
+
+    if isinstance(score, str): return permuted_acc[score], perm_stats[score]
+    else: return permuted_acc, perm_stats
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# shared permutation nulls
+def get_permute_fn(reg, X_folds, perm_mode = 'batch'):
+    # permute_linear_batch for estimators that are linear in y (if perm_mode = 'batch'), otherwise permute_loop with
+    # the train/test kernels computed once per fold for kernel estimators. Returns (permute_fn, reg, X_folds) to pass on.
+    if perm_mode == 'batch' and is_linear_smoother(reg):
+        return permute_linear_batch, reg, X_folds
+    elif has_kernel(reg):
+        return permute_loop, get_precomputed_reg(reg), get_kernel_folds(X_folds, reg)
+    else:
+        return permute_loop, reg, X_folds
+
+
+def _run_perm_model(y, my_cv, reg, X_folds, perm_idx, score_names, perm_mode, c_y = None, nuis_mode = 'krr_rbf'):
+    permute_fn, reg, X_folds = get_permute_fn(reg, X_folds, perm_mode = perm_mode)
+    return permute_fn(y = y, my_cv = my_cv, reg = reg, X_folds = X_folds, perm_idx = perm_idx, score = score_names, c_y = c_y,
+                      nuis_mode = nuis_mode)
+
+
+def permute_table(y, my_cv, regs, X_folds, perm_idx, score = 'corr', perm_mode = 'batch', n_jobs = 1, c_y = None, nuis_mode = 'krr_rbf'):
+    # Permutation nulls for every combination of estimator and feature set against one set of permutations.
+    # regs is a dict of estimators keyed on alg and X_folds a dict of fold lists (see get_X_folds) keyed on metric, so
+    # each metric's residualized folds are computed once and shared by every alg. perm_idx (see get_perm_idx) is
+    # generated once by the caller, so every null in the table is built from identical permuted y and the nulls are
+    # directly comparable across models. Models are spread across n_jobs processes. If c_y is given, nuisance is
+    # regressed out of every permuted y as well, on c_y permuted along with it (see permute_linear_batch).
+    # Returns a dict of (n_perm,) arrays keyed on (alg, score, metric).
+    y = _as_array(y)
+
+    if isinstance(score, str): score_names = [score,]
+    else: score_names = list(score)
+
+    models = [(alg, metric) for metric in X_folds for alg in regs]
+    out = Parallel(n_jobs = n_jobs)(delayed(_run_perm_model)(y, my_cv, regs[alg], X_folds[metric], perm_idx, score_names, perm_mode, c_y, nuis_mode)
+                                    for alg, metric in models)
+
+    permuted_acc = dict()
+    for (alg, metric), acc in zip(models, out):
+        for s in score_names: permuted_acc[(alg, s, metric)] = acc[s]
+
+    return permuted_acc
+# --------------------------------------------------------------------------------------------------------------------
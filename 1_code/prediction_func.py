@@ -0,0 +1,525 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# Prediction helpers shared by func.py, the results notebooks and the cluster scripts.
+# Only depends on numpy, scipy, pandas and sklearn so it can be imported in the cluster environment.
+
+# Essentials
+import os
+import numpy as np
+import pandas as pd
+
+# Stats
+import scipy as sp
+from scipy import stats
+
+from joblib import Parallel, delayed
+
+# Sklearn
+from sklearn.base import BaseEstimator, RegressorMixin, clone
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LinearRegression, Ridge
+from sklearn.kernel_ridge import KernelRidge
+from sklearn.metrics import make_scorer, r2_score, mean_squared_error, mean_absolute_error
+from sklearn.metrics.pairwise import pairwise_kernels
+
+# Project
+from split_func import make_split_plan, get_plan_cv
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# scoring functions
+def corr_true_pred(y_true, y_pred):
+    if type(y_true) == np.ndarray:
+        y_true = y_true.flatten()
+    if type(y_pred) == np.ndarray:
+        y_pred = y_pred.flatten()
+
+    r,p = sp.stats.pearsonr(y_true, y_pred)
+    return r
+
+
+def root_mean_squared_error(y_true, y_pred):
+    mse = np.mean((y_true - y_pred)**2, axis=0)
+    rmse = np.sqrt(mse)
+    return rmse
+
+
+def get_scorer(score = 'corr'):
+    # sklearn scorer for each of the score strings the scripts accept
+    if score == 'r2':
+        my_scorer = make_scorer(r2_score, greater_is_better = True)
+    elif score == 'corr':
+        my_scorer = make_scorer(corr_true_pred, greater_is_better = True)
+    elif score == 'mse':
+        my_scorer = make_scorer(mean_squared_error, greater_is_better = False)
+    elif score == 'rmse':
+        my_scorer = make_scorer(root_mean_squared_error, greater_is_better = False)
+    elif score == 'mae':
+        my_scorer = make_scorer(mean_absolute_error, greater_is_better = False)
+    else:
+        raise ValueError('get_scorer: unknown score ' + str(score))
+
+    return my_scorer
+
+
+# sign applied by make_scorer(..., greater_is_better) for each score
+score_signs = {'r2': 1, 'corr': 1, 'mse': -1, 'rmse': -1, 'mae': -1}
+
+
+def get_scores_batch(y_true, y_pred, score = 'corr'):
+    # column-wise scores for (n, m) y_true/y_pred, with the same sign convention as the scorers used in the
+    # scripts (i.e., errors are negated). A 1d y_true is broadcast against every column of y_pred.
+    if y_pred.ndim == 1: y_pred = y_pred[:,np.newaxis]
+    if y_true.ndim == 1: y_true = y_true[:,np.newaxis]
+    resid = y_true - y_pred
+
+    if score == 'corr':
+        yt = y_true - y_true.mean(axis = 0)
+        yp = y_pred - y_pred.mean(axis = 0)
+        out = np.sum(yt * yp, axis = 0) / np.sqrt(np.sum(yt**2, axis = 0) * np.sum(yp**2, axis = 0))
+        # undefined for constant predictions (e.g., a Lasso with every coefficient at zero), as in pearsonr
+        out[np.all(y_pred == y_pred[0], axis = 0)] = np.nan
+    elif score == 'r2':
+        ss_tot = np.sum((y_true - y_true.mean(axis = 0))**2, axis = 0)
+        out = 1 - np.sum(resid**2, axis = 0) / ss_tot
+    elif score == 'mse':
+        out = np.mean(resid**2, axis = 0)
+    elif score == 'rmse':
+        out = np.sqrt(np.mean(resid**2, axis = 0))
+    elif score == 'mae':
+        out = np.mean(np.abs(resid), axis = 0)
+    else:
+        raise ValueError('get_scores_batch: unknown score ' + str(score))
+
+    return score_signs[score] * out
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# cross-validation
+def get_stratified_cv(X, y, c = None, n_splits = 10, plan = None):
+    # sort data on outcome variable in ascending order and create custom stratified kfold on outcome variable: every
+    # n_splits-th sorted row is in the same test fold. plan (see split_func.get_split_plan(..., 'stratified'))
+    # takes the sort and folds from a stored split plan instead of making them here
+    if plan is None: plan = make_split_plan(y.shape[0], 'stratified', n_splits = n_splits, y = y)
+    order, my_cv = get_plan_cv(plan)
+
+    idx = y.index[order]
+    if X.ndim == 2: X_sort = X.loc[idx,:]
+    elif X.ndim == 1: X_sort = X.loc[idx]
+    y_sort = y.loc[idx]
+    if c is not None:
+        if c.ndim == 2: c_sort = c.loc[idx,:]
+        elif c.ndim == 1: c_sort = c.loc[idx]
+
+    if c is not None:
+        return X_sort, y_sort, my_cv, c_sort
+    else:
+        return X_sort, y_sort, my_cv
+
+
+def _as_array(x):
+    # contiguous float64 view/copy of a DataFrame, Series or array
+    if isinstance(x, (pd.DataFrame, pd.Series)): x = x.values
+    return np.ascontiguousarray(x, dtype = np.float64)
+
+
+def _get_buffer(buffers, key, shape):
+    # returns a (leading rows) view of a preallocated buffer, growing it if needed
+    buf = buffers.get(key)
+    if buf is None or buf.shape[0] < shape[0] or buf.shape[1:] != shape[1:]:
+        buf = np.empty(shape); buffers[key] = buf
+    return buf[:shape[0]]
+
+
+class _Prediction(RegressorMixin, BaseEstimator):
+    # stands in for a fitted estimator so an sklearn scorer reuses an existing prediction instead of predicting again
+    def __init__(self, y_pred):
+        self.y_pred = y_pred
+
+    def predict(self, X):
+        return self.y_pred
+
+
+# nuisance models the scripts can regress out: ols is the LinearRegression path that used to be commented out, krr_rbf
+# the KernelRidge(kernel='rbf') the scripts have always used
+nuis_modes = ['ols', 'ridge', 'krr_rbf']
+
+
+def get_nuis_fold(c_train, c_test, mode = 'krr_rbf', alpha = 1.0):
+    # Residual-forming matrices of a nuisance model fit on c_train. Every nuisance model here is linear in its target,
+    # so for any X (or y) the residuals are R_train @ X_train on the training rows and X_test - H_test @ X_train on the
+    # test rows. The matrices only depend on the covariates, so they are computed once per fold and shared by every
+    # feature set and by y (see _apply_nuis). Standardizes c_train and c_test in place.
+    #   ols: LinearRegression(), ridge: Ridge(alpha), krr_rbf: KernelRidge(kernel='rbf', alpha)
+    # Returns (R_train, H_test).
+    sc = StandardScaler(); sc.fit(c_train); sc.transform(c_train, copy = False); sc.transform(c_test, copy = False)
+    n = c_train.shape[0]
+
+    if mode == 'krr_rbf':
+        # gamma defaults to 1 / n_covariates and there is no intercept, as in KernelRidge. With A = K + alpha I, the
+        # fitted values are K A^-1 = I - alpha A^-1
+        K_train = pairwise_kernels(c_train, metric = 'rbf')
+        K_test = pairwise_kernels(c_test, c_train, metric = 'rbf')
+        K_train.flat[::n+1] += alpha
+        cho = sp.linalg.cho_factor(K_train, overwrite_a = True)
+        R_train = alpha * sp.linalg.cho_solve(cho, np.eye(n))
+        H_test = sp.linalg.cho_solve(cho, K_test.T).T
+    elif mode in ('ols', 'ridge'):
+        # with an intercept; c_train is centered, so the intercept is the training mean and the slopes are
+        # (c'c + alpha I)^-1 c' (alpha = 0 for ols)
+        G = np.dot(c_train.T, c_train)
+        if mode == 'ridge': G.flat[::G.shape[0]+1] += alpha
+        B = np.dot(sp.linalg.pinvh(G), c_train.T)
+        R_train = np.eye(n) - 1 / n - np.dot(c_train, B)
+        H_test = 1 / n + np.dot(c_test, B)
+    else:
+        raise ValueError('get_nuis_fold: unknown mode ' + str(mode))
+
+    return R_train, H_test
+
+
+def get_nuis_folds(c, my_cv, mode = 'krr_rbf'):
+    # get_nuis_fold for every fold of my_cv. Depends on the covariates and folds only, so it can be shared by every
+    # feature set (metric) that is residualized on the same folds, and by y
+    c = _as_array(c)
+    return [get_nuis_fold(c[tr], c[te], mode = mode) for tr, te in my_cv]
+
+
+def _apply_nuis(nuis_fold, X_train, X_test):
+    # in place: regress nuisance out of X (n, p) or y (n,) with matrices from get_nuis_fold
+    R_train, H_test = nuis_fold
+    X_test -= np.dot(H_test, X_train)
+    X_train[:] = np.dot(R_train, X_train)
+
+
+def get_fold_stats(X, my_cv, gram = False):
+    # Training-fold StandardScaler statistics for every fold from one pass over X. Column sums and sums of squares
+    # (and, if gram, X'X) are taken once on the full sample and each training fold's are the full-sample ones minus
+    # those of its (small) test fold. X is shifted by its full-sample mean first so the subtraction does not lose
+    # precision. Returns one dict per fold with the training 'mean' and 'scale' (zero-variance features get scale 1,
+    # as in StandardScaler) and, if gram, 'gram': the Gram matrix of the standardized training features, i.e.
+    # X_train' X_train after StandardScaler (see get_ridge_gram_path).
+    X = _as_array(X)
+    shift = X.mean(axis = 0)
+    X = X - shift
+    S = X.sum(axis = 0); Q = np.einsum('ij,ij->j', X, X)
+    if gram: G = np.dot(X.T, X)
+
+    fold_stats = []
+    for tr, te in my_cv:
+        X_test = X[te]; n_train = len(tr)
+        mean = (S - X_test.sum(axis = 0)) / n_train
+        var = np.maximum((Q - np.einsum('ij,ij->j', X_test, X_test)) / n_train - mean**2, 0)
+        scale = np.sqrt(var)
+        scale[scale < 10 * np.finfo(np.float64).eps * np.maximum(np.abs(mean + shift), 1)] = 1
+        stats = {'mean': mean + shift, 'scale': scale}
+
+        if gram:
+            G_train = G - np.dot(X_test.T, X_test) - n_train * np.outer(mean, mean)
+            stats['gram'] = G_train / np.outer(scale, scale)
+        fold_stats.append(stats)
+
+    return fold_stats
+
+
+def _standardize_nuis(X_train, X_test, c_train = None, c_test = None, nuis_fold = None, X_stats = None):
+    # in place: standardize predictors and, if covariates are given, standardize them and regress them out of X.
+    # nuis_fold (see get_nuis_fold) stands in for c_train/c_test when the nuisance model is already computed.
+    # X_stats (see get_fold_stats) holds the training mean and scale, so StandardScaler does not have to be fit
+
+    # standardize predictors
+    if X_stats is not None:
+        X_train -= X_stats['mean']; X_train /= X_stats['scale']
+        X_test -= X_stats['mean']; X_test /= X_stats['scale']
+    else:
+        sc = StandardScaler(); sc.fit(X_train); sc.transform(X_train, copy = False); sc.transform(X_test, copy = False)
+
+    if nuis_fold is not None:
+        _apply_nuis(nuis_fold, X_train, X_test)
+    elif c_train is not None:
+        # standardize covariates
+        sc = StandardScaler(); sc.fit(c_train); sc.transform(c_train, copy = False); sc.transform(c_test, copy = False)
+
+        # regress nuisance (X)
+        # nuis_reg = LinearRegression(); nuis_reg.fit(c_train, X_train)
+        nuis_reg = KernelRidge(kernel='rbf'); nuis_reg.fit(c_train, X_train)
+        X_train -= nuis_reg.predict(c_train)
+        X_test -= nuis_reg.predict(c_test)
+
+
+def _fit_predict(reg, X_train, y_train, X_test):
+    # fit and predict. A 2d y_train (n, k) holds several phenotypes: estimators that solve every column with the same
+    # factorization (Ridge, KernelRidge) fit them as one multi-output problem, the rest are fit one column at a time.
+    # predictions keep y_train's trailing axis (Ridge drops it for a single column)
+    if y_train.ndim == 1 or type(reg) in (LinearRegression, Ridge, KernelRidge):
+        reg.fit(X_train, y_train)
+        return reg.predict(X_test).reshape((X_test.shape[0],) + y_train.shape[1:])
+    else:
+        y_pred = np.zeros((X_test.shape[0], y_train.shape[1]))
+        for j in np.arange(y_train.shape[1]):
+            reg.fit(X_train, y_train[:,j])
+            y_pred[:,j] = reg.predict(X_test)
+        return y_pred
+
+
+def get_X_folds_arr(X, c, my_cv, nuis = True, nuis_folds = None, fold_stats = None):
+    # standardized (and, if nuis, nuisance-residualized) X_train/X_test for every fold. None of this depends on y,
+    # so permutation loops compute it once and pass it to cross_val_score_nuis via X_folds.
+    # nuis_folds (see get_nuis_folds) reuses covariate kernels that were factored for another feature set; c is
+    # then not used. The scaler statistics of all folds come from one pass over X (see get_fold_stats); fold_stats
+    # passes in ones that were already computed (e.g., with gram = True for get_ridge_gram_path).
+    X_folds = []
+    if fold_stats is None: fold_stats = get_fold_stats(X, my_cv)
+
+    for k in np.arange(len(my_cv)):
+        tr = my_cv[k][0]
+        te = my_cv[k][1]
+
+        X_train = X[tr]; X_test = X[te]
+        if nuis and nuis_folds is not None: _standardize_nuis(X_train, X_test, nuis_fold = nuis_folds[k], X_stats = fold_stats[k])
+        elif nuis: _standardize_nuis(X_train, X_test, c[tr], c[te], X_stats = fold_stats[k])
+        else: _standardize_nuis(X_train, X_test, X_stats = fold_stats[k])
+        X_folds.append((X_train, X_test))
+
+    return X_folds
+
+
+def get_X_folds(X, c, my_cv, nuis = True, nuis_folds = None, fold_stats = None):
+    if c is not None: c = _as_array(c)
+    return get_X_folds_arr(X = _as_array(X), c = c, my_cv = my_cv, nuis = nuis, nuis_folds = nuis_folds, fold_stats = fold_stats)
+
+
+def cross_val_score_nuis_arr(X, y, c, my_cv, reg, my_scorer, c_y = None, buffers = None, X_folds = None,
+                             nuis_mode = 'krr_rbf', nuis_y = False, nuis_folds = None, artifacts = None):
+    # ndarray core of cross_val_score_nuis. X (n, p), y (n,) and c (n, q) are contiguous float arrays.
+    # Train/test splits are gathered into preallocated buffers that are reused across folds, and across calls
+    # if the same buffers dict is passed in again. If X_folds (see get_X_folds) is given, the per-fold
+    # standardization and nuisance regression are skipped entirely and X/c are not touched. Otherwise the scaler
+    # statistics of all folds come from one pass over X (see get_fold_stats).
+    # my_scorer is either an sklearn scorer, a score name ('corr', 'rmse', ...) or a list of score names. The
+    # estimator predicts once per fold and every score is computed from that prediction; for a list of names
+    # accuracy is returned as a dict of (n_splits,) arrays keyed on score.
+    # y can also be (n, k), one column per phenotype (score names only): the X-side work is done once per fold for
+    # all phenotypes (see _fit_predict) and accuracy arrays are (n_splits, k).
+    # nuis_mode picks the nuisance model (see nuis_modes and get_nuis_fold); nuis_folds, from get_nuis_folds, reuses
+    # precomputed residual-forming matrices instead. If nuis_y, nuisance is also regressed out of y_train/y_test
+    # (and scores are computed on the residualized y_test), using c_y as covariates if given and c otherwise.
+    # artifacts, if a dict, is filled with what each fold fit (see get_fold_artifact) under 'folds' and the
+    # out-of-fold y the scores were computed on under 'y_true', for save_fold_artifacts.
+    if buffers is None: buffers = dict()
+
+    if isinstance(my_scorer, str): score_names = [my_scorer,]
+    elif isinstance(my_scorer, (list, tuple)): score_names = list(my_scorer)
+    else: score_names = None
+
+    if score_names is None: accuracy = np.zeros(len(my_cv),)
+    else: accuracy = {s: np.zeros((len(my_cv),) + y.shape[1:]) for s in score_names}
+    y_pred_out = np.zeros(y.shape)
+    if X_folds is None: fold_stats = get_fold_stats(X, my_cv)
+    if artifacts is not None:
+        artifacts['folds'] = []; artifacts['y_true'] = np.zeros(y.shape)
+        if X_folds is None and c is not None: c_stats = get_fold_stats(c, my_cv)
+
+    for k in np.arange(len(my_cv)):
+        tr = my_cv[k][0]
+        te = my_cv[k][1]
+
+        # Split into train test
+        y_train = y[tr]; y_test = y[te]
+        if X_folds is not None:
+            X_train, X_test = X_folds[k]
+        else:
+            X_train = _get_buffer(buffers, 'X_train', (len(tr), X.shape[1])); np.take(X, tr, axis = 0, out = X_train)
+            X_test = _get_buffer(buffers, 'X_test', (len(te), X.shape[1])); np.take(X, te, axis = 0, out = X_test)
+            c_train = _get_buffer(buffers, 'c_train', (len(tr), c.shape[1])); np.take(c, tr, axis = 0, out = c_train)
+            c_test = _get_buffer(buffers, 'c_test', (len(te), c.shape[1])); np.take(c, te, axis = 0, out = c_test)
+
+        nuis_fold = None if nuis_folds is None else nuis_folds[k]
+        if X_folds is None:
+            # standardize and regress nuisance (X)
+            if nuis_fold is None and (nuis_mode != 'krr_rbf' or (nuis_y and c_y is None)):
+                nuis_fold = get_nuis_fold(c_train, c_test, mode = nuis_mode)
+            _standardize_nuis(X_train, X_test, c_train, c_test, nuis_fold = nuis_fold, X_stats = fold_stats[k])
+
+        # regress nuisance (y)
+        if nuis_y:
+            if c_y is not None:
+                nuis_fold = get_nuis_fold(c_y[tr], c_y[te], mode = nuis_mode)
+            elif nuis_fold is None:
+                nuis_fold = get_nuis_fold(c[tr], c[te], mode = nuis_mode)
+            _apply_nuis(nuis_fold, y_train, y_test)
+
+        y_pred = _fit_predict(reg, X_train, y_train, X_test)
+        y_pred_out[te] = y_pred
+
+        if artifacts is not None:
+            if X_folds is None and c is not None:
+                fold = get_fold_artifact(reg, X_stats = fold_stats[k], c_stats = c_stats[k], nuis_mode = nuis_mode, X_resid = X_train,
+                                         X_orig = X[tr], c_orig = c[tr])
+            else:
+                fold = get_fold_artifact(reg)
+            artifacts['folds'].append(fold); artifacts['y_true'][te] = y_test
+
+        if score_names is None:
+            accuracy[k] = my_scorer(_Prediction(y_pred), X_test, y_test)
+        elif y.ndim == 1:
+            for s in score_names: accuracy[s][k] = get_scores_batch(y_test, y_pred, score = s)[0]
+        else:
+            for s in score_names: accuracy[s][k] = get_scores_batch(y_test, y_pred, score = s)
+
+    if isinstance(my_scorer, str): accuracy = accuracy[my_scorer]
+
+    return accuracy, y_pred_out
+
+
+def cross_val_score_nuis(X, y, c, my_cv, reg, my_scorer, c_y = None, buffers = None, X_folds = None,
+                         nuis_mode = 'krr_rbf', nuis_y = False, nuis_folds = None, artifacts = None):
+    # thin pandas wrapper around cross_val_score_nuis_arr. Rows are taken by position (my_cv holds integer indices),
+    # so no index alignment happens anywhere.
+    if c_y is not None: c_y = _as_array(c_y)
+    if c is not None: c = _as_array(c)
+    if X_folds is not None: X = None
+    else: X = _as_array(X)
+
+    return cross_val_score_nuis_arr(X = X, y = _as_array(y), c = c, my_cv = my_cv, reg = reg,
+                                    my_scorer = my_scorer, c_y = c_y, buffers = buffers, X_folds = X_folds,
+                                    nuis_mode = nuis_mode, nuis_y = nuis_y, nuis_folds = nuis_folds, artifacts = artifacts)
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# repeated cross-validation
+def get_repeated_cv(n, n_repeats = 100, n_splits = 10, plan = None):
+    # every repeat's shuffle and folds up front. Repeat i shuffles rows with np.random.seed(i), as shuffle_data in
+    # predict_symptoms_rcv_nuis.py always has, and splits the shuffled rows with an unshuffled KFold. plan (see
+    # split_func.get_split_plan(..., 'random')) takes them from a stored split plan instead. Returns
+    # shuffle_idx (n_repeats, n) and, per repeat, my_cv as positions into the shuffled rows.
+    if plan is None: plan = make_split_plan(n, 'random', n_splits = n_splits, n_repeats = n_repeats)
+    shuffle_idx = np.zeros((n_repeats, n), dtype = int)
+    my_cvs = []
+
+    for i in np.arange(n_repeats):
+        shuffle_idx[i,:], my_cv = get_plan_cv(plan, r = i)
+        my_cvs.append(my_cv)
+
+    return shuffle_idx, my_cvs
+
+
+def _fit_fold_nuis(X, y, c, train_idx, test_idx, reg, score_names, X_stats = None):
+    # one fold of cross_val_score_nuis_arr on rows train_idx/test_idx of X, y and c (in that order)
+    X_train = X[train_idx]; X_test = X[test_idx]
+    _standardize_nuis(X_train, X_test, c[train_idx], c[test_idx], X_stats = X_stats)
+
+    y_pred = _fit_predict(clone(reg), X_train, y[train_idx], X_test)
+
+    if y.ndim == 1: return y_pred, [get_scores_batch(y[test_idx], y_pred, score = s)[0] for s in score_names]
+    else: return y_pred, [get_scores_batch(y[test_idx], y_pred, score = s) for s in score_names]
+
+
+def repeated_cross_val_score_nuis(X, y, c, reg, scores, n_repeats = 100, n_splits = 10, n_jobs = 1, plan = None):
+    # repeated k-fold version of cross_val_score_nuis. The n_repeats * n_splits fold fits are independent, so they
+    # are all dispatched to one joblib pool instead of looping over repeats. Gives the same numbers as calling
+    # cross_val_score_nuis on each shuffled copy of the data.
+    # Returns accuracy, a dict keyed on score of (n_repeats, n_splits) arrays, y_pred_out_repeats (n, n_repeats),
+    # where column i is in repeat i's shuffled row order (as the scripts have always saved it), and shuffle_idx.
+    # The folds don't depend on y, so y can be (n, k) with one column per phenotype; every fold is then standardized
+    # and residualized once for all k, and accuracy and y_pred_out_repeats get a trailing phenotype axis.
+    # plan is a stored 'random' split plan (see get_repeated_cv).
+    X = _as_array(X); y = _as_array(y); c = _as_array(c)
+    if isinstance(scores, str): scores = [scores,]
+
+    shuffle_idx, my_cvs = get_repeated_cv(y.shape[0], n_repeats = n_repeats, n_splits = n_splits, plan = plan)
+    # scaler statistics for every fold of a repeat from one pass over X (see get_fold_stats)
+    fold_stats = [get_fold_stats(X, [(shuffle_idx[i][tr], shuffle_idx[i][te]) for tr, te in my_cvs[i]]) for i in np.arange(n_repeats)]
+
+    tasks = [(i, k) for i in np.arange(n_repeats) for k in np.arange(n_splits)]
+    out = Parallel(n_jobs = n_jobs)(delayed(_fit_fold_nuis)(X, y, c, shuffle_idx[i][my_cvs[i][k][0]],
+                                                            shuffle_idx[i][my_cvs[i][k][1]], reg, scores,
+                                                            X_stats = fold_stats[i][k])
+                                    for i, k in tasks)
+
+    accuracy = {s: np.zeros((n_repeats, n_splits) + y.shape[1:]) for s in scores}
+    y_pred_out_repeats = np.zeros((y.shape[0], n_repeats) + y.shape[1:])
+    for (i, k), (y_pred, acc) in zip(tasks, out):
+        y_pred_out_repeats[my_cvs[i][k][1],i] = y_pred
+        for j, s in enumerate(scores): accuracy[s][i,k] = acc[j]
+
+    return accuracy, y_pred_out_repeats, shuffle_idx
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# per-fold artifacts
+def get_fold_artifact(reg, X_stats = None, c_stats = None, nuis_mode = None, X_resid = None, X_orig = None, c_orig = None):
+    # What one fold fit, as a dict of arrays: the estimator's coefficients (coef_ and intercept_, for linear
+    # estimators) or dual weights (dual_coef_, and support_ and intercept_ for SVR) and, with X_stats/c_stats (see
+    # get_fold_stats), the X and covariate scalers. For the linear nuisance models (ols, ridge) the nuisance
+    # coefficients on the standardized covariates are recovered from the fold's nuisance fitted values (X_orig
+    # standardized, minus the residualized X_resid). The krr_rbf nuisance model's dual weights are n_train x p, so only
+    # its covariate scaler is kept; refitting it is one Cholesky per fold (see get_nuis_fold).
+    fold = dict()
+    for key in ['coef_', 'intercept_', 'dual_coef_', 'support_']:
+        # SVR raises on coef_ for non-linear kernels
+        if hasattr(reg, key): fold[key[:-1]] = np.asarray(getattr(reg, key))
+
+    if X_stats is not None: fold['x_mean'] = X_stats['mean']; fold['x_scale'] = X_stats['scale']
+    if c_stats is not None:
+        fold['c_mean'] = c_stats['mean']; fold['c_scale'] = c_stats['scale']
+        if nuis_mode in ('ols', 'ridge'):
+            X_fit = (X_orig - X_stats['mean']) / X_stats['scale'] - X_resid
+            c_std = (c_orig - c_stats['mean']) / c_stats['scale']
+            fold['nuis_coef'] = np.linalg.lstsq(c_std, X_fit - X_fit.mean(axis = 0), rcond = None)[0]
+
+    return fold
+
+
+def get_fold_artifact_file(outroot, alg, metric, pheno):
+    # one artifact file per alg, metric and pheno, shared by every score (the fits don't depend on the score)
+    return os.path.join(outroot, 'fold_artifacts', alg + '_' + metric + '_' + pheno + '.npz')
+
+
+def save_fold_artifacts(artifact_file, artifacts, y_pred, accuracy = None, plan = None, nuis_mode = None):
+    # One compressed .npz per model: every fold's arrays (from cross_val_score_nuis(..., artifacts = artifacts)) as
+    # <name>_<fold>, the out-of-fold predictions (y_pred) and the y they were scored against (y_true) in the row order
+    # of the fit, the fold scores as accuracy_<score> and, with plan (see split_func), the plan's row order (order)
+    # and test folds (test_fold), so rows map back to the input data.
+    data = {'y_pred': y_pred, 'y_true': artifacts['y_true'], 'n_splits': len(artifacts['folds'])}
+    for k, fold in enumerate(artifacts['folds']):
+        for key in fold.keys(): data[key + '_' + str(k)] = fold[key]
+    if accuracy is not None:
+        for s in accuracy.keys(): data['accuracy_' + s] = accuracy[s]
+    if plan is not None: data['order'] = plan[0,0]; data['test_fold'] = plan[0,1]
+    if nuis_mode is not None: data['nuis_mode'] = nuis_mode
+
+    np.savez_compressed(artifact_file, **data)
+
+
+def check_fold_artifacts(artifacts, order, nuis_mode = 'krr_rbf', n_features = None):
+    # True if artifacts (see load_fold_artifacts) can stand in for a fit the caller would make itself: fit on the
+    # rows in order (positions into the caller's y, in the order of the stratified folds, e.g. plan[0,0]), with the
+    # same nuisance model and, if n_features is given, on as many features (e.g. a parcel subset or a bin)
+    if artifacts is None or 'order' not in artifacts or not np.array_equal(artifacts['order'], order): return False
+    if artifacts.get('nuis_mode') != nuis_mode: return False
+    if n_features is not None and 'x_mean' in artifacts['folds'][0] and len(artifacts['folds'][0]['x_mean']) != n_features: return False
+
+    return True
+
+
+def load_fold_artifacts(artifact_file):
+    # what save_fold_artifacts stored, with the per-fold arrays as a list of dicts under 'folds' and the fold scores
+    # as a dict under 'accuracy'. None if artifact_file doesn't exist (e.g., the job predates saved artifacts)
+    if not os.path.exists(artifact_file): return None
+
+    data = np.load(artifact_file)
+    artifacts = {'folds': [dict() for k in np.arange(int(data['n_splits']))], 'accuracy': dict()}
+    for key in data.files:
+        name, _, k = key.rpartition('_')
+        if key.startswith('accuracy_'): artifacts['accuracy'][key[len('accuracy_'):]] = data[key]
+        elif name != '' and k.isdigit(): artifacts['folds'][int(k)][name] = data[key]
+        elif key == 'nuis_mode': artifacts[key] = str(data[key])
+        else: artifacts[key] = data[key]
+
+    return artifacts
+# --------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,300 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# Hyperparameter search over fixed folds, sharing per-fold work (standardization, kernels) across candidates.
+# Only depends on numpy, scipy and sklearn.
+
+# Essentials
+import copy
+import numpy as np
+
+# Stats
+import scipy as sp
+
+# Sklearn
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import KFold, ParameterGrid
+from sklearn.linear_model import Ridge, Lasso
+from sklearn.kernel_ridge import KernelRidge
+from sklearn.svm import SVR
+
+# Project
+from prediction_func import _as_array, get_scorer, get_scores_batch, get_X_folds, cross_val_score_nuis_arr
+from solver_func import get_kernel_folds, has_kernel, get_precomputed_reg, get_krr_path, get_ridge_path, get_ridge_gram_path, get_lasso_path, get_svr_path
+
+
+class SearchResult(object):
+    # the parts of a fitted GridSearchCV(refit = False) the scripts use: cv_results_, best_index_, best_params_ and
+    # best_score_ (the latter three for the first score)
+
+    def __init__(self, cv_results, scores):
+        self.cv_results_ = cv_results
+        self.best_index_ = int(np.argmin(cv_results['rank_test_' + scores[0]]))
+        self.best_params_ = cv_results['params'][self.best_index_]
+        self.best_score_ = cv_results['mean_test_' + scores[0]][self.best_index_]
+
+
+def set_reg_params(reg, params):
+    # copy of reg with Pipeline style params ({'reg__alpha': ...}) applied
+    new_reg = copy.deepcopy(reg)
+    new_reg.set_params(**{key.replace('reg__', ''): params[key] for key in params.keys()})
+    return new_reg
+
+
+def get_cv_results(params, accuracy, scores):
+    # GridSearchCV style cv_results_ from a list of candidate params and, per score, a (n_candidates, n_splits) array
+    cv_results = {'params': params}
+
+    for s in scores:
+        cv_results['split_test_' + s] = accuracy[s]
+        cv_results['mean_test_' + s] = accuracy[s].mean(axis = 1)
+        cv_results['std_test_' + s] = accuracy[s].std(axis = 1)
+        cv_results['rank_test_' + s] = get_rank(cv_results['mean_test_' + s])
+
+    return cv_results
+
+
+def get_rank(mean_test):
+    # 1 = best. candidates with an undefined score (e.g., corr of a constant prediction) rank last, as in GridSearchCV
+    if np.isnan(mean_test).all(): mean_test = np.zeros(mean_test.shape)
+    else: mean_test = np.nan_to_num(mean_test, nan = np.nanmin(mean_test) - 1)
+    return sp.stats.rankdata(-mean_test, method = 'min').astype(int)
+
+
+def get_candidate_folds(X_folds, my_cv, reg, kernel_cache = None, caches = None, folds = None):
+    # per-fold inputs for one candidate estimator: precomputed kernels for KernelRidge/SVR, the cached fold features
+    # otherwise. With kernel_cache (a full-sample KernelCache, see its notes on approximation) kernel blocks are taken
+    # by index from the one n x n matrix instead of the per-fold caches. folds optionally restricts this to a subset
+    # of fold indices.
+    if folds is None: folds = np.arange(len(my_cv))
+    if not has_kernel(reg):
+        return reg, [X_folds[k] for k in folds]
+
+    if kernel_cache is not None:
+        # the full-sample cache is standardized, so 'scale' and 'auto' both come to 1 / n_features
+        gamma = reg.gamma
+        if gamma in ('scale', 'auto') or gamma is None: gamma = 1.0 / kernel_cache.n_features
+        K_folds = []
+        for k in folds:
+            tr, te = my_cv[k]
+            K_folds.append((kernel_cache.get_block(tr, tr, kernel = reg.kernel, gamma = gamma),
+                            kernel_cache.get_block(te, tr, kernel = reg.kernel, gamma = gamma)))
+    else:
+        K_folds = get_kernel_folds(X_folds, reg, caches = caches, folds = folds)
+
+    return get_precomputed_reg(reg), K_folds
+
+
+def grid_search_folds(X_folds, y, my_cv, reg, param_grid, scores = ['corr',], kernel_cache = None, fold_stats = None):
+    # Exhaustive search over param_grid on fixed folds. X_folds are the standardized fold features (see
+    # get_X_folds(..., nuis = False)), so every candidate sees exactly what Pipeline(StandardScaler, reg) inside
+    # GridSearchCV(cv = my_cv) would see, without re-standardizing for every candidate. Kernel estimators share one
+    # KernelCache per fold across all candidates. fold_stats (see get_fold_stats(..., gram = True)) is passed on to
+    # grid_search_path. Returns a SearchResult.
+    path_param = get_path_param(reg)
+    if path_param is not None and isinstance(param_grid, dict) and path_param in param_grid:
+        return grid_search_path(X_folds, y, my_cv, reg, param_grid, scores = scores, kernel_cache = kernel_cache, fold_stats = fold_stats)
+
+    y = _as_array(y)
+    params = list(ParameterGrid(param_grid))
+    accuracy = {s: np.zeros((len(params), len(my_cv))) for s in scores}
+    caches = [None,] * len(my_cv)
+
+    for i, p in enumerate(params):
+        cand_reg, cand_folds = get_candidate_folds(X_folds, my_cv, set_reg_params(reg, p), kernel_cache = kernel_cache, caches = caches)
+        acc, _ = cross_val_score_nuis_arr(X = None, y = y, c = None, my_cv = my_cv, reg = cand_reg, my_scorer = scores, X_folds = cand_folds)
+        for s in scores: accuracy[s][i,:] = acc[s]
+
+    return SearchResult(get_cv_results(params, accuracy, scores), scores)
+
+
+def get_path_param(reg):
+    # the param whose whole grid grid_search_path evaluates from one factorization (or kernel) per fold, if any
+    if type(reg) in (Ridge, Lasso) or (type(reg) == KernelRidge and has_kernel(reg)):
+        return 'reg__alpha'
+    elif type(reg) == SVR and has_kernel(reg):
+        return 'reg__C'
+    else:
+        return None
+
+
+def grid_search_path(X_folds, y, my_cv, reg, param_grid, scores = ['corr',], kernel_cache = None, fold_stats = None):
+    # grid_search_folds for Ridge, KernelRidge and Lasso: for each setting of the other params (e.g., gamma) every
+    # fold is factorized once (thin SVD of the train features for Ridge, eigendecomposition of the train kernel for
+    # KernelRidge) and predictions for the whole reg__alpha grid come from that one factorization (see
+    # get_ridge_path, get_krr_path). Same results as refitting per alpha, to floating point rounding. Lasso runs one
+    # warm-started coordinate descent path per fold (see get_lasso_path), which agrees to within the solver tol.
+    # For SVR the path is over reg__C: the train/test kernel blocks for each gamma are taken once per fold and every
+    # C is fit on them (see get_svr_path). If fold_stats carries the standardized training Grams (see get_fold_stats),
+    # Ridge with an intercept uses them in place of the SVD when there are fewer features than training rows (see
+    # get_ridge_gram_path).
+    y = _as_array(y)
+    params = list(ParameterGrid(param_grid))
+    accuracy = {s: np.zeros((len(params), len(my_cv))) for s in scores}
+    caches = [None,] * len(my_cv)
+
+    path_param = get_path_param(reg)
+    other_grid = {key: param_grid[key] for key in param_grid.keys() if key != path_param}
+    for p in ParameterGrid(other_grid):
+        cand_idx = [i for i in np.arange(len(params)) if all(params[i][key] == p[key] for key in p.keys())]
+        alphas = [params[i][path_param] for i in cand_idx]
+        cand_reg, cand_folds = get_candidate_folds(X_folds, my_cv, set_reg_params(reg, p), kernel_cache = kernel_cache, caches = caches)
+
+        for k in np.arange(len(my_cv)):
+            tr = my_cv[k][0]
+            te = my_cv[k][1]
+
+            X_train, X_test = cand_folds[k]
+            if type(cand_reg) == KernelRidge: y_pred = get_krr_path(X_train, X_test, y[tr], alphas)
+            elif type(cand_reg) == SVR: y_pred = get_svr_path(X_train, X_test, y[tr], alphas, cand_reg)
+            elif type(cand_reg) == Lasso: y_pred = get_lasso_path(X_train, X_test, y[tr], alphas, fit_intercept = cand_reg.fit_intercept,
+                                                                    tol = cand_reg.tol, max_iter = cand_reg.max_iter)
+            elif fold_stats is not None and 'gram' in fold_stats[k] and cand_reg.fit_intercept and X_train.shape[1] < X_train.shape[0]:
+                y_pred = get_ridge_gram_path(fold_stats[k]['gram'], X_train, X_test, y[tr], alphas)
+            else: y_pred = get_ridge_path(X_train, X_test, y[tr], alphas, fit_intercept = cand_reg.fit_intercept)
+            for s in scores: accuracy[s][cand_idx,k] = get_scores_batch(y[te], y_pred, score = s)
+
+    return SearchResult(get_cv_results(params, accuracy, scores), scores)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# adaptive search
+def subsample_folds(cand_reg, cand_folds, cv_folds, frac, seed = 0):
+    # keep the same random frac of every training fold (test folds are untouched). precomputed kernels are
+    # sub-indexed on both axes of K_train and the columns of K_test
+    rng = np.random.RandomState(seed)
+    sub_folds = []; sub_cv = []
+
+    for k in np.arange(len(cv_folds)):
+        tr, te = cv_folds[k]
+        X_train, X_test = cand_folds[k]
+        sub = np.sort(rng.permutation(len(tr))[:int(np.ceil(frac * len(tr)))])
+
+        if getattr(cand_reg, 'kernel', None) == 'precomputed': sub_folds.append((X_train[np.ix_(sub, sub)], X_test[:,sub]))
+        else: sub_folds.append((X_train[sub], X_test))
+        sub_cv.append((tr[sub], te))
+
+    return sub_folds, sub_cv
+
+
+def get_refine_grid(param_grid, best_params):
+    # incumbent plus the geometric midpoints to its neighbours on each positive numeric (i.e., logspace) grid axis
+    refine_grid = dict()
+
+    for key in param_grid.keys():
+        v = best_params[key]
+        values = np.sort(np.asarray(param_grid[key]))
+        refine_grid[key] = [v,]
+        if not np.issubdtype(values.dtype, np.number) or np.any(values <= 0): continue
+
+        i = int(np.argmin(np.abs(values - v)))
+        if i > 0: refine_grid[key].append(np.sqrt(values[i-1] * v))
+        if i < len(values) - 1: refine_grid[key].append(np.sqrt(values[i+1] * v))
+
+    return refine_grid
+
+
+def halving_search_folds(X_folds, y, my_cv, reg, param_grid, scores = ['corr',], factor = 3, min_folds = 1, min_frac = 1/3,
+                            refine = False, kernel_cache = None):
+    # Successive halving over folds and training subsamples as an alternative to grid_search_folds. Every candidate
+    # starts on min_folds folds, each trained on a random min_frac of its training fold; after each round the best
+    # 1/factor (on the first score) go on, with factor times as many folds and factor times the training fraction,
+    # until the survivors are evaluated on every fold with full training folds. With refine, the geometric
+    # midpoints around the incumbent on each logspace axis are then evaluated on every fold as well.
+    # Returns a SearchResult whose cv_results_ hold the fully evaluated candidates; search_log_ lists every
+    # evaluated point (round, n_folds, train_frac, params and mean score). Candidate selection uses scores[0] only.
+    # Training fractions much below 1/3 bias selection towards hyperparameters suited to small samples.
+    y = _as_array(y)
+    n_splits = len(my_cv)
+    caches = [None,] * n_splits
+
+    def evaluate(p, n_folds, frac):
+        folds = np.arange(n_folds)
+        cand_reg, cand_folds = get_candidate_folds(X_folds, my_cv, set_reg_params(reg, p), kernel_cache = kernel_cache, caches = caches, folds = folds)
+        cv_folds = [my_cv[k] for k in folds]
+        if frac < 1: cand_folds, cv_folds = subsample_folds(cand_reg, cand_folds, cv_folds, frac)
+        acc, _ = cross_val_score_nuis_arr(X = None, y = y, c = None, my_cv = cv_folds, reg = cand_reg, my_scorer = scores, X_folds = cand_folds)
+        return acc
+
+    candidates = list(ParameterGrid(param_grid))
+    n_rounds = max(int(np.ceil(np.log(len(candidates)) / np.log(factor))) - 1, 0)
+    search_log = []; final = dict()
+
+    r = 0
+    while True:
+        n_folds = int(min(n_splits, np.ceil(min_folds * factor**r)))
+        frac = float(min(1, max(min_frac, factor**float(r - n_rounds))))
+
+        mean_test = np.zeros(len(candidates))
+        for i, p in enumerate(candidates):
+            acc = evaluate(p, n_folds, frac)
+            mean_test[i] = acc[scores[0]].mean()
+            search_log.append({'iter': r, 'n_folds': n_folds, 'train_frac': frac, 'params': p, 'mean_test_' + scores[0]: mean_test[i]})
+            if n_folds == n_splits and frac == 1: final[i] = acc
+
+        if n_folds == n_splits and frac == 1: break
+        keep = np.argsort(get_rank(mean_test), kind = 'stable')[:int(np.ceil(len(candidates) / factor))]
+        candidates = [candidates[i] for i in keep]
+        r += 1
+
+    params = [candidates[i] for i in final.keys()]
+    accuracy = {s: np.array([final[i][s] for i in final.keys()]) for s in scores}
+
+    if refine and isinstance(param_grid, dict):
+        best_params = params[int(np.argmin(get_rank(accuracy[scores[0]].mean(axis = 1))))]
+        for p in ParameterGrid(get_refine_grid(param_grid, best_params)):
+            if p == best_params: continue
+            acc = evaluate(p, n_splits, 1)
+            search_log.append({'iter': r + 1, 'n_folds': n_splits, 'train_frac': 1.0, 'params': p, 'mean_test_' + scores[0]: acc[scores[0]].mean()})
+            params.append(p)
+            for s in scores: accuracy[s] = np.vstack((accuracy[s], acc[s]))
+
+    result = SearchResult(get_cv_results(params, accuracy, scores), scores)
+    result.search_log_ = search_log
+
+    return result
+
+
+class FoldSearchCV(RegressorMixin, BaseEstimator):
+    # Estimator stand-in for GridSearchCV(Pipeline([('standardize', StandardScaler()), ('reg', reg)]), param_grid,
+    # cv = KFold(n_splits), scoring = scores, refit = scores[0]) that runs grid_search_folds (search = 'grid') or
+    # halving_search_folds (search = 'halving') on the inner folds, so it can go straight into cross_val_score for
+    # nested CV. score() uses scores[0], like GridSearchCV with refit on the first scorer.
+
+    def __init__(self, reg, param_grid, n_splits = 10, scores = ['corr',], search = 'grid', refine = False):
+        self.reg = reg
+        self.param_grid = param_grid
+        self.n_splits = n_splits
+        self.scores = scores
+        self.search = search
+        self.refine = refine
+
+    def fit(self, X, y):
+        my_cv = list(KFold(n_splits = self.n_splits, shuffle = False).split(X))
+        X_folds = get_X_folds(X = X, c = None, my_cv = my_cv, nuis = False)
+
+        if self.search == 'halving':
+            result = halving_search_folds(X_folds, y, my_cv, self.reg, self.param_grid, scores = self.scores, refine = self.refine)
+            self.search_log_ = result.search_log_
+        else:
+            result = grid_search_folds(X_folds, y, my_cv, self.reg, self.param_grid, scores = self.scores)
+
+        self.cv_results_ = result.cv_results_
+        self.best_index_ = result.best_index_
+        self.best_params_ = result.best_params_
+        self.best_score_ = result.best_score_
+
+        self.best_estimator_ = Pipeline(steps=[('standardize', StandardScaler()),
+                                                ('reg', set_reg_params(self.reg, self.best_params_))])
+        self.best_estimator_.fit(X, y)
+
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def score(self, X, y):
+        return get_scorer(self.scores[0])(self, X, y)
+# --------------------------------------------------------------------------------------------------------------------
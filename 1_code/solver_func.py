@@ -0,0 +1,346 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# Closed-form solvers for the estimators in get_reg. Only depends on numpy, scipy and sklearn.
+
+# Essentials
+import copy
+import numpy as np
+
+# Project
+from prediction_func import get_scores_batch
+
+# Stats
+import scipy as sp
+from scipy import linalg
+
+# Sklearn
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import Ridge, lasso_path
+from sklearn.kernel_ridge import KernelRidge
+from sklearn.svm import SVR
+from sklearn.metrics.pairwise import pairwise_kernels
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# kernel cache
+class KernelCache(object):
+    # Squared euclidean distances and inner products for one feature matrix X (n, p), computed once for all n x n
+    # pairs. Kernels for any gamma are derived from those and memoized, and fold train/test blocks are served by
+    # index. With ~1,000 subjects each n x n matrix is ~8 MB.
+    #
+    # The cache is exact for the features it is given. Two ways to use it with per-fold standardization:
+    #   get_kernel_folds(X_folds, ...): one cache per fold built from that fold's standardized (and residualized)
+    #       X_train/X_test (see get_X_folds). Exact; reused for every gamma, alpha, C and permutation.
+    #   KernelCache(X, standardize = True): X is standardized once on the full sample and a single n x n matrix
+    #       serves every fold, including GridSearchCV's. Approximate: per-fold StandardScaler's mean shift cancels
+    #       in the rbf distances, and the linear kernel is centred on each fold's training mean in get_block, but
+    #       the scaling is not redone, so each feature is off by sigma_full / sigma_train (close to 1 when train
+    #       folds are 90% of the sample).
+
+    def __init__(self, X, standardize = False):
+        X = np.ascontiguousarray(X, dtype = np.float64)
+        if standardize: X = StandardScaler().fit_transform(X)
+        self.standardize = standardize
+        self.n_features = X.shape[1]
+
+        self.gram = np.dot(X, X.T)
+        sq_norms = np.diag(self.gram).copy()
+        self.sqdist = -2 * self.gram
+        self.sqdist += sq_norms[:,np.newaxis]
+        self.sqdist += sq_norms[np.newaxis,:]
+        np.maximum(self.sqdist, 0, out = self.sqdist)
+        self.sqdist[np.diag_indices_from(self.sqdist)] = 0
+
+        self._kernels = dict()
+
+    def get_kernel(self, kernel = 'rbf', gamma = None):
+        # full n x n kernel; gamma = None follows sklearn (1 / n_features)
+        if kernel == 'linear':
+            return self.gram
+        elif kernel == 'rbf':
+            if gamma is None: gamma = 1.0 / self.n_features
+            if gamma not in self._kernels:
+                self._kernels[gamma] = np.exp(-gamma * self.sqdist)
+            return self._kernels[gamma]
+        else:
+            raise ValueError('KernelCache: unsupported kernel ' + str(kernel))
+
+    def get_block(self, rows, cols, kernel = 'rbf', gamma = None):
+        # cols are the training rows of a fold (K_train is (tr, tr), K_test is (te, tr))
+        K = self.get_kernel(kernel = kernel, gamma = gamma)
+        if kernel == 'linear' and self.standardize:
+            # inner products aren't shift invariant and KernelRidge has no intercept, so centre the features on the
+            # training rows' mean as per-fold standardization would: K - 1m' - m1' + mm', from means over cols
+            K_cols = K[np.ix_(cols, cols)]
+            K_block = K[np.ix_(rows, cols)]
+            return K_block - K_block.mean(axis = 1)[:,np.newaxis] - K_cols.mean(axis = 0)[np.newaxis,:] + K_cols.mean()
+
+        return K[np.ix_(rows, cols)]
+
+    def subset(self, idx):
+        return KernelView(self, idx)
+
+
+class KernelView(object):
+    # A KernelCache seen through a row index map, so shuffled or subsetted data (e.g., the outer training folds of
+    # nested CV for every seed) index into one full-sample cache without copying it.
+
+    def __init__(self, cache, idx):
+        self.cache = cache
+        self.idx = np.asarray(idx)
+        self.n_features = cache.n_features
+
+    def get_block(self, rows, cols, kernel = 'rbf', gamma = None):
+        return self.cache.get_block(self.idx[rows], self.idx[cols], kernel = kernel, gamma = gamma)
+
+    def subset(self, idx):
+        return KernelView(self.cache, self.idx[idx])
+
+
+def get_gamma(reg, X_train):
+    # numeric gamma the estimator would use when fit on X_train
+    gamma = reg.gamma
+    if gamma == 'scale':
+        X_var = X_train.var()
+        gamma = 1.0 / (X_train.shape[1] * X_var) if X_var != 0 else 1.0
+    elif gamma == 'auto' or gamma is None:
+        gamma = 1.0 / X_train.shape[1]
+    return gamma
+
+
+def get_kernel_folds(X_folds, reg, caches = None, folds = None):
+    # exact precomputed kernels (K_train, K_test) for each fold from per-fold features (see get_X_folds), for use
+    # with get_precomputed_reg(reg). Pass the same caches list back in to reuse the distances for another gamma.
+    # folds optionally restricts this to a subset of fold indices.
+    if caches is None: caches = [None,] * len(X_folds)
+    if folds is None: folds = np.arange(len(X_folds))
+    K_folds = []
+
+    for k in folds:
+        X_train, X_test = X_folds[k]
+        n_train = X_train.shape[0]
+        if caches[k] is None: caches[k] = KernelCache(np.vstack((X_train, X_test)))
+
+        tr = np.arange(n_train); te = np.arange(n_train, n_train + X_test.shape[0])
+        gamma = get_gamma(reg, X_train)
+        K_folds.append((caches[k].get_block(tr, tr, kernel = reg.kernel, gamma = gamma),
+                        caches[k].get_block(te, tr, kernel = reg.kernel, gamma = gamma)))
+
+    return K_folds
+
+
+def has_kernel(reg):
+    # estimators whose kernel can be served from a KernelCache
+    return type(reg) in (KernelRidge, SVR) and reg.kernel in ('linear', 'rbf')
+
+
+def get_precomputed_reg(reg):
+    # copy of a KernelRidge/SVR that takes precomputed kernels in place of X
+    new_reg = copy.deepcopy(reg)
+    new_reg.kernel = 'precomputed'
+    return new_reg
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# linear smoothers
+def is_linear_smoother(reg):
+    # True if, for fixed hyperparameters, test predictions are a fixed matrix times y_train
+    return type(reg) in (Ridge, KernelRidge)
+
+
+def get_kernel(X, Y, reg):
+    # same kernel KernelRidge would compute internally
+    if callable(reg.kernel):
+        params = reg.kernel_params or {}
+    else:
+        params = {'gamma': reg.gamma, 'degree': reg.degree, 'coef0': reg.coef0}
+    return pairwise_kernels(X, Y, metric = reg.kernel, filter_params = True, **params)
+
+
+def get_smoother(X_train, X_test, reg):
+    # (n_test, n_train) matrix S such that reg.fit(X_train, y_train).predict(X_test) == S @ y_train.
+    # Only valid for Ridge and KernelRidge (see is_linear_smoother). For KernelRidge(kernel = 'precomputed'),
+    # X_train and X_test are the train and test kernel blocks.
+    n_train = X_train.shape[0]
+
+    if type(reg) == KernelRidge:
+        if reg.kernel == 'precomputed':
+            # X_train/X_test are already K_train/K_test (see get_kernel_folds)
+            K = X_train.copy(); K_test = X_test
+        else:
+            K = get_kernel(X_train, X_train, reg); K_test = get_kernel(X_test, X_train, reg)
+        K[np.diag_indices_from(K)] += reg.alpha
+        S = sp.linalg.solve(K, K_test.T, assume_a = 'pos').T
+    elif type(reg) == Ridge:
+        if reg.fit_intercept:
+            X_offset = X_train.mean(axis = 0)
+        else:
+            X_offset = np.zeros(X_train.shape[1])
+        Xc = X_train - X_offset
+        Xc_test = X_test - X_offset
+
+        if Xc.shape[1] <= n_train:
+            # primal: (Xc'Xc + aI)^-1 Xc'. Xc' 1 = 0 so the y centering drops out
+            G = np.dot(Xc.T, Xc)
+            G[np.diag_indices_from(G)] += reg.alpha
+            S = np.dot(Xc_test, sp.linalg.solve(G, Xc.T, assume_a = 'pos'))
+        else:
+            # dual: Xc' (XcXc' + aI)^-1 (I - 11'/n)
+            K = np.dot(Xc, Xc.T)
+            K[np.diag_indices_from(K)] += reg.alpha
+            S = np.dot(np.dot(Xc_test, Xc.T), sp.linalg.inv(K, overwrite_a = True))
+            if reg.fit_intercept: S -= S.mean(axis = 1, keepdims = True)
+
+        if reg.fit_intercept: S += 1 / n_train
+    else:
+        raise ValueError('get_smoother: estimator is not linear in y: ' + type(reg).__name__)
+
+    return S
+# --------------------------------------------------------------------------------------------------------------------
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# regularization paths
+def get_krr_path(K_train, K_test, y_train, alphas):
+    # KernelRidge predictions for every alpha from one eigendecomposition of the train kernel.
+    # K_train = V diag(w) V', so (K_train + aI)^-1 y = V diag(1 / (w + a)) V' y for any a.
+    # K_train (n_train, n_train), K_test (n_test, n_train), y_train (n_train,) or (n_train, m).
+    # Returns (n_test, n_alphas), or (n_test, m, n_alphas) for 2d y_train.
+    alphas = np.asarray(alphas, dtype = np.float64)
+    w, V = sp.linalg.eigh(K_train)
+    w = np.maximum(w, 0) # clip round-off negatives; K_train is psd
+
+    KV = np.dot(K_test, V)
+    Vy = np.dot(V.T, y_train)
+    if Vy.ndim == 1:
+        return np.dot(KV, Vy[:,np.newaxis] / (w[:,np.newaxis] + alphas[np.newaxis,:]))
+    else:
+        return np.einsum('ti,im,ia->tma', KV, Vy, 1 / (w[:,np.newaxis] + alphas[np.newaxis,:]))
+
+
+def get_svr_path(K_train, K_test, y_train, Cs, reg):
+    # SVR predictions for every C on one pair of precomputed kernel blocks (see get_kernel_folds). libsvm has no warm
+    # start, so each C is still its own fit, but none of them compute a kernel entry. reg is an
+    # SVR(kernel = 'precomputed') carrying the other params (epsilon, tol, ...). Returns (n_test, n_Cs).
+    y_pred = np.zeros((K_test.shape[0], len(Cs)))
+    for i, C in enumerate(Cs):
+        svr = copy.deepcopy(reg); svr.C = C
+        svr.fit(K_train, y_train)
+        y_pred[:,i] = svr.predict(K_test)
+
+    return y_pred
+
+
+def get_lasso_path(X_train, X_test, y_train, alphas, fit_intercept = True, precompute = True, tol = 1e-4, max_iter = 1000):
+    # Lasso predictions for every alpha from one coordinate descent path: alphas are fit from largest to smallest,
+    # each warm started from the previous solution, with the Gram matrix X'X computed once for the whole path
+    # (precompute = True). Same objective, tol and max_iter as Lasso(); solutions agree with cold-start fits to
+    # within the solver tolerance. Returns (n_test, n_alphas) in the order alphas were given.
+    alphas = np.asarray(alphas, dtype = np.float64)
+    if fit_intercept:
+        X_offset = X_train.mean(axis = 0); y_offset = y_train.mean()
+    else:
+        X_offset = np.zeros(X_train.shape[1]); y_offset = 0
+    Xc = np.asfortranarray(X_train - X_offset)
+    yc = y_train - y_offset
+
+    order = np.argsort(alphas)[::-1]
+    Gram = np.dot(Xc.T, Xc) if precompute else None
+    _, coefs, _ = lasso_path(Xc, yc, alphas = alphas[order], precompute = Gram if precompute else False,
+                                tol = tol, max_iter = max_iter)
+
+    coef = np.zeros((X_train.shape[1], len(alphas)))
+    coef[:,order] = coefs
+    return np.dot(X_test - X_offset, coef) + y_offset
+
+
+def get_ridge_svd(X_train, y_train, fit_intercept = True):
+    # thin SVD of the (centered) train features and the projected (centered) outcome, shared by every alpha
+    if fit_intercept:
+        X_offset = X_train.mean(axis = 0); y_offset = y_train.mean(axis = 0)
+    else:
+        X_offset = np.zeros(X_train.shape[1]); y_offset = 0
+    U, s, Vt = sp.linalg.svd(X_train - X_offset, full_matrices = False)
+    Uy = np.dot(U.T, y_train - y_offset)
+
+    return {'U': U, 's': s, 'Vt': Vt, 'Uy': Uy, 'X_offset': X_offset, 'y_offset': y_offset}
+
+
+def get_ridge_coef_path(svd, alphas):
+    # (p, n_alphas) Ridge coefficients for every alpha: V diag(s / (s^2 + a)) U' y
+    alphas = np.asarray(alphas, dtype = np.float64)
+    d = svd['s'][:,np.newaxis] / (svd['s'][:,np.newaxis]**2 + alphas[np.newaxis,:])
+    return np.dot(svd['Vt'].T, d * svd['Uy'][:,np.newaxis])
+
+
+def get_ridge_path(X_train, X_test, y_train, alphas, fit_intercept = True):
+    # Ridge predictions for every alpha from one thin SVD of the train features. Returns (n_test, n_alphas).
+    svd = get_ridge_svd(X_train, y_train, fit_intercept = fit_intercept)
+    coef = get_ridge_coef_path(svd, alphas)
+    return np.dot(X_test - svd['X_offset'], coef) + svd['y_offset']
+
+
+def get_ridge_gram_path(gram, X_train, X_test, y_train, alphas):
+    # get_ridge_path (fit_intercept = True) from the Gram matrix of the centered train features, e.g. the standardized
+    # training fold Gram from get_fold_stats, instead of an SVD of X_train: (G + a I)^-1 X' y for every alpha from one
+    # eigendecomposition of the p x p Gram. Cheaper than the thin SVD when p is well below n_train. X_train must be
+    # centered (standardized fold features are). Returns (n_test, n_alphas).
+    alphas = np.asarray(alphas, dtype = np.float64)
+    y_offset = y_train.mean(axis = 0)
+    w, V = sp.linalg.eigh(gram)
+    w = np.maximum(w, 0)
+    Vy = np.dot(V.T, np.dot(X_train.T, y_train - y_offset))
+    coef = np.dot(V, Vy[:,np.newaxis] / (w[:,np.newaxis] + alphas[np.newaxis,:]))
+    return np.dot(X_test, coef) + y_offset
+
+
+def get_ridge_loo_path(X, y, alphas, fit_intercept = True, cv_mode = 'loo', svd = None):
+    # Leave-one-out predictions for every alpha from the same SVD, without refitting: the LOO residual is
+    # r_i / (1 - h_ii), with h the diagonal of the hat matrix (cv_mode = 'loo'), or r_i / (1 - trace(H) / n)
+    # for generalized cross-validation (cv_mode = 'gcv'). Returns (n, n_alphas).
+    alphas = np.asarray(alphas, dtype = np.float64)
+    if svd is None: svd = get_ridge_svd(X, y, fit_intercept = fit_intercept)
+    n = X.shape[0]
+
+    shrink = svd['s'][:,np.newaxis]**2 / (svd['s'][:,np.newaxis]**2 + alphas[np.newaxis,:])
+    y_fit = np.dot(svd['U'], shrink * svd['Uy'][:,np.newaxis]) + svd['y_offset']
+    h = np.dot(svd['U']**2, shrink)
+    if fit_intercept: h += 1 / n
+    if cv_mode == 'gcv': h = np.broadcast_to(h.mean(axis = 0), h.shape)
+
+    resid = y[:,np.newaxis] - y_fit
+    return y[:,np.newaxis] - resid / (1 - h)
+
+
+class RidgePathCV(RegressorMixin, BaseEstimator):
+    # Ridge that picks its own alpha by efficient leave-one-out (or GCV) on the training data: one thin SVD per fit
+    # scores every alpha (see get_ridge_loo_path), then the coefficients for the best alpha come from the same SVD.
+    # score is any of the score names in prediction_func; None uses mean squared LOO error.
+
+    def __init__(self, alphas = np.logspace(0.5, -1, 10), fit_intercept = True, score = None, cv_mode = 'loo'):
+        self.alphas = alphas
+        self.fit_intercept = fit_intercept
+        self.score = score
+        self.cv_mode = cv_mode
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype = np.float64); y = np.asarray(y, dtype = np.float64)
+        svd = get_ridge_svd(X, y, fit_intercept = self.fit_intercept)
+        y_loo = get_ridge_loo_path(X, y, self.alphas, fit_intercept = self.fit_intercept, cv_mode = self.cv_mode, svd = svd)
+
+        score = 'mse' if self.score is None else self.score
+        self.cv_scores_ = get_scores_batch(y, y_loo, score = score)
+        self.best_index_ = int(np.nanargmax(self.cv_scores_))
+        self.alpha_ = np.asarray(self.alphas)[self.best_index_]
+
+        self.coef_ = get_ridge_coef_path(svd, [self.alpha_,])[:,0]
+        self.intercept_ = svd['y_offset'] - np.dot(svd['X_offset'], self.coef_)
+
+        return self
+
+    def predict(self, X):
+        return np.dot(np.asarray(X, dtype = np.float64), self.coef_) + self.intercept_
+# --------------------------------------------------------------------------------------------------------------------
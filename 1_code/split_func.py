@@ -0,0 +1,108 @@
+# Linden Parkes, 2020
+# lindenmp@seas.upenn.edu
+
+# Split plans: the cross-validation folds the cluster scripts and results notebooks use, generated once and stored as
+# integer arrays in a shared directory so every job (and notebook) that works on the same sample reads, via a memory
+# map, exactly the same folds. Only depends on numpy and pandas.
+
+# Essentials
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# split plans
+#   stratified: get_stratified_cv. rows sorted on y, every n_splits-th sorted row in the same test fold (seed unused)
+#   random:     get_repeated_cv. repeat r shuffles the rows with np.random.seed(seed + r), then KFold(n_splits)
+#   nested:     run_ncv. repeat r shuffles the rows as shuffle_data(seed = seed + r) in predict_symptoms_ncv.py, then
+#               outer KFold(n_splits) and an inner KFold(n_splits) on every outer training set
+split_schemes = ['stratified', 'random', 'nested']
+
+
+def get_sample_hash(index, y = None):
+    # short hash of the sample (row labels, in row order) a plan is made for. the stratified folds also depend on
+    # the outcome, so y is hashed with the rows when it is given
+    h = hashlib.sha1(pd.util.hash_pandas_object(index).values.tobytes())
+    if y is not None: h.update(pd.util.hash_pandas_object(pd.Series(np.asarray(y)), index = False).values.tobytes())
+    return h.hexdigest()[:16]
+
+
+def get_kfold_labels(n, n_splits = 10):
+    # test fold of every row under KFold(n_splits, shuffle = False): contiguous blocks, the first n % n_splits one
+    # row larger
+    fold_sizes = np.full(n_splits, n // n_splits); fold_sizes[:n % n_splits] += 1
+    return np.repeat(np.arange(n_splits), fold_sizes)
+
+
+def make_split_plan(n, scheme, seed = 0, n_splits = 10, n_repeats = 1, y = None):
+    # Split plan for n rows: an int32 array (n_repeats, n_rows, n). For every repeat, row 0 is the order the rows are
+    # used in (positions into the original rows: the sort on y or the shuffle) and row 1 the test fold of every
+    # position in that order. Nested plans add one row per outer fold with the inner test fold of every position in
+    # the outer training set (-1 on the outer test fold). y is needed for scheme = 'stratified'.
+    if scheme not in split_schemes: raise ValueError('make_split_plan: unknown scheme ' + str(scheme))
+    n_rows = 2 + n_splits if scheme == 'nested' else 2
+    plan = np.zeros((n_repeats, n_rows, n), dtype = np.int32)
+
+    for r in np.arange(n_repeats):
+        if scheme == 'stratified':
+            # same sort as y.sort_values in get_stratified_cv
+            plan[r,0] = pd.Series(np.asarray(y)).sort_values(ascending = True).index.values
+            plan[r,1] = np.arange(n) % n_splits
+        else:
+            np.random.seed(seed + r)
+            idx = np.arange(n)
+            np.random.shuffle(idx)
+            plan[r,0] = idx
+            plan[r,1] = get_kfold_labels(n, n_splits = n_splits)
+
+        if scheme == 'nested':
+            for k in np.arange(n_splits):
+                plan[r,2+k] = -1
+                plan[r,2+k,plan[r,1] != k] = get_kfold_labels(n - np.sum(plan[r,1] == k), n_splits = n_splits)
+
+    return plan
+
+
+def get_plan_file(split_dir, sample_hash, scheme, seed = 0, n_splits = 10, n_repeats = 1):
+    # plans are keyed on (sample hash, scheme, seed); the number of folds and repeats are part of the scheme
+    return os.path.join(split_dir, '{0}_{1}_k{2}_r{3}_s{4}.npy'.format(sample_hash, scheme, n_splits, n_repeats, seed))
+
+
+def get_split_plan(split_dir, index, scheme, seed = 0, n_splits = 10, n_repeats = 1, y = None):
+    # The split plan for the rows labelled index (see make_split_plan), memory-mapped read-only from split_dir. The
+    # first job to ask for a plan writes it (to a temporary file that is then renamed into place, so concurrent
+    # jobs never read a partial plan); every later job, notebook or worker maps the same file. With split_dir None
+    # the plan is made in memory and not stored.
+    if split_dir is None: return make_split_plan(len(index), scheme, seed = seed, n_splits = n_splits, n_repeats = n_repeats, y = y)
+
+    sample_hash = get_sample_hash(index, y = y if scheme == 'stratified' else None)
+    plan_file = get_plan_file(split_dir, sample_hash, scheme, seed = seed, n_splits = n_splits, n_repeats = n_repeats)
+
+    if not os.path.exists(plan_file):
+        if not os.path.exists(split_dir): os.makedirs(split_dir, exist_ok = True)
+        plan = make_split_plan(len(index), scheme, seed = seed, n_splits = n_splits, n_repeats = n_repeats, y = y)
+        tmp_file = plan_file + '.' + str(os.getpid()) + '.tmp'
+        f = open(tmp_file, 'wb'); np.save(f, plan); f.close()
+        os.replace(tmp_file, plan_file)
+
+    return np.load(plan_file, mmap_mode = 'r')
+
+
+def get_fold_cv(fold):
+    # [(train_idx, test_idx), ...] from the test fold of every row; rows labelled -1 are in neither
+    n_splits = int(fold.max()) + 1
+    return [(np.flatnonzero((fold != k) & (fold >= 0)), np.flatnonzero(fold == k)) for k in np.arange(n_splits)]
+
+
+def get_plan_cv(plan, r = 0):
+    # repeat r of a split plan as (order, my_cv), my_cv holding positions into the rows taken in that order
+    return np.asarray(plan[r,0], dtype = int), get_fold_cv(np.asarray(plan[r,1]))
+
+
+def get_plan_inner_cv(plan, r = 0, k = 0):
+    # inner folds of outer fold k of a nested plan, as positions into the outer training rows
+    outer = np.asarray(plan[r,1])
+    return get_fold_cv(np.asarray(plan[r,2+k])[outer != k])
+# --------------------------------------------------------------------------------------------------------------------